@@ -15,12 +15,22 @@ import pickle
 import gc
 import psutil
 import threading
+import bisect
+import unicodedata
+import mimetypes
+from array import array
+from collections import deque
+from types import SimpleNamespace
 import requests
 import xml.etree.ElementTree as ET
 import email.utils
 
 import ctypes  # For malloc_trim
 
+from textbook_index import (TEXTBOOK_HEADER_PATTERN, quantize_vectors_int8, build_textbook_bm25_index,
+                            build_textbook_section_index, normalize_search_text as _normalize_essay_search_text,
+                            search_bigrams as _essay_search_bigrams, normalize_section_title as _normalize_section_title)
+
 
 def wilson_lower_bound(correct, total, z=1.96):
     """Wilson Score の下限値（信頼度調整済み正答率）
@@ -43,7 +53,7 @@ load_dotenv()
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
 # feedparser: 遅延インポート (update_world_news内でのみ使用)
-# numpy: 削除 (pure Pythonのmathモジュールで代替)
+# numpy: 遅延インポート (TextbookManagerのベクトル検索でのみ使用)
 # google.genai types: 遅延インポート (AI関連関数内でのみ使用)
 
 # Check if memory usage exceeds this threshold (MB)
@@ -52,11 +62,45 @@ MEMORY_THRESHOLD_MB = 300
 
 # In-memory Caches
 ROOM_SETTING_CACHE = {} # {room_number: {'data': dict, 'timestamp': float}}
-WORD_DATA_CACHE = {}    # {filename: {'data': list, 'timestamp': float}}
+WORD_DATA_CACHE = {}    # {filename: {'data': list, 'timestamp': float, 'rpg_pools': {room_number: dict}}}
 CACHE_TTL = 180         # 3 minutes (reduced for 512MB)
 MAX_WORD_DATA_CACHE_SIZE = 2      # Limit number of large CSVs in memory (reduced for 512MB)
 MAX_ROOM_SETTING_CACHE_SIZE = 50  # Limit number of room settings in memory (reduced for 512MB)
 
+# RPGボス戦用キャッシュ
+RPG_BATTLE_STORE = {}        # {battle_id: {'user_id': int, 'answers': list, 'stage_id': int, 'expires_at': datetime(UTC)}} RpgBattle の変わらない部分のメモリ上の写し
+RPG_BATTLE_STORE_LOCK = threading.Lock()
+RPG_BATTLE_TTL = 1800             # 30 minutes (戦闘は最長でも数分で終わる)
+MAX_RPG_PROBLEM_POOL_CACHE_SIZE = 10  # CSV1件あたりの部屋数（プールはWORD_DATA_CACHEのエントリ内に持ち、CSVと一緒に破棄される）
+RPG_BOSS_LADDER_CACHE = {}   # {'scores': list, 'bosses': list} 出現スコア昇順の有効ボス一覧（管理画面での編集時に破棄）
+RPG_USER_STATE_CACHE = {}    # {user_id: {'cleared_stages': frozenset, 'last_challenge_at': datetime, 'timestamp': float}}
+STREAK_CACHE = {}            # {user_id: {'logic_date': date, 'streak': int, 'timestamp': float}}
+MAX_RPG_USER_STATE_CACHE_SIZE = 500
+
+# 論述問題の公開設定キャッシュ
+ESSAY_VISIBILITY_CACHE = {}  # {room_number: {'data': {(chapter, problem_type): bool}, 'timestamp': float}}
+ESSAY_CHAPTER_STATS_CACHE = {}  # {user_id: {'room_number': str, 'data': dict, 'timestamp': float}}
+ESSAY_CHAPTER_STATS_TTL = 60    # 進捗更新時にも破棄されるため短め
+MAX_ESSAY_CHAPTER_STATS_CACHE_SIZE = 200
+ESSAY_SEARCH_INDEX = {}      # {'data': {'postings': {bigram: (ids, tfs)}, 'doc_lengths': dict, 'doc_count': int, 'avg_doc_length': float}, 'timestamp': float}
+ESSAY_SEARCH_INDEX_LOCK = threading.Lock()
+ESSAY_SEARCH_INDEX_TTL = 3600   # 追加・編集・CSVアップロード時にも破棄される
+ESSAY_SEARCH_MAX_IN_IDS = 500   # これを超える候補はIN句で絞らず通常の部分一致に任せる
+ANSWER_KEYWORD_MATCHER_CACHE = {}  # {'version': tuple, 'matcher': dict, 'word_by_answer': dict} 全CSVの答え語オートマトン
+ANSWER_KEYWORD_MATCHER_LOCK = threading.Lock()
+
+# 埋め込みベクトルのキャッシュ（EmbeddingCacheテーブルの前段のLRU。教科書検索の全呼び出し元で共有）
+EMBEDDING_MODEL = "models/gemini-embedding-001"  # scripts/build_vector_db.py と合わせる
+EMBEDDING_CACHE = {}         # {(model, text_hash): array('f')} 参照のたびに末尾へ移動（先頭が最も古い）
+EMBEDDING_CACHE_LOCK = threading.Lock()
+MAX_EMBEDDING_CACHE_SIZE = 64  # 3072次元 x 4byte = 約12KB/件
+IMAGE_VARIANT_SRCSET_CACHE = {}  # {(source_type, source_id, source_hash): str} ハッシュを含むので差し替え後も古い値は使われない
+MAX_IMAGE_VARIANT_SRCSET_CACHE_SIZE = 500
+EMBEDDING_CACHE_STATS = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+# 教科書検索の方式: 'vector' / 'hybrid'（ベクトル + BM25 をRRFで統合。環境変数で明示したときのみ）/ 'bm25'（埋め込みAPIを使わない）
+# 既定値を変えると採点に渡る教科書の抜粋が変わるので ESSAY_GRADING_PROMPT_VERSION も上げる
+TEXTBOOK_RETRIEVAL_MODE = os.environ.get('TEXTBOOK_RETRIEVAL_MODE', 'vector')
+
 # ニュース更新状態の追跡
 NEWS_UPDATE_LOCK = threading.Lock()
 NEWS_UPDATE_IN_PROGRESS = False
@@ -67,7 +111,7 @@ from html.parser import HTMLParser
 import html
 # import pykakasi (Removed to save 300MB memory)
 # MeCab, unidic_lite: 遅延インポート (get_katakana_from_mecab内でのみ使用)
-from sqlalchemy import inspect, text, func, case, cast, Integer, bindparam
+from sqlalchemy import inspect, text, func, case, cast, Integer, bindparam, select
 from sqlalchemy.orm import joinedload, deferred
 from datetime import date, datetime, timedelta
 import random
@@ -140,16 +184,417 @@ def get_genai_client():
     # 初回のみクライアントを作成
     try:
         from google import genai
-        _genai_client_instance = genai.Client(api_key=GEMINI_API_KEY)
+        # タイムアウトを付けて、応答しないAPIでワーカースレッドが止まり続けないようにする
+        _genai_client_instance = genai.Client(api_key=GEMINI_API_KEY, http_options={'timeout': AI_REQUEST_TIMEOUT_MS})
         print("✅ Gemini APIクライアントを初期化しました（シングルトン）")
         return _genai_client_instance
     except Exception as e:
         print(f"⚠️ Gemini API設定失敗: {e}")
         return None
 
-# AI採点の同時実行制限（メモリクラッシュ防止）
-# 同時に3件までのAI採点を許可。それを超える場合は一時的に拒否。
-ai_grading_semaphore = threading.Semaphore(1)
+# ====================================================================
+# AI Gateway（Gemini呼び出しの共通窓口）
+# ====================================================================
+# 生成・埋め込みの呼び出しはすべて AI_GATEWAY を通す。
+# - モデルごとのトークンバケットで流量を抑える（枠が空かなければ待たずにフォールバック先へ回す）
+# - 連続して失敗したモデルはサーキットブレーカーで一定時間即座に失敗させる（障害時にスレッドを滞留させない）
+# - 呼び出しごとの所要時間・トークン数・エラー種別を集計する（/admin/api/ai_gateway_metrics）
+AI_PRIMARY_MODEL = 'gemini-3.5-flash'
+AI_FALLBACK_MODEL = 'gemini-3.1-flash-lite'
+AI_MODEL_RATE_LIMITS = {  # 1分あたりの呼び出し上限。AI_MODEL_RATE_LIMITS='{"モデル名": 回数}' で上書きできる
+    AI_PRIMARY_MODEL: 60,
+    AI_FALLBACK_MODEL: 60,
+    EMBEDDING_MODEL: 300,
+}
+AI_MODEL_RATE_LIMITS.update(json.loads(os.environ.get('AI_MODEL_RATE_LIMITS', '{}')))
+AI_DEFAULT_RATE_LIMIT = 60
+AI_RATE_LIMIT_MAX_WAIT = float(os.environ.get('AI_RATE_LIMIT_MAX_WAIT', '3'))  # 枠が空くのを待つ上限（秒）
+AI_CIRCUIT_FAILURE_THRESHOLD = 5  # 連続失敗がこの回数に達したらブレーカーを開く
+AI_CIRCUIT_RESET_TIMEOUT = 60     # 開いてから試し呼び出しを許すまでの秒数
+AI_REQUEST_TIMEOUT_MS = int(os.environ.get('AI_REQUEST_TIMEOUT_MS', '90000'))
+AI_LATENCY_SAMPLES = 200          # パーセンタイル計算に残す直近の所要時間の件数
+
+class AiGatewayError(Exception):
+    """
+    AI_GATEWAY が送出するエラー。kind は
+    'unavailable'（APIキー未設定など）/ 'rate_limited'（429・流量制限）/ 'circuit_open'（障害で遮断中）/ 'upstream'（5xx・タイムアウト）
+    """
+    def __init__(self, kind, message, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+
+def classify_ai_error(error):
+    """APIの例外を 'rate_limited' / 'upstream' / 'client'（リクエスト側の問題。ブレーカーには数えない）に分類する"""
+    if isinstance(error, AiGatewayError):
+        return error.kind
+    message = str(error)
+    if '429' in message or 'RESOURCE_EXHAUSTED' in message:
+        return 'rate_limited'
+    if isinstance(error, (TimeoutError, ConnectionError)) or 'Timeout' in type(error).__name__:
+        return 'upstream'
+    if re.search(r'\b5\d\d\b', message) or any(s in message for s in ('UNAVAILABLE', 'DEADLINE_EXCEEDED', 'INTERNAL')):
+        return 'upstream'
+    return 'client'
+
+def is_ai_rate_limit_error(error):
+    """利用者に「混雑中」と返すべきエラーか（APIの429・流量制限・ブレーカー遮断中）"""
+    return classify_ai_error(error) in ('rate_limited', 'circuit_open')
+
+class AiTokenBucket:
+    """1分あたり rate_per_minute 回まで。capacity 回分までは連続で呼べる"""
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity or max(1, rate_per_minute // 6))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait=0):
+        """1回分を取り出す。max_wait 秒以内に枠が空かなければ False"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class AiCircuitBreaker:
+    """closed → (連続失敗) → open → (reset_timeout経過) → half_open（1件だけ試す）→ 成功で closed / 失敗で open"""
+    def __init__(self, failure_threshold=AI_CIRCUIT_FAILURE_THRESHOLD, reset_timeout=AI_CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.probe_in_flight:
+                    return False
+                self.probe_in_flight = True
+            return True
+
+    def release(self):
+        """allow() 後に呼び出さなかった場合（流量制限で見送りなど）に試し呼び出しの枠を戻す"""
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"⚠️ AI circuit opened after {self.failures} consecutive failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        with self.lock:
+            if self.state != 'open':
+                return 0
+            return max(0, int(math.ceil(self.reset_timeout - (time.monotonic() - self.opened_at))))
+
+class GeminiAiBackend:
+    """本番用バックエンド（google-genai の共有クライアント）"""
+    name = 'gemini'
+
+    def available(self):
+        return get_genai_client() is not None
+
+    def _client(self):
+        client = get_genai_client()
+        if not client:
+            raise AiGatewayError('unavailable', 'Gemini client could not be loaded')
+        return client
+
+    def generate(self, model, contents, config=None):
+        return self._client().models.generate_content(model=model, contents=contents, config=config)
+
+    def generate_stream(self, model, contents, config=None):
+        return self._client().models.generate_content_stream(model=model, contents=contents, config=config)
+
+    def embed(self, model, contents):
+        result = self._client().models.embed_content(model=model, contents=contents)
+        return result.embeddings[0].values
+
+class FakeAiResponse:
+    """generate_content の応答のうちアプリが参照する部分だけを持つ"""
+    def __init__(self, text, prompt_tokens=0, output_tokens=0):
+        self.text = text
+        self.candidates = [SimpleNamespace(
+            content=SimpleNamespace(parts=[SimpleNamespace(text=text)]),
+            finish_reason=SimpleNamespace(name='STOP')
+        )]
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens)
+
+class FakeAiBackend:
+    """
+    APIを呼ばないバックエンド（テスト・開発用。AI_BACKEND=fake で起動時に選ばれる）。
+    text は文字列か (model, contents) を受け取る関数。errors は {モデル名: 例外 または 例外のリスト（1回ごとに消費）}。
+    ストリーミングでは text を chunk_size 文字ずつ返す。
+    """
+    name = 'fake'
+
+    def __init__(self, text='[]', embedding=None, errors=None, chunk_size=20):
+        self.text = text
+        self.embedding = embedding or [1.0, 0.0, 0.0]
+        self.errors = dict(errors or {})
+        self.chunk_size = chunk_size
+        self.calls = []  # [(種別, モデル名)]
+
+    def available(self):
+        return True
+
+    def _raise_if_failing(self, model):
+        error = self.errors.get(model)
+        if isinstance(error, list):
+            error = error.pop(0) if error else None
+        if error is not None:
+            raise error
+
+    def generate(self, model, contents, config=None):
+        self.calls.append(('generate', model))
+        self._raise_if_failing(model)
+        text = self.text(model, contents) if callable(self.text) else self.text
+        return FakeAiResponse(text, prompt_tokens=len(str(contents)), output_tokens=len(text))
+
+    def generate_stream(self, model, contents, config=None):
+        self.calls.append(('stream', model))
+        self._raise_if_failing(model)
+        text = self.text(model, contents) if callable(self.text) else self.text
+        pieces = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or ['']
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            chunk = FakeAiResponse(piece, prompt_tokens=len(str(contents)), output_tokens=len(text))
+            if not last:
+                chunk.usage_metadata = None  # 使用量は最後の断片にだけ付く
+            yield chunk
+
+    def embed(self, model, contents):
+        self.calls.append(('embed', model))
+        self._raise_if_failing(model)
+        return list(self.embedding)
+
+class AiGateway:
+    def __init__(self, backend, rate_limits=None, max_wait=AI_RATE_LIMIT_MAX_WAIT,
+                 failure_threshold=AI_CIRCUIT_FAILURE_THRESHOLD, reset_timeout=AI_CIRCUIT_RESET_TIMEOUT):
+        self.backend = backend
+        self.rate_limits = dict(AI_MODEL_RATE_LIMITS if rate_limits is None else rate_limits)
+        self.max_wait = max_wait
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.buckets = {}
+        self.breakers = {}
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def available(self):
+        return self.backend.available()
+
+    def _model_state(self, model):
+        """モデルごとのバケット・ブレーカー・集計（初回呼び出し時に作る）"""
+        with self.lock:
+            if model not in self.breakers:
+                self.buckets[model] = AiTokenBucket(self.rate_limits.get(model, AI_DEFAULT_RATE_LIMIT))
+                self.breakers[model] = AiCircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.metrics[model] = {
+                    'calls': 0, 'success': 0, 'rejected': 0,
+                    'errors': {'rate_limited': 0, 'upstream': 0, 'client': 0, 'unavailable': 0},
+                    'prompt_tokens': 0, 'output_tokens': 0, 'latency_total': 0.0,
+                    'latencies': deque(maxlen=AI_LATENCY_SAMPLES), 'purposes': {},
+                }
+            return self.buckets[model], self.breakers[model], self.metrics[model]
+
+    def _record(self, stats, purpose, outcome, latency=None, response=None):
+        with self.lock:
+            stats['purposes'][purpose] = stats['purposes'].get(purpose, 0) + 1
+            if outcome == 'rejected':
+                stats['rejected'] += 1
+                return
+            stats['calls'] += 1
+            stats['latency_total'] += latency
+            stats['latencies'].append(latency)
+            if outcome != 'success':
+                stats['errors'][outcome] += 1
+                return
+            stats['success'] += 1
+            self._add_usage(stats, response)
+
+    def _add_usage(self, stats, response):
+        """応答の usage_metadata からトークン数を加算する（呼び出し元でロックを取る）"""
+        usage = getattr(response, 'usage_metadata', None)
+        for key, attr in (('prompt_tokens', 'prompt_token_count'), ('output_tokens', 'candidates_token_count')):
+            value = getattr(usage, attr, None)
+            if isinstance(value, int):
+                stats[key] += value
+
+    def _call(self, model, purpose, call):
+        bucket, breaker, stats = self._model_state(model)
+        if not breaker.allow():
+            self._record(stats, purpose, 'rejected')
+            raise AiGatewayError('circuit_open', f"{model}: 障害のため一時的に呼び出しを止めています",
+                                 retry_after=breaker.retry_after())
+        if not bucket.acquire(self.max_wait):
+            breaker.release()
+            self._record(stats, purpose, 'rejected')
+            raise AiGatewayError('rate_limited', f"{model}: 流量制限（{self.rate_limits.get(model, AI_DEFAULT_RATE_LIMIT)}回/分）",
+                                 retry_after=60)
+
+        start = time.monotonic()
+        try:
+            response = call(model)
+        except Exception as e:
+            kind = classify_ai_error(e)
+            self._record(stats, purpose, kind, latency=time.monotonic() - start)
+            if kind in ('client', 'unavailable'):
+                breaker.release()  # APIは応答している（または呼んでいない）ので障害には数えない
+                raise
+            breaker.record_failure()
+            raise AiGatewayError(kind, f"{model}: {e}", retry_after=breaker.retry_after() or 60) from e
+        breaker.record_success()
+        self._record(stats, purpose, 'success', latency=time.monotonic() - start, response=response)
+        return response
+
+    def _call_chain(self, models, purpose, call):
+        """先頭のモデルから順に試す。流量制限・遮断中・障害のときだけ次のモデルへ回す"""
+        for index, model in enumerate(models):
+            try:
+                return self._call(model, purpose, call)
+            except AiGatewayError as e:
+                if e.kind == 'unavailable' or index + 1 == len(models):
+                    raise
+                print(f"⚠️ AI {purpose}: {model} ({e.kind}). Switching to {models[index + 1]}...")
+
+    def generate(self, model, contents, config=None, fallback_models=(), purpose='generate', retries=0, retry_delay=5):
+        """
+        generate_content を呼ぶ。すべてのモデルが429で失敗したときは retries 回まで指数バックオフで待って再試行する
+        （リクエスト処理中のスレッドを止めないよう、既定では再試行しない）。
+        """
+        models = [model, *fallback_models]
+        for attempt in range(retries + 1):
+            try:
+                return self._call_chain(models, purpose, lambda m: self.backend.generate(m, contents, config))
+            except AiGatewayError as e:
+                if e.kind != 'rate_limited' or attempt >= retries:
+                    raise
+                print(f"⚠️ AI {purpose}: rate limited (attempt {attempt + 1}/{retries + 1}). Retrying in {retry_delay}s...")
+                time.sleep(retry_delay)
+                retry_delay *= 2
+
+    def generate_stream(self, model, contents, config=None, fallback_models=(), purpose='generate'):
+        """
+        generate_content_stream を呼び、応答の断片を順に返すジェネレーター。
+        流量制限・ブレーカー・フォールバックは最初の断片を受け取るまでに適用する（所要時間は最初の断片までを記録）。
+        """
+        opened = {}
+
+        def open_stream(m):
+            stream = iter(self.backend.generate_stream(m, contents, config))
+            opened.update(model=m, stream=stream)
+            return (next(stream, None),)  # タプルで包み、最初の断片の使用量を二重に数えない
+
+        (chunk,) = self._call_chain([model, *fallback_models], purpose, open_stream)
+        _, breaker, stats = self._model_state(opened['model'])
+        usage_chunk = None
+        try:
+            while chunk is not None:
+                if getattr(chunk, 'usage_metadata', None) is not None:
+                    usage_chunk = chunk  # 使用量は累計で届くので最後のものだけ使う
+                yield chunk
+                chunk = next(opened['stream'], None)
+        except Exception as e:
+            kind = classify_ai_error(e)
+            with self.lock:
+                stats['errors'][kind] = stats['errors'].get(kind, 0) + 1
+            if kind in ('client', 'unavailable'):
+                raise
+            breaker.record_failure()
+            raise AiGatewayError(kind, f"{opened['model']}: {e}", retry_after=breaker.retry_after() or 60) from e
+        finally:
+            with self.lock:
+                self._add_usage(stats, usage_chunk)
+            close = getattr(opened['stream'], 'close', None)
+            if close:
+                close()  # 途中で打ち切った場合もAPIとの接続を閉じる
+
+    def embed(self, model, contents, purpose='embedding'):
+        """embed_content を呼び、ベクトル（floatの列）を返す"""
+        return self._call_chain([model], purpose, lambda m: self.backend.embed(m, contents))
+
+    def snapshot(self):
+        """モデルごとの集計（管理画面用）"""
+        models = {}
+        with self.lock:
+            items = [(model, self.breakers[model], dict(stats, errors=dict(stats['errors']), purposes=dict(stats['purposes']),
+                                                           latencies=sorted(stats['latencies'])))
+                     for model, stats in self.metrics.items()]
+        for model, breaker, stats in items:
+            latencies = stats.pop('latencies')
+            latency_total = stats.pop('latency_total')
+            stats['avg_latency_ms'] = round(latency_total / stats['calls'] * 1000, 1) if stats['calls'] else None
+            stats['p95_latency_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1) if latencies else None
+            stats['rate_limit_per_minute'] = self.rate_limits.get(model, AI_DEFAULT_RATE_LIMIT)
+            stats['circuit'] = breaker.state
+            stats['circuit_retry_after'] = breaker.retry_after()
+            models[model] = stats
+        return {'backend': self.backend.name, 'models': models}
+
+AI_GATEWAY = AiGateway(FakeAiBackend() if os.environ.get('AI_BACKEND') == 'fake' else GeminiAiBackend())
+
+# AI採点・OCRの待ち行列（メモリクラッシュ防止）
+# 受け付けたジョブはDBに積み、専用ワーカースレッドが古い順に処理する。混雑時も拒否せず順番待ちにする。
+AI_GRADING_CONCURRENCY = max(1, int(os.environ.get('AI_GRADING_CONCURRENCY', '1')))  # ワーカースレッド数
+AI_GRADING_POLL_INTERVAL = 5      # ワーカーがDBを確認する間隔（秒）。投入時は即座に起こす
+AI_GRADING_JOB_RETENTION = 3600   # 完了したジョブを残しておく秒数
+AI_GRADING_WAKEUP = threading.Event()
+AI_GRADING_WORKERS = []
+AI_GRADING_WORKERS_LOCK = threading.Lock()
+AI_GRADING_CLAIM_LOCK = threading.Lock()
+AI_PRIORITY_JOB_TYPES = ('search',)  # 数秒で終わる対話的なジョブは待機中の添削より先に処理する
+AI_CANCELLABLE_JOB_TYPES = ('grade', 'ocr', 'search')  # 利用者が離れたら中断してよいジョブ
+AI_THREAD_JOB_TYPES = ('news',)  # 時間のかかる管理用ジョブは採点ワーカーを塞がないよう専用スレッドで処理する
+# この秒数ポーリングが途絶えたジョブは、クライアントが離れたとみなして中断する。
+# スマホで画面を消したり別のタブに移ると数十秒〜1分ほどポーリングが止まるため余裕を持たせ、
+# 順番待ちが長いほど（前に並んでいる件数 x AI_JOB_ABANDON_TIMEOUT_PER_JOB）待つ
+AI_JOB_ABANDON_TIMEOUT = 180
+AI_JOB_ABANDON_TIMEOUT_PER_JOB = 60
+AI_JOB_STREAMS = {}  # {job_token: {'partial': str, 'last_seen': float, 'position': int, 'cancelled': bool}}（途中経過と生存確認）
+AI_JOB_STREAMS_LOCK = threading.Lock()
+
+# OCR画像の前処理（スマホ写真をフル解像度のまま展開・保存・送信しない）
+OCR_IMAGE_MAX_SIDE = 1280                   # Geminiに送る画像の長辺（px）
+OCR_IMAGE_MAX_SOURCE_PIXELS = 50_000_000    # これより大きい画像は展開せずに拒否する
+OCR_IMAGE_JPEG_QUALITY = 85
+OCR_PREPROCESS_SLOTS = threading.BoundedSemaphore(1)  # 同時に展開する画像は1枚まで（RSSの急増を防ぐ）
+
+# AI採点結果キャッシュ（同じ答案の再提出・模範解答のデモでAPIを呼ばない）
+ESSAY_GRADING_CACHE = {}  # {cache_key: {'problem_id': int, 'data': dict, 'timestamp': float}}
+ESSAY_GRADING_CACHE_ENABLED = os.environ.get('ESSAY_GRADING_CACHE_ENABLED', 'true').lower() != 'false'
+MAX_ESSAY_GRADING_CACHE_SIZE = 200
+ESSAY_GRADING_CACHE_TTL = 86400  # 24時間（モデル側の更新で採点傾向が変わっても古い結果を使い続けない）
+ESSAY_GRADING_PROMPT_VERSION = '2'  # 採点プロンプトや教科書データを変えたら上げる（古いキャッシュを使わない）
 
 # 定数定義
 UPLOAD_FOLDER = 'uploads'
@@ -778,16 +1223,19 @@ class RpgEnemy(db.Model):
     icon_image = db.Column(db.String(255)) # ファイル名またはURL
     icon_image_content = deferred(db.Column(db.LargeBinary)) # DB保存用
     icon_image_mimetype = db.Column(db.String(50)) # MIMEタイプ
+    icon_image_hash = db.Column(db.String(32)) # 画像内容のMD5 (ETag・URLバージョン用)
     
     badge_name = db.Column(db.String(100))
     badge_image = db.Column(db.String(255)) # ファイル名またはFAクラス
     badge_image_content = deferred(db.Column(db.LargeBinary)) #  DB保存用
     badge_image_mimetype = db.Column(db.String(50)) #  MIMEタイプ
+    badge_image_hash = db.Column(db.String(32))
 
     # 討伐後画像 (Status画面用)
     defeated_image = db.Column(db.String(255)) 
     defeated_image_content = deferred(db.Column(db.LargeBinary))
     defeated_image_mimetype = db.Column(db.String(50))
+    defeated_image_hash = db.Column(db.String(32))
     
     difficulty = db.Column(db.Integer, default=1)
     description = db.Column(db.Text)
@@ -833,12 +1281,38 @@ class RpgEnemy(db.Model):
             'appearance_required_score': self.appearance_required_score,
             'is_manual_order': self.is_manual_order,
             'defeated_image': self.defeated_image,
-            # 画像配信用URL
-            'icon_url': url_for('serve_rpg_image', enemy_id=self.id, image_type='icon'),
-            'badge_url': url_for('serve_rpg_image', enemy_id=self.id, image_type='badge'),
-            'defeated_url': url_for('serve_rpg_image', enemy_id=self.id, image_type='defeated')
+            # 画像配信用URL (内容ハッシュ付きでブラウザに長期キャッシュさせる)
+            'icon_url': rpg_image_url(self.id, 'icon', self.icon_image_hash),
+            'badge_url': rpg_image_url(self.id, 'badge', self.badge_image_hash),
+            'defeated_url': rpg_image_url(self.id, 'defeated', self.defeated_image_hash),
+            # 一覧表示用の縮小版（DBに画像がある場合のみ）
+            'icon_thumb_url': image_variant_url('rpg_icon', self.id, self.icon_image_hash, IMAGE_VARIANT_WIDTHS['rpg_icon'][0]) if self.icon_image_hash else None
         }
 
+def rpg_image_url(enemy_id, image_type, image_hash=None):
+    """RPG画像のURL。ハッシュがあればバージョンとしてURLに含める"""
+    if image_hash:
+        return url_for('serve_rpg_image', enemy_id=enemy_id, image_type=image_type, version=image_hash)
+    return url_for('serve_rpg_image', enemy_id=enemy_id, image_type=image_type)
+
+def essay_image_url(problem_id, image_hash=None):
+    """論述問題画像のURL。ハッシュがあればバージョンとしてURLに含める"""
+    if image_hash:
+        return url_for('essay_image', problem_id=problem_id, version=image_hash)
+    return url_for('essay_image', problem_id=problem_id)
+
+def correction_image_url(image_id, image_hash=None):
+    """添削画像のURL。ハッシュがあればバージョンとしてURLに含める"""
+    if image_hash:
+        return url_for('serve_correction_image', image_id=image_id, version=image_hash)
+    return url_for('serve_correction_image', image_id=image_id)
+
+def map_image_url(filename, image_hash=None):
+    """地図画像のURL。filenameが<path:>なのでバージョンはクエリ(v)で渡す"""
+    if image_hash:
+        return url_for('serve_map_image', filename=filename, v=image_hash)
+    return url_for('serve_map_image', filename=filename)
+
 class MapGenre(db.Model):
     """地図ジャンル管理"""
     __tablename__ = 'mq_genre'
@@ -857,7 +1331,8 @@ class MapImage(db.Model):
     genre_id = db.Column(db.Integer, db.ForeignKey('mq_genre.id'), nullable=True) # Link to MapGenre
     display_order = db.Column(db.Integer, default=0)
     filename = db.Column(db.String(255), nullable=False)
-    image_data = db.Column(db.LargeBinary, nullable=True) # BLOB storage for persistence
+    image_data = deferred(db.Column(db.LargeBinary, nullable=True)) # BLOB storage for persistence
+    image_hash = db.Column(db.String(32)) # 画像内容のMD5 (ETag・URLバージョン用)
     is_active = db.Column(db.Boolean, default=False) # Public/Private status
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(JST))
     
@@ -1653,8 +2128,7 @@ def update_world_news():
         if not all_items:
             return False, "RSSフィードからニュースを取得できませんでした。ネットワーク接続を確認してください。"
 
-        client = get_genai_client()
-        if not client:
+        if not AI_GATEWAY.available():
             return False, "Gemini APIクライアントの初期化に失敗しました。APIキーが設定されているか確認してください。"
 
         # 重複排除
@@ -1708,37 +2182,27 @@ def update_world_news():
 {news_text}
 """
         try:
-            # リトライ設定（429 Resource Exhausted対策）
-            max_retries = 3
-            retry_delay = 5 # seconds
-            
-            last_error = None
-            data_json = None
-            for attempt in range(max_retries):
-                try:
-                    response = client.models.generate_content(
-                        model='gemini-3.5-flash',
-                        contents=prompt,
-                        config={
-                            'response_mime_type': 'application/json',
-                            'response_schema': NewsResponseSchema,
-                            'temperature': 0.3
-                        }
-                    )
-                    data_json = json.loads(response.text)
-                    break # 成功したらループを抜ける
-                except Exception as e:
-                    last_error = e
-                    if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-                        print(f"⚠️ Gemini API Quota Hit (Attempt {attempt+1}/{max_retries}). Retrying in {retry_delay}s...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2 # 指数バックオフ
-                    else:
-                        raise # その他のエラーは外側のexceptへ
-            else:
+            # 429 Resource Exhausted対策: バックグラウンド処理なので指数バックオフで2回まで再試行する
+            try:
+                response = AI_GATEWAY.generate(
+                    AI_PRIMARY_MODEL,
+                    prompt,
+                    config={
+                        'response_mime_type': 'application/json',
+                        'response_schema': NewsResponseSchema,
+                        'temperature': 0.3
+                    },
+                    purpose='world_news',
+                    retries=2,
+                    retry_delay=5
+                )
+            except AiGatewayError as e:
+                if not is_ai_rate_limit_error(e):
+                    raise # その他のエラーは外側のexceptへ
                 # リトライ上限に達した
-                print(f"❌ Gemini API News Update Error (Max retries reached): {last_error}")
-                return False, f"Gemini APIのリトライ上限に達しました: {str(last_error)}"
+                print(f"❌ Gemini API News Update Error (Max retries reached): {e}")
+                return False, f"Gemini APIのリトライ上限に達しました: {str(e)}"
+            data_json = json.loads(response.text)
             
             now = datetime.now(JST)
             data = {
@@ -2063,6 +2527,18 @@ class RpgState(db.Model):
     def __repr__(self):
         return f'<RpgState User:{self.user_id} Bonus:{self.permanent_bonus_percent}%>'
 
+class RpgBattle(db.Model):
+    """進行中のボス戦（正解と正誤数。ワーカーが再起動しても勝利判定できるようDBに置く）"""
+    __tablename__ = 'rpg_battles'
+    id = db.Column(db.Integer, primary_key=True)
+    battle_id = db.Column(db.String(32), unique=True, nullable=False)  # セッションに入れる推測されにくいID
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    stage_id = db.Column(db.Integer, nullable=False)
+    answers = db.Column(JSONEncodedDict, nullable=False)  # 出題順の正解リスト
+    correct_count = db.Column(db.Integer, default=0, nullable=False)
+    incorrect_count = db.Column(db.Integer, default=0, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # UTC
+
 class YearlyBaseline(db.Model):
     """年度別スコア計算のためのベースラインスナップショット"""
     __tablename__ = 'yearly_baseline'
@@ -2112,6 +2588,56 @@ class EssayVisibilitySetting(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
+def compute_essay_grading_metadata(question, answer):
+    """
+    AI添削で使う問題ごとの値を計算する（問題の登録・編集・CSV取込時に1回だけ実行）。
+    - grading_max_length / grading_min_length: 問題文の「XX字以内」「XX字以上」「XX〜YY字」等から読み取った字数制限（なければ0）
+    - model_answer_clean_length: タグと空白を除いた解答例の字数
+    - clean_question: タグを除去した問題文（一覧のプレビュー用）
+    """
+    question = question or ''
+    max_length = 0
+    min_length = 0
+
+    # 1. 「XX字以内」「XX字以下」
+    limit_match_max = re.search(r'(\d+)字(?:以内|以下)', question)
+    if limit_match_max:
+        max_length = int(limit_match_max.group(1))
+
+    # 明示的な下限「XX字以上」
+    limit_match_min = re.search(r'(\d+)字以上', question)
+    if limit_match_min:
+        min_length = int(limit_match_min.group(1))
+
+    # 範囲指定「XX〜YY字」（上限・下限の両方）
+    if max_length == 0:
+        limit_match_range = re.search(r'(\d+)[〜~-](\d+)字', question)
+        if limit_match_range:
+            min_length = int(limit_match_range.group(1))
+            max_length = int(limit_match_range.group(2))
+
+    # 「XX字」「XX字程度」（「以上」は除く）のうち最大のもの
+    if max_length == 0:
+        candidates = [int(m.group(1)) for m in re.finditer(r'(\d+)字(以上|程度)?', question) if m.group(2) != '以上']
+        if candidates:
+            max_length = max(candidates)
+
+    model_answer_length = len(re.sub(r'\s+', '', strip_tags(answer))) if answer else 0
+
+    return {
+        'grading_max_length': max_length,
+        'grading_min_length': min_length,
+        'model_answer_clean_length': model_answer_length,
+        'clean_question': re.sub(r'<[^>]+>', '', question).replace('\n', ' ').strip()
+    }
+
+# 論述問題ごとに事前計算して保存する関連教科書セクションの件数
+ESSAY_TEXTBOOK_SECTIONS_TOP_K = 3
+
+def essay_textbook_sections_key(question):
+    """関連セクションを計算した時点の問題文を表すキー（問題文が変わったら再計算が必要）"""
+    return hashlib.sha256((question or '').encode('utf-8')).hexdigest()
+
 class EssayProblem(db.Model):
     __tablename__ = 'essay_problems'
     __table_args__ = {'extend_existing': True}
@@ -2130,6 +2656,43 @@ class EssayProblem(db.Model):
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(JST))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(JST))
     image_url = db.Column(db.Text, nullable=True) 
+    # AI添削用の事前計算値（compute_essay_grading_metadata参照。NULLは未計算）
+    grading_max_length = db.Column(db.Integer, nullable=True)
+    grading_min_length = db.Column(db.Integer, nullable=True)
+    model_answer_clean_length = db.Column(db.Integer, nullable=True)
+    clean_question = db.Column(db.Text, nullable=True)
+    # 関連教科書セクション（JSON配列）と計算時の問題文キー（map_essay_problems_to_textbook参照）
+    textbook_sections = db.Column(db.Text, nullable=True)
+    textbook_sections_key = db.Column(db.String(64), nullable=True)
+    
+    def refresh_grading_metadata(self):
+        """問題文・解答例から採点用の事前計算値を更新する（登録・編集時に呼ぶ）"""
+        for key, value in compute_essay_grading_metadata(self.question, self.answer).items():
+            setattr(self, key, value)
+
+    def get_grading_metadata(self):
+        """採点用の事前計算値を返す（未計算の古い問題はその場で計算する）"""
+        if self.model_answer_clean_length is None:
+            return compute_essay_grading_metadata(self.question, self.answer)
+        return {
+            'grading_max_length': self.grading_max_length or 0,
+            'grading_min_length': self.grading_min_length or 0,
+            'model_answer_clean_length': self.model_answer_clean_length,
+            'clean_question': self.clean_question or ''
+        }
+
+    def get_textbook_sections(self):
+        """事前計算済みの関連セクション名を返す（未計算・問題文変更後はNone）"""
+        if not self.textbook_sections or self.textbook_sections_key != essay_textbook_sections_key(self.question):
+            return None
+        try:
+            return json.loads(self.textbook_sections)
+        except ValueError:
+            return None
+
+    def set_textbook_sections(self, titles):
+        self.textbook_sections = json.dumps(list(titles), ensure_ascii=False)
+        self.textbook_sections_key = essay_textbook_sections_key(self.question)
     
     @property
     def clean_answer_length(self):
@@ -2154,10 +2717,13 @@ class EssayProblem(db.Model):
         """HTMLタグを除去した問題文の先頭150文字を返す"""
         if not self.question:
             return ""
-        # タグ除去
-        text = re.sub(r'<[^>]+>', '', self.question)
-        # 改行をスペースに置換して整形
-        text = text.replace('\n', ' ').strip()
+        if self.clean_question is not None:
+            text = self.clean_question  # 登録時に計算済み
+        else:
+            # タグ除去
+            text = re.sub(r'<[^>]+>', '', self.question)
+            # 改行をスペースに置換して整形
+            text = text.replace('\n', ' ').strip()
         if len(text) > 150:
             return text[:150] + "..."
         return text
@@ -2342,6 +2908,7 @@ class CorrectionRequestImage(db.Model):
     image_type = db.Column(db.String(20), nullable=False)  # 'request' (生徒提出) or 'reply' (添削返却)
     image_data = deferred(db.Column(db.LargeBinary, nullable=False))  # 画像バイナリ
     image_format = db.Column(db.String(10), nullable=False, default='PNG')  # PNG, JPEG など
+    image_hash = db.Column(db.String(32))  # 画像内容のMD5 (ETag・URLバージョン用)
     created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(JST))
     
     # リレーション
@@ -2421,6 +2988,19 @@ def cleanup_caches():
     # 1. Clear Global Dict Caches
     ROOM_SETTING_CACHE.clear()
     WORD_DATA_CACHE.clear()
+    RPG_BOSS_LADDER_CACHE.clear()
+    RPG_USER_STATE_CACHE.clear()
+    STREAK_CACHE.clear()
+    ESSAY_VISIBILITY_CACHE.clear()
+    ESSAY_CHAPTER_STATS_CACHE.clear()
+    ESSAY_SEARCH_INDEX.clear()
+    ANSWER_KEYWORD_MATCHER_CACHE.clear()
+    ESSAY_GRADING_CACHE.clear()
+    IMAGE_VARIANT_SRCSET_CACHE.clear()
+    with EMBEDDING_CACHE_LOCK:
+        EMBEDDING_CACHE.clear()
+    with RPG_BATTLE_STORE_LOCK:
+        RPG_BATTLE_STORE.clear()  # 戦闘の本体は RpgBattle にあり、必要になればDBから読み直す
     
     # 2. Clear Textbook Manager Memory
     try:
@@ -2499,7 +3079,11 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 3600 * 24 * 7
 
 database_url = os.environ.get('DATABASE_URL')
 
-if database_url:
+if database_url and database_url.startswith('sqlite:'):
+    # テストなどで別ファイルのSQLiteを使う場合（PostgreSQL用の接続オプションは付けない）
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    is_postgres = False
+elif database_url:
     logger.info("🐘 PostgreSQL設定を適用中...")
     
     # PostgreSQL用のURLフォーマットへの対応
@@ -2531,6 +3115,7 @@ class EssayImage(db.Model):
     problem_id = db.Column(db.Integer, db.ForeignKey('essay_problems.id'), nullable=False, unique=True)
     image_data = deferred(db.Column(db.LargeBinary, nullable=False))  # 画像のバイナリデータ
     image_format = db.Column(db.String(10), nullable=False, default='PNG')  # PNG, JPEG など
+    image_hash = db.Column(db.String(32))  # 画像内容のMD5 (ETag・URLバージョン用)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     
     # リレーション
@@ -2539,6 +3124,54 @@ class EssayImage(db.Model):
     def __repr__(self):
         return f'<EssayImage {self.problem_id}>'
 
+class ImageVariant(db.Model):
+    """画像の派生版（縮小・WebP）。元画像の内容ハッシュごとに保存し、元画像が差し替えられたら作り直す"""
+    __tablename__ = 'image_variants'
+
+    id = db.Column(db.Integer, primary_key=True)
+    source_type = db.Column(db.String(20), nullable=False)  # 'rpg_icon', 'rpg_badge', 'rpg_defeated', 'essay', 'map'
+    source_id = db.Column(db.Integer, nullable=False)  # 敵ID / 論述問題ID / 地図ID
+    source_hash = db.Column(db.String(32), nullable=False)  # 元画像のMD5
+    width = db.Column(db.Integer, nullable=False)  # 0 = 元のサイズのまま
+    pixel_width = db.Column(db.Integer, nullable=False)  # 実際の幅（元画像が width 以下なら元の幅。srcset の w に使う）
+    image_format = db.Column(db.String(10), nullable=False)
+    image_data = deferred(db.Column(db.LargeBinary, nullable=False))
+    byte_size = db.Column(db.Integer, nullable=False)
+    source_size = db.Column(db.Integer, nullable=False)  # 元画像のバイト数（削減量の集計用）
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(JST))
+
+    __table_args__ = (
+        db.UniqueConstraint('source_type', 'source_id', 'source_hash', 'width', name='uq_image_variant'),
+    )
+
+class AiGradingJob(db.Model):
+    """AI採点・OCRの待ち行列（ワーカースレッドが古い順に処理する）"""
+    __tablename__ = 'ai_grading_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_token = db.Column(db.String(32), unique=True, nullable=False, default=lambda: uuid.uuid4().hex)  # クライアントに渡す推測されにくいID
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True, index=True)
+    job_type = db.Column(db.String(10), nullable=False)  # 'grade' (添削) / 'ocr' (画像読み取り) / 'search' (AI検索) / 'news' (ニュース更新)
+    status = db.Column(db.String(10), nullable=False, default='queued', index=True)  # queued / running / done / error
+    payload = db.Column(db.Text, nullable=True)  # 添削の入力 (JSON)
+    input_data = deferred(db.Column(db.LargeBinary, nullable=True))  # OCRの画像（処理後に削除）
+    result = db.Column(db.Text, nullable=True)  # APIレスポンス本体 (JSON)
+    result_status = db.Column(db.Integer, nullable=True)  # APIレスポンスのHTTPステータス
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(JST))
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class EmbeddingCache(db.Model):
+    """埋め込みAPIの結果（同じ文章を何度もAPIに送らない。get_text_embedding参照）"""
+    __tablename__ = 'embedding_cache'
+    __table_args__ = (db.UniqueConstraint('model', 'text_hash', name='uq_embedding_cache_model_text'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(100), nullable=False)
+    text_hash = db.Column(db.String(64), nullable=False)  # 正規化した文章のsha256
+    vector = db.Column(db.LargeBinary, nullable=False)  # float32の配列 (array('f').tobytes())
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(JST))
+
 class Announcement(db.Model):
     __tablename__ = 'announcements'
     id = db.Column(db.Integer, primary_key=True)
@@ -4278,77 +4911,327 @@ def create_tables_and_admin_user():
         logger.error(f"❌ データベース初期化エラー: {e}")
         raise
 
+IMAGE_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+IMAGE_FORMAT_MIMETYPES = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+    'JPG': 'image/jpeg',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp'
+}
+
+def make_cached_image_response(etag, mimetype, load_content, immutable=False):
+    """
+    ETag付きの画像レスポンスを返す。If-None-Matchが一致すれば画像本体を読み込まずに304を返す。
+    load_content: 画像バイナリを返す関数（304の場合は呼ばれない）
+    immutable: URLに内容ハッシュが含まれる場合はTrue（長期キャッシュ）
+    """
+    cache_control = IMAGE_IMMUTABLE_CACHE_CONTROL if immutable else 'no-cache'
+
+    if etag and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        content = load_content()
+        if not content:
+            return None
+        if not etag:
+            etag = hashlib.md5(content).hexdigest()
+        response = make_response(content)
+
+    # 304でもContent-Typeを付与（HTML用のno-storeヘッダーで上書きされないように）
+    response.headers.set('Content-Type', mimetype or 'image/png')
+    response.headers.set('ETag', f'"{etag}"')
+    response.headers.set('Cache-Control', cache_control)
+    return response
+
 @app.route('/api/rpg/image/<int:enemy_id>/<string:image_type>')
-def serve_rpg_image(enemy_id, image_type):
+@app.route('/api/rpg/image/<int:enemy_id>/<string:image_type>/<string:version>')
+def serve_rpg_image(enemy_id, image_type, version=None):
     """
-    RPG敵キャラの画像（アイコン/バッジ）をDBから配信する
-    image_type: 'icon' or 'badge'
+    RPG敵キャラの画像（アイコン/バッジ/討伐後）をDBから配信する
+    image_type: 'icon', 'badge' or 'defeated'
+    version: 画像内容のハッシュ（一致すれば immutable として長期キャッシュ）
     """
+    if image_type not in ('icon', 'badge', 'defeated'):
+        return "", 400
+
     try:
-        enemy = RpgEnemy.query.get(enemy_id)
-        if not enemy:
-            # print(f"DEBUG: RPG Image - Enemy {enemy_id} not found")
+        # 画像バイナリは読み込まず、メタデータのみ取得
+        filename_col = getattr(RpgEnemy, f'{image_type}_image')
+        mimetype_col = getattr(RpgEnemy, f'{image_type}_image_mimetype')
+        hash_col = getattr(RpgEnemy, f'{image_type}_image_hash')
+        content_col = getattr(RpgEnemy, f'{image_type}_image_content')
+
+        row = db.session.query(filename_col, mimetype_col, hash_col).filter(RpgEnemy.id == enemy_id).first()
+        if not row:
             return "", 404
-            
-        content = None
-        mimetype = None
-        filename = None
-        
-        if image_type == 'icon':
-            content = enemy.icon_image_content
-            mimetype = enemy.icon_image_mimetype
-            filename = enemy.icon_image
-        elif image_type == 'badge':
-            content = enemy.badge_image_content
-            mimetype = enemy.badge_image_mimetype
-            filename = enemy.badge_image
-        elif image_type == 'defeated':
-            content = enemy.defeated_image_content
-            mimetype = enemy.defeated_image_mimetype
-            filename = enemy.defeated_image
-        else:
-            return "", 400
+        filename, mimetype, image_hash = row
 
-        # print(f"DEBUG: RPG Image Request - ID: {enemy_id}, Type: {image_type}")
-        # print(f"DEBUG: Content Size: {len(content) if content else 'None'}")
-        # print(f"DEBUG: MimeType: {mimetype}")
-        # print(f"DEBUG: Filename: {filename}")
-            
         # 1. DBにバイナリがあればそれを返す
-        if content:
-            response = make_response(content)
-            response.headers.set('Content-Type', mimetype or 'image/png')
-            # キャッシュ制御: 常に最新版をチェック（管理画面での更新を即座に反映）
-            # no-cache: キャッシュするが、使用前に必ずサーバーに問い合わせる
-            # must-revalidate: キャッシュが古い場合は必ず再検証
-            response.headers.set('Cache-Control', 'no-cache, must-revalidate')
-            # ETagを設定して効率的な再検証を可能にする
-            etag = hashlib.md5(content).hexdigest()
-            response.headers.set('ETag', f'"{etag}"')
+        def load_content():
+            return db.session.query(content_col).filter(RpgEnemy.id == enemy_id).scalar()
+
+        response = make_cached_image_response(
+            image_hash, mimetype, load_content,
+            immutable=bool(version and image_hash and version == image_hash)
+        )
+        if response is not None:
             return response
-            
+
         # 2. DBになければ、従来のファイルパス/URLを確認
         # filenameがURL(http...)ならリダイレクト
         if filename and (filename.startswith('http://') or filename.startswith('https://')):
-            # print("DEBUG: Redirecting to External URL")
             return redirect(filename)
-            
+
         # 3. ローカルファイルの場合 (static/images/rpg/)
         if filename:
             # セキュリティのためファイル名のみ抽出
             secure_name = secure_filename(os.path.basename(filename))
-            # print(f"DEBUG: Redirecting to Local Static: {secure_name}")
             return redirect(url_for('static', filename=f'images/rpg/{secure_name}'))
-            
-        # print("DEBUG: No content or filename found.")
+
         return "", 404
-        
+
     except Exception as e:
         print(f"Error serving RPG image: {e}")
         import traceback
         traceback.print_exc()
         return "", 500
 
+# =========================================================
+# 画像の派生版（縮小・WebP）
+# アップロード時（または初回リクエスト時）に作ってDBに保存し、テンプレートでは srcset で選ばせる。
+# 既存画像は scripts/backfill_image_variants.py でまとめて作る。
+# =========================================================
+IMAGE_VARIANT_WIDTHS = {  # 種類ごとの幅(px)。0 は縮小せず形式だけ変換する（地図はズームするので解像度を保つ）
+    'rpg_icon': (160, 320),
+    'rpg_badge': (160, 320),
+    'rpg_defeated': (160, 320),
+    'essay': (480, 960, 1600),
+    'map': (0,),
+}
+IMAGE_VARIANT_LOSSLESS = ('map',)  # 地名の文字がにじまないよう可逆圧縮（元がJPEGの場合を除く）
+IMAGE_VARIANT_WEBP_QUALITY = 80
+IMAGE_VARIANT_SLOTS = threading.BoundedSemaphore(1)  # 変換の同時実行数（リクエスト処理のCPUを奪わない）
+
+def _image_variant_source(source_type):
+    """派生版の元画像の (キー列, 画像列, ハッシュ列)"""
+    if source_type.startswith('rpg_'):
+        image_type = source_type[len('rpg_'):]
+        return (RpgEnemy.id, getattr(RpgEnemy, f'{image_type}_image_content'),
+                getattr(RpgEnemy, f'{image_type}_image_hash'))
+    if source_type == 'essay':
+        return EssayImage.problem_id, EssayImage.image_data, EssayImage.image_hash
+    return MapImage.id, MapImage.image_data, MapImage.image_hash
+
+def image_variant_format():
+    """派生版の保存形式（PillowがWebP非対応ならPNG）"""
+    from PIL import features
+    return 'WEBP' if features.check('webp') else 'PNG'
+
+def image_variant_url(source_type, source_id, image_hash, width):
+    """派生版のURL（元画像のハッシュ付きなので immutable で配信される）"""
+    return url_for('serve_image_variant', source_type=source_type, source_id=source_id, width=width, version=image_hash)
+
+@app.template_global()
+def image_variant_srcset(source_type, source_id, image_hash):
+    """
+    img の srcset 属性の値。元画像より狭い幅の派生版と、元のサイズの画像（実際の幅）を並べる。
+    ハッシュがない（DBに画像がない）場合や派生版がまだない場合は空文字（src の画像がそのまま使われる）
+    """
+    if not image_hash:
+        return ''
+    cache_key = (source_type, source_id, image_hash)
+    cached = IMAGE_VARIANT_SRCSET_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    widths = IMAGE_VARIANT_WIDTHS[source_type]
+    rows = db.session.query(ImageVariant.width, ImageVariant.pixel_width).filter(
+        ImageVariant.source_type == source_type, ImageVariant.source_id == source_id,
+        ImageVariant.source_hash == image_hash, ImageVariant.width.in_(widths)
+    ).order_by(ImageVariant.width).all()
+
+    candidates = {}  # {実際の幅: 派生版の幅}
+    for width, pixel_width in rows:
+        # 元画像が width 以下なら以降の派生版はすべて元のサイズ。最も小さいものだけを元の幅で載せる
+        candidates.setdefault(pixel_width, width)
+    srcset = ', '.join(
+        f'{image_variant_url(source_type, source_id, image_hash, width)} {pixel_width}w'
+        for pixel_width, width in candidates.items()
+    )
+    if len(rows) == len(widths):  # 作成途中の結果は覚えない
+        if len(IMAGE_VARIANT_SRCSET_CACHE) >= MAX_IMAGE_VARIANT_SRCSET_CACHE_SIZE:
+            IMAGE_VARIANT_SRCSET_CACHE.pop(next(iter(IMAGE_VARIANT_SRCSET_CACHE)))
+        IMAGE_VARIANT_SRCSET_CACHE[cache_key] = srcset
+    return srcset
+
+def build_image_variant(image_bytes, width, lossless=False):
+    """
+    画像を幅widthに縮小してWebPに変換する（widthが0または元画像より大きければ縮小しない）。
+    戻り値は (bytes, 形式, 実際の幅)。縮小せず変換しても小さくならない場合は元画像をそのまま返す。
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        source_format = source.format
+        if width and source_format == 'JPEG':
+            source.draft('RGB', (width, width))  # DCTの段階で縮小して展開する
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ('RGB', 'RGBA'):
+            has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    resized = bool(width and image.width > width)
+    if resized:
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    image_format = image_variant_format()
+    if image_format == 'WEBP':
+        image.save(output, format='WEBP', quality=IMAGE_VARIANT_WEBP_QUALITY,
+                   lossless=lossless and source_format != 'JPEG', method=4)
+    else:
+        image.save(output, format='PNG', optimize=True)
+    pixel_width = image.width
+    image.close()
+
+    data = output.getvalue()
+    if not resized and len(data) >= len(image_bytes) and source_format in IMAGE_FORMAT_MIMETYPES:
+        return image_bytes, source_format, pixel_width
+    return data, image_format, pixel_width
+
+def get_image_variant(source_type, source_id, width):
+    """
+    派生版を (bytes, 形式) で返す。まだなければ元画像から作ってDBに保存する。
+    元画像がない場合は None。
+    """
+    key_col, content_col, hash_col = _image_variant_source(source_type)
+    source_hash = db.session.query(hash_col).filter(key_col == source_id).scalar()
+    if not source_hash:
+        return None
+
+    def load_existing():
+        return db.session.query(ImageVariant.image_data, ImageVariant.image_format).filter_by(
+            source_type=source_type, source_id=source_id, source_hash=source_hash, width=width
+        ).first()
+
+    existing = load_existing()
+    if existing:
+        return bytes(existing.image_data), existing.image_format
+
+    with IMAGE_VARIANT_SLOTS:
+        existing = load_existing()  # 待っている間に別のリクエストが作った場合
+        if existing:
+            return bytes(existing.image_data), existing.image_format
+
+        content = db.session.query(content_col).filter(key_col == source_id).scalar()
+        if not content:
+            return None
+        content = bytes(content)
+        data, image_format, pixel_width = build_image_variant(content, width, lossless=source_type in IMAGE_VARIANT_LOSSLESS)
+
+        # 差し替え前の画像の派生版は不要
+        ImageVariant.query.filter(
+            ImageVariant.source_type == source_type, ImageVariant.source_id == source_id,
+            ImageVariant.source_hash != source_hash
+        ).delete(synchronize_session=False)
+        db.session.add(ImageVariant(
+            source_type=source_type, source_id=source_id, source_hash=source_hash, width=width, pixel_width=pixel_width,
+            image_format=image_format, image_data=data, byte_size=len(data), source_size=len(content)
+        ))
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()  # 別のワーカーが先に保存した場合など。作った画像はそのまま返す
+            logger.warning(f"Image variant save skipped ({source_type}/{source_id}/{width}): {e}")
+        logger.info(f"Image variant created: {source_type}/{source_id} w={width} {len(content) // 1024}KB -> {len(data) // 1024}KB")
+    return data, image_format
+
+def generate_image_variants(source_type, source_id):
+    """元画像の派生版をすべて作る（アップロード直後に呼ぶ。失敗してもアップロード自体は成功させる）"""
+    created = 0
+    for width in IMAGE_VARIANT_WIDTHS[source_type]:
+        try:
+            if get_image_variant(source_type, source_id, width):
+                created += 1
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Image variant generation failed ({source_type}/{source_id}/{width}): {e}")
+    return created
+
+def delete_image_variants(source_type, source_id):
+    """元画像を削除するときに派生版も消す（コミットは呼び出し側で行う）"""
+    ImageVariant.query.filter_by(source_type=source_type, source_id=source_id).delete(synchronize_session=False)
+    for key in [k for k in IMAGE_VARIANT_SRCSET_CACHE if k[:2] == (source_type, source_id)]:
+        IMAGE_VARIANT_SRCSET_CACHE.pop(key, None)
+
+def backfill_image_variants(source_types=None):
+    """
+    既存画像の派生版をまとめて作る（scripts/backfill_image_variants.py から実行）。
+    種類ごとの処理した元画像の件数を返す。
+    """
+    counts = {}
+    for source_type in (source_types or IMAGE_VARIANT_WIDTHS):
+        key_col, _, hash_col = _image_variant_source(source_type)
+        source_ids = [row[0] for row in db.session.query(key_col).filter(hash_col.isnot(None)).order_by(key_col).all()]
+        for source_id in source_ids:
+            generate_image_variants(source_type, source_id)
+            db.session.expunge_all()  # メモリ節約
+        counts[source_type] = len(source_ids)
+    return counts
+
+def image_variant_report():
+    """種類・幅ごとの派生版の件数と、元画像の代わりに配信した場合に1回あたり削減できるバイト数"""
+    rows = db.session.query(
+        ImageVariant.source_type, ImageVariant.width, func.count(ImageVariant.id),
+        func.sum(ImageVariant.source_size), func.sum(ImageVariant.byte_size)
+    ).group_by(ImageVariant.source_type, ImageVariant.width).order_by(ImageVariant.source_type, ImageVariant.width).all()
+    return [{
+        'source_type': source_type,
+        'width': width,
+        'variants': count,
+        'source_bytes': int(source_bytes or 0),
+        'variant_bytes': int(variant_bytes or 0),
+        'saved_bytes': int((source_bytes or 0) - (variant_bytes or 0))
+    } for source_type, width, count, source_bytes, variant_bytes in rows]
+
+@app.route('/image_variant/<string:source_type>/<int:source_id>/<int:width>/<string:version>')
+def serve_image_variant(source_type, source_id, width, version):
+    """
+    画像の派生版を配信する（初回リクエストで作ってDBに保存する）
+    version: 元画像の内容ハッシュ。画像が差し替えられていれば現在の版へリダイレクトする
+    """
+    if width not in IMAGE_VARIANT_WIDTHS.get(source_type, ()):
+        return "", 404
+
+    key_col, _, hash_col = _image_variant_source(source_type)
+    source_hash = db.session.query(hash_col).filter(key_col == source_id).scalar()
+    if not source_hash:
+        return "", 404
+    if version != source_hash:
+        return redirect(image_variant_url(source_type, source_id, source_hash, width))
+
+    etag = f'{source_hash}-{width}'
+    content = None
+    if request.if_none_match.contains(etag):
+        # 304は本体を読まない（Content-Typeは保存済みの派生版の形式）
+        image_format = db.session.query(ImageVariant.image_format).filter_by(
+            source_type=source_type, source_id=source_id, source_hash=source_hash, width=width
+        ).scalar() or image_variant_format()
+    else:
+        # 変換しても小さくならなければ元画像の形式のまま返るので、形式は作った結果から決める
+        variant = get_image_variant(source_type, source_id, width)
+        if not variant:
+            return "", 404
+        content, image_format = variant
+
+    response = make_cached_image_response(
+        etag, IMAGE_FORMAT_MIMETYPES.get(image_format, 'image/png'), lambda: content, immutable=True
+    )
+    if response is None:
+        return "", 404
+    return response
+
 def create_essay_visibility_table_auto():
     """essay_visibility_settingテーブルを自動作成"""
     try:
@@ -4472,6 +5355,7 @@ def create_default_visibility_settings():
                             created_count += 1
             
             conn.commit()
+            invalidate_essay_visibility_cache()
             print(f"✅ デフォルト公開設定を{created_count}件作成しました")
             
     except Exception as e:
@@ -5319,36 +6203,119 @@ def admin_cleanup_orphaned_tokens():
         db.session.rollback()
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-def extract_keywords_from_text(text):
+def build_keyword_automaton(keywords):
     """
-    文章から一問一答のキーワード候補を抜き出す（ライブラリ不要版）
+    キーワード群からAho–Corasickオートマトンを構築する。
+    ノードごとの遷移(goto)・失敗リンク(fail)・深さ(depth)・終端フラグ(terminal)と、
+    自身より短い終端ノードへの出力リンク(out_link)をノード番号で引けるリストとして持つ。
     """
-    # データベースから全ての一問一答の「答え」を取得
-    # 注意: 問題数が増えるとパフォーマンスに影響する可能性があります
-    try:
-        # CsvFileContentからすべてのCSVコンテンツを取得
-        all_csv_content = db.session.query(CsvFileContent.content).all()
-        
-        all_answers = set()
-        for (content,) in all_csv_content:
+    goto = [{}]
+    depth = [0]
+    terminal = [False]
+    for keyword in keywords:
+        node = 0
+        for char in keyword:
+            next_node = goto[node].get(char)
+            if next_node is None:
+                next_node = len(goto)
+                goto[node][char] = next_node
+                goto.append({})
+                depth.append(depth[node] + 1)
+                terminal.append(False)
+            node = next_node
+        terminal[node] = True
+
+    # 幅優先で失敗リンクと出力リンクを張る（1文字目のノードの失敗先は根のまま）
+    fail = [0] * len(goto)
+    out_link = [0] * len(goto)
+    queue = list(goto[0].values())
+    head = 0
+    while head < len(queue):
+        node = queue[head]
+        head += 1
+        for char, child in goto[node].items():
+            queue.append(child)
+            state = fail[node]
+            while state and char not in goto[state]:
+                state = fail[state]
+            fail[child] = goto[state].get(char, 0)
+            out_link[child] = fail[child] if terminal[fail[child]] else out_link[fail[child]]
+
+    return {'goto': goto, 'fail': fail, 'depth': depth, 'terminal': terminal, 'out_link': out_link}
+
+def find_keywords_in_text(matcher, text):
+    """
+    オートマトンでテキストを1回走査し、含まれるキーワードを初出位置の辞書 {keyword: position} で返す。
+    """
+    goto = matcher['goto']
+    fail = matcher['fail']
+    depth = matcher['depth']
+    terminal = matcher['terminal']
+    out_link = matcher['out_link']
+
+    found = {}
+    node = 0
+    for i, char in enumerate(text):
+        while node and char not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(char, 0)
+        match = node if terminal[node] else out_link[node]
+        while match:
+            start = i - depth[match] + 1
+            keyword = text[start:i + 1]
+            if keyword not in found:
+                found[keyword] = start
+            match = out_link[match]
+    return found
+
+def get_answer_keyword_matcher():
+    """
+    全CSVの答え語（2文字以上）のオートマトンと {答え: 最初に見つかった単語データ} を返す（キャッシュ対応）。
+    CSVの内容は読まずに (id, ファイル名, アップロード日時, サイズ) だけでバージョンを確認し、
+    CSVがアップロード・削除された時だけ再構築する。
+    """
+    version = tuple(
+        tuple(row) for row in db.session.query(
+            CsvFileContent.id,
+            CsvFileContent.filename,
+            CsvFileContent.upload_date,
+            CsvFileContent.file_size
+        ).order_by(CsvFileContent.id).all()
+    )
+
+    with ANSWER_KEYWORD_MATCHER_LOCK:
+        cached = ANSWER_KEYWORD_MATCHER_CACHE
+        if cached.get('version') == version:
+            return cached['matcher'], cached['word_by_answer']
+
+        word_by_answer = {}
+        for (content,) in db.session.query(CsvFileContent.content).order_by(CsvFileContent.id).all():
             reader = csv.DictReader(StringIO(content))
             for row in reader:
-                answer = row.get('answer', '').strip()
-                if len(answer) >= 2: # 2文字以上の答えのみをキーワード候補とする
-                    all_answers.add(answer)
+                answer = (row.get('answer') or '').strip()
+                if len(answer) >= 2 and answer not in word_by_answer: # 2文字以上の答えのみをキーワード候補とする
+                    word_by_answer[answer] = row
 
+        matcher = build_keyword_automaton(word_by_answer.keys())
+        ANSWER_KEYWORD_MATCHER_CACHE.clear()
+        ANSWER_KEYWORD_MATCHER_CACHE.update({'version': version, 'matcher': matcher, 'word_by_answer': word_by_answer})
+        return matcher, word_by_answer
+
+def extract_keywords_from_text(text):
+    """
+    文章から一問一答のキーワード候補を抜き出す（ライブラリ不要版）
+    全CSVの答え語から作ったAho–Corasickオートマトンで、テキストを1回走査するだけで照合する。
+    """
+    try:
+        matcher, _ = get_answer_keyword_matcher()
     except Exception as e:
         print(f"キーワード抽出のための単語データ取得エラー: {e}")
         return []
 
-    # テキストに含まれるキーワードを抽出
-    found_keywords = []
-    for answer in all_answers:
-        if answer in text:
-            found_keywords.append(answer)
+    found = find_keywords_in_text(matcher, text or '')
     
-    # 文字数が長いものから順に並べ替え、最大10件に絞る
-    found_keywords.sort(key=len, reverse=True)
+    # 文字数が長いものから順に並べ替え（同じ長さなら先に出てきた順）、最大10件に絞る
+    found_keywords = sorted(found, key=lambda keyword: (-len(keyword), found[keyword]))
     
     return found_keywords[:10]
 
@@ -5362,15 +6329,8 @@ def api_search_essays():
         if not query:
             return jsonify({'status': 'success', 'results': []})
             
-        # キーワードで検索（問題文または模範解答）
-        search_term = f"%{query}%"
-        essays = EssayProblem.query.filter(
-            db.or_(
-                EssayProblem.question.like(search_term),
-                EssayProblem.answer.like(search_term),
-                EssayProblem.university.like(search_term)
-            )
-        ).limit(50).all()
+        # キーワードで検索（問題文・模範解答・大学名）。全文検索インデックスで関連度順に並べる
+        essays = search_essays_ranked(query, limit=50)
         
         results = []
         for essay in essays:
@@ -5408,6 +6368,7 @@ def api_search_essays_ai():
              return jsonify({'status': 'success', 'results': []})
 
         # チケット消費チェック
+        user = None
         if 'user_id' in session and session['user_id']:
             user = User.query.get(session['user_id'])
             if user and not consume_ai_ticket(user):
@@ -5417,16 +6378,8 @@ def api_search_essays_ai():
                 }), 403
 
         # 1. DBフィルタリング
-        # メモリ最適化: 必要なカラムのみ取得し、軽量なタプルとして扱う
-        query = db.session.query(
-            EssayProblem.id, 
-            EssayProblem.university, 
-            EssayProblem.year, 
-            EssayProblem.question, 
-            EssayProblem.answer, 
-            EssayProblem.chapter, 
-            EssayProblem.type
-        ).filter(EssayProblem.enabled == True)
+        # メモリ最適化: 絞り込みではIDのみ取得し、本文は最終候補の分だけ読む
+        query = db.session.query(EssayProblem.id).filter(EssayProblem.enabled == True)
         
         # 年度フィルタ
         if year_start:
@@ -5458,44 +6411,62 @@ def api_search_essays_ai():
             if university_filters:
                 query = query.filter(db.or_(*university_filters))
         
-        # 候補を取得（広めに取得してPython側でスコアリング）
-        # タプルのリストとして返される [(id, uni, year, q, a, chap, type), ...]
-        raw_candidates = query.limit(200).all()
+        # 条件に合う全問題のIDを取得（件数で打ち切らない）
+        filtered_ids = {row.id for row in query.all()}
         
-        if not raw_candidates:
+        if not filtered_ids:
              return jsonify({'status': 'success', 'results': [], 'message': '条件に一致する問題が見つかりませんでした。'})
 
-        # キーワードの分割（全角・半角スペース対応）
-        keyword_list = re.split(r'[\s　]+', keywords)
-        keyword_list = [k for k in keyword_list if k] # 空文字除去
+        # 全文検索インデックスのBM25で絞り込み結果全体を採点し、上位15件をAIに渡す
+        ranked = rank_essays_bm25(keywords, candidate_ids=filtered_ids, limit=15)
+        if ranked is None:
+            # インデックスが使えない場合は新しい問題から候補にする
+            top_ids = sorted(filtered_ids, reverse=True)[:15]
+        else:
+            top_ids = [problem_id for problem_id, _ in ranked]
+            if len(top_ids) < 15:
+                # キーワードに一致しない問題で残り枠を埋める（従来どおり常に候補を渡す）
+                ranked_set = set(top_ids)
+                top_ids += sorted(filtered_ids - ranked_set, reverse=True)[:15 - len(top_ids)]
+        del filtered_ids
+
+        # 2. AI選定 (Gemini API) はワーカースレッドで行い、ここではジョブを積んですぐに返す
+        # （APIの応答待ちでリクエスト処理スレッドを塞がない。結果は /api/essay/jobs/<job_id> で取得）
+        if not AI_GATEWAY.available():
+             return jsonify({'status': 'error', 'message': 'AI機能が利用できません'}), 503
 
-        # Python側でスコアリング（キーワード一致数）
-        scored_candidates = []
-        for c in raw_candidates:
-            # c is tuple: 0:id, 1:uni, 2:year, 3:q, 4:a, 5:chap, 6:type
-            # 全テキストを結合して検索
-            full_text = f"{c.university} {c.question} {c.answer}"
-            match_count = 0
-            for k in keyword_list:
-                if k in full_text:
-                    match_count += 1
-            scored_candidates.append({'candidate': c, 'score': match_count})
-        
-        # スコア順にソート（降順）
-        scored_candidates.sort(key=lambda x: x['score'], reverse=True)
-        
-        # 上位15件を取得
-        top_candidates = [item['candidate'] for item in scored_candidates[:15]]
-        
-        # 不要なリストを削除してメモリ解放
-        del raw_candidates
-        del scored_candidates
+        job = enqueue_ai_grading_job('search', session.get('user_id'), payload={
+            'keywords': keywords,
+            'candidate_ids': top_ids,
+            'ticket_consumed': user is not None  # 完了前に中断したら戻す
+        })
+        return jsonify(ai_grading_job_response(job)), 202
+
+    except Exception as e:
+        error_msg = str(e)
+        app.logger.error(f"AI Essay search error: {error_msg}")
+        return jsonify({'status': 'error', 'message': error_msg}), 500
+
+def run_essay_ai_search(keywords, candidate_ids):
+    """
+    BM25で絞り込んだ候補からAIがおすすめの問題を選ぶ（ワーカースレッドから呼ばれる）。
+    戻り値は (レスポンス本体のdict, HTTPステータス)。
+    """
+    try:
+        rows_by_id = {
+            row.id: row for row in db.session.query(
+                EssayProblem.id,
+                EssayProblem.university,
+                EssayProblem.year,
+                EssayProblem.question,
+                EssayProblem.answer,
+                EssayProblem.chapter,
+                EssayProblem.type
+            ).filter(EssayProblem.id.in_(candidate_ids)).all()
+        }
+        top_candidates = [rows_by_id[problem_id] for problem_id in candidate_ids if problem_id in rows_by_id]
         
         # 2. AI選定 (Gemini API)
-        client = get_genai_client()
-        if not client:
-             return jsonify({'status': 'error', 'message': 'AI機能が利用できません'}), 503
-
         # 候補リストの作成（JSON化）
         candidate_list_for_ai = []
         for c in top_candidates:
@@ -5526,25 +6497,8 @@ JSON形式のリスト（配列）のみを出力してください。配列の
 余計な解説やマークダウン記法(```jsonなど)は一切不要です。
 """
         
-        # === AI検索: モデルフォールバックロジック ===
-        current_model = 'gemini-3.5-flash'
-        response = None
-        
-        try:
-             response = client.models.generate_content(
-                model=current_model,
-                contents=prompt
-            )
-        except Exception as e:
-            if '429' in str(e) or 'RESOURCE_EXHAUSTED' in str(e):
-                print(f"⚠️ AI Search Rate Limit ({current_model}). Switching to fallback...")
-                current_model = 'gemini-3.1-flash-lite'
-                response = client.models.generate_content(
-                    model=current_model,
-                    contents=prompt
-                )
-            else:
-                raise e
+        # === AI検索: 混雑・障害時は AI_GATEWAY が軽量モデルにフォールバックする ===
+        response = AI_GATEWAY.generate(AI_PRIMARY_MODEL, prompt, fallback_models=(AI_FALLBACK_MODEL,), purpose='essay_search')
         ai_output = response.text.strip()
         
         # JSON解析
@@ -5581,22 +6535,22 @@ JSON形式のリスト（配列）のみを出力してください。配列の
                     'is_recommended': True
                 })
         
-        return jsonify({'status': 'success', 'results': results})
+        return {'status': 'success', 'results': results}, 200
 
     except Exception as e:
         error_msg = str(e)
-        app.logger.error(f"AI Essay search error: {error_msg}")
+        print(f"AI Essay search error: {error_msg}")
         
         # レート制限エラーハンドリング
-        if '429' in error_msg or 'RESOURCE_EXHAUSTED' in error_msg:
-             return jsonify({
+        if is_ai_rate_limit_error(e):
+             return {
                 'status': 'error', 
                 'error_type': 'rate_limit',
                 'message': 'AI機能が混雑しています（利用制限）。数分待ってから再度お試しください。',
                 'retry_after': 300
-            }), 429
+            }, 429
             
-        return jsonify({'status': 'error', 'message': error_msg}), 500
+        return {'status': 'error', 'message': error_msg}, 500
 
 @app.route('/api/essay/get_keywords/<int:problem_id>')
 def get_essay_keywords(problem_id):
@@ -5617,20 +6571,12 @@ def get_essay_keywords(problem_id):
     # 抽出したキーワードに対応する一問一答の問題を取得
     quiz_data = []
     if keywords:
-        # CsvFileContentからすべてのCSVコンテンツを取得
-        all_csv_content = db.session.query(CsvFileContent.content).all()
-        all_words = []
-        for (content,) in all_csv_content:
-            reader = csv.DictReader(StringIO(content))
-            all_words.extend(list(reader))
-
+        # オートマトンと一緒にキャッシュした {答え: 単語データ} から引く（キーワード1つにつき1問）
+        _, word_by_answer = get_answer_keyword_matcher()
         for keyword in keywords:
-            # 答えがキーワードと一致する問題を探す
-            for word in all_words:
-                if word.get('answer', '').strip() == keyword:
-                    quiz_data.append(word)
-                    # 同じキーワードで複数の問題が見つからないように一度見つけたらループを抜ける
-                    break 
+            word = word_by_answer.get(keyword)
+            if word:
+                quiz_data.append(word)
     
     return jsonify({
         'status': 'success',
@@ -8192,11 +9138,22 @@ def admin_update_news():
     if not session.get('admin_logged_in') and not session.get('manager_logged_in'):
         return jsonify({'status': 'error', 'message': '権限がありません'}), 403
 
+    # RSS取得とAI処理に1分程度かかるため、別スレッドで実行する（結果は /api/essay/jobs/<job_id> で取得）
+    # 採点ワーカー（既定1本）を1分間塞がないよう、待ち行列には並べない
+    job = enqueue_ai_grading_job('news', user_id)
+    start_ai_thread_job(job)
+    return jsonify(ai_grading_job_response(job)), 202
+
+def run_news_update():
+    """
+    ニュースを更新する（管理画面からの手動更新。ワーカースレッドから呼ばれる）。
+    戻り値は (レスポンス本体のdict, HTTPステータス)。
+    """
     try:
         success, message = update_world_news()
 
         if not success:
-            return jsonify({'status': 'error', 'message': message})
+            return {'status': 'error', 'message': message}, 200
 
         # 更新後の最終更新日時をDBから取得
         updated_at = None
@@ -8209,11 +9166,11 @@ def admin_update_news():
                     updated_at = dt.strftime('%Y年%m月%d日 %H:%M')
             except Exception:
                 pass
-        return jsonify({'status': 'success', 'message': message, 'updated_at': updated_at})
+        return {'status': 'success', 'message': message, 'updated_at': updated_at}, 200
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({'status': 'error', 'message': f'ニュース更新エラー: {e}'}), 500
+        return {'status': 'error', 'message': f'ニュース更新エラー: {e}'}, 500
 
 @app.route('/announcements')
 def announcements_page():
@@ -11614,6 +12571,7 @@ def initialize_essay_visibility(room_number):
                     created_count += 1
         
         db.session.commit()
+        invalidate_essay_visibility_cache(room_number)
         print(f"✅ 部屋 {room_number} の公開設定を初期化しました（{created_count}件作成）")
         return True
         
@@ -11931,6 +12889,7 @@ def admin_delete_user(user_id):
         # ★ユーザー本体を削除
         db.session.delete(user_to_delete)
         db.session.commit()
+        invalidate_rpg_user_state(user_id)
         
         flash(f'✅ ユーザー "{username}" (部屋番号: {room_number}, 出席番号: {student_id}) を削除しました。', 'success')
         
@@ -11958,6 +12917,10 @@ def admin_bulk_delete_users():
 
     if not user_ids:
         return jsonify({'status': 'error', 'message': '削除するユーザーが選択されていません。'}), 400
+    try:
+        user_ids = [int(uid) for uid in user_ids]
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'ユーザーIDが不正です。'}), 400
 
     try:
         # 関連するデータを先に削除
@@ -11976,10 +12939,14 @@ def admin_bulk_delete_users():
         MapQuizComplete.query.filter(MapQuizComplete.user_id.in_(user_ids)).delete(synchronize_session=False)
         RpgRematchHistory.query.filter(RpgRematchHistory.user_id.in_(user_ids)).delete(synchronize_session=False)
         RpgState.query.filter(RpgState.user_id.in_(user_ids)).delete(synchronize_session=False)
+        RpgBattle.query.filter(RpgBattle.user_id.in_(user_ids)).delete(synchronize_session=False)
 
         # ユーザーを削除
         num_deleted = User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
         db.session.commit()
+        # 削除したユーザーのRPG進行状況をキャッシュからも消す（IDの再利用で撃破済みが引き継がれないように）
+        for uid in user_ids:
+            invalidate_rpg_user_state(uid)
 
         return jsonify({'status': 'success', 'message': f'{num_deleted}人のユーザーを削除しました。'})
     except Exception as e:
@@ -14158,6 +15125,14 @@ def essay_index():
         
         # app.logger.info(f"📊 章並び順: {sorted_chapters}")
         
+        # 章別の問題数・進捗を1回の集計クエリで取得（公開設定考慮済み）
+        try:
+            chapter_progress_counts = get_essay_chapter_progress_counts(session.get('user_id'), current_room)
+        except Exception as e:
+            app.logger.error(f"章別統計取得エラー: {e}")
+            db.session.rollback()
+            chapter_progress_counts = {}
+        
         for chapter in sorted_chapters:
             types = visibility_settings[chapter]
             
@@ -14174,44 +15149,16 @@ def essay_index():
             else:
                 chapter_name = f"第{chapter}章"
             
-            # この章の問題を取得（公開設定に従って）
-            visible_problems = []
-            for problem_type in ['A', 'B', 'C', 'D']:
-                is_visible = types.get(problem_type, True)  # デフォルト公開
-                if is_visible:
-                    problems = EssayProblem.query.filter_by(
-                        chapter=chapter,
-                        type=problem_type,
-                        enabled=True
-                    ).all()
-                    visible_problems.extend(problems)
-
+            # この章の公開問題数と進捗
+            chapter_counts = chapter_progress_counts.get(chapter)
             
-            if not visible_problems:
+            if not chapter_counts or not chapter_counts['total']:
                 # app.logger.info(f"⏭️ {chapter_name}: 実際の問題なし（スキップ）")
                 continue
             
-            # ユーザーの進捗を取得
-            total_problems = len(visible_problems)
-            viewed_problems = 0
-            understood_problems = 0
-            
-            # 進捗計算（EssayProgressテーブルがある場合）
-            try:
-                for problem in visible_problems:
-                    progress = EssayProgress.query.filter_by(
-                        user_id=session.get('user_id'),
-                        problem_id=problem.id
-                    ).first()
-                    
-                    if progress:
-                        viewed_problems += 1
-                        if progress.understood:
-                            understood_problems += 1
-            except Exception:
-                # EssayProgressテーブルがない場合はスキップ
-                db.session.rollback()
-                pass
+            total_problems = chapter_counts['total']
+            viewed_problems = chapter_counts['touched']  # 進捗レコードがあれば閲覧済み扱い
+            understood_problems = chapter_counts['understood']
             
             # 進捗率を計算
             progress_rate = int((understood_problems / total_problems * 100)) if total_problems > 0 else 0
@@ -14268,10 +15215,7 @@ def essay_university_index():
     # 公開設定を取得
     visibility_settings = {}
     try:
-        settings = EssayVisibilitySetting.query.filter_by(room_number=current_room).all()
-        for setting in settings:
-            key = (setting.chapter, setting.problem_type)
-            visibility_settings[key] = setting.is_visible
+        visibility_settings = get_essay_visibility_matrix(current_room)
     except Exception as e:
         app.logger.error(f"公開設定取得エラー (essay_university): {e}")
         db.session.rollback()
@@ -14689,7 +15633,8 @@ def submit_correction_request():
                 request_id=req.id,
                 image_type='request',
                 image_data=image_data,
-                image_format=image_format
+                image_format=image_format,
+                image_hash=hashlib.md5(image_data).hexdigest()
             )
             db.session.add(img_record)
 
@@ -14881,10 +15826,8 @@ def get_adjacent_problems_with_visibility(problem, room_number):
         ).all()
         
         # 公開設定でフィルタリング
-        visible_problems = []
-        for p in ordered_problems:
-            if is_essay_problem_visible(room_number, p.chapter, p.type):
-                visible_problems.append(p)
+        visibility = get_essay_visibility_matrix(room_number)
+        visible_problems = [p for p in ordered_problems if visibility.get((p.chapter, p.type), True)]
         
         print(f"📋 公開問題数: {len(visible_problems)}件（全体: {len(ordered_problems)}件）")
         
@@ -14943,26 +15886,30 @@ def admin_essay_requests_list():
     return render_template('admin/essay_requests_list.html', **context)
 
 @app.route('/correction_image/<int:image_id>')
-def serve_correction_image(image_id):
-    """DBから添削画像を配信"""
-    from io import BytesIO
-    
-    img = CorrectionRequestImage.query.get_or_404(image_id)
-    
-    # MIMEタイプの決定
-    mime_types = {
-        'PNG': 'image/png',
-        'JPEG': 'image/jpeg',
-        'GIF': 'image/gif',
-        'WEBP': 'image/webp'
-    }
-    mime_type = mime_types.get(img.image_format, 'image/png')
-    
-    return Response(
-        img.image_data,
-        mimetype=mime_type,
-        headers={'Cache-Control': 'max-age=86400'}  # 24時間キャッシュ
+@app.route('/correction_image/<int:image_id>/<string:version>')
+def serve_correction_image(image_id, version=None):
+    """
+    DBから添削画像を配信
+    version: 画像内容のハッシュ（一致すれば immutable として長期キャッシュ）
+    """
+    # 画像バイナリは読み込まず、メタデータのみ取得
+    row = db.session.query(
+        CorrectionRequestImage.image_format, CorrectionRequestImage.image_hash
+    ).filter(CorrectionRequestImage.id == image_id).first()
+    if not row:
+        abort(404)
+    image_format, image_hash = row
+
+    def load_content():
+        return db.session.query(CorrectionRequestImage.image_data).filter(CorrectionRequestImage.id == image_id).scalar()
+
+    response = make_cached_image_response(
+        image_hash, IMAGE_FORMAT_MIMETYPES.get(image_format, 'image/png'), load_content,
+        immutable=bool(version and image_hash and version == image_hash)
     )
+    if response is None:
+        abort(404)
+    return response
 
 @app.route('/admin/essay_request/<int:request_id>')
 def admin_correction_request_detail(request_id):
@@ -15048,7 +15995,8 @@ def admin_reply_correction_request(request_id):
                 request_id=req.id,
                 image_type='reply',
                 image_data=reply_image_data,
-                image_format=reply_image_format
+                image_format=reply_image_format,
+                image_hash=hashlib.md5(reply_image_data).hexdigest()
             )
             db.session.add(img_record)
         
@@ -15241,16 +16189,342 @@ def admin_delete_correction_request(request_id):
 # ====================================================================
 # Gemini API連携機能 (論述問題添削 & OCR)
 # ====================================================================
-@app.route('/api/essay/ocr', methods=['POST'])
-def essay_ocr():
-    """アップロードされた画像から手書き文字を読み取り、HTML形式で返す"""
-    import PIL.Image
-    from google.genai import types  # 遅延インポート（メモリ節約）
-    if not GEMINI_API_KEY:
-        return jsonify({'status': 'error', 'message': 'Gemini API key not configured'}), 500
+# 添削・OCR（とAI検索・ニュース手動更新）は受付時にAiGradingJobとして積み、専用ワーカースレッドで処理する。
+# Gemini APIの応答待ちでgunicornのリクエスト処理スレッド（2本）を塞がないようにするため。
+# クライアントは /api/essay/jobs/<job_id> をポーリングして順番待ちの状況と結果を受け取る。
+
+def enqueue_ai_grading_job(job_type, user_id, payload=None, input_data=None):
+    """AI採点・OCRのジョブを待ち行列に積み、ワーカーを起こす"""
+    # 前回のプロセスの処理中ジョブの復旧を、このジョブを積む前に済ませる
+    ensure_ai_grading_workers()
+    job = AiGradingJob(
+        user_id=user_id,
+        job_type=job_type,
+        payload=json.dumps(payload, ensure_ascii=False) if payload is not None else None,
+        input_data=input_data
+    )
+    db.session.add(job)
+    db.session.commit()
+    touch_ai_job(job.job_token, get_ai_grading_queue_position(job))
+    AI_GRADING_WAKEUP.set()
+    return job
+
+def touch_ai_job(job_token, position=0):
+    """クライアントがまだ結果を待っていることを記録する（投入時・ポーリング時。position は前に並んでいる件数）"""
+    with AI_JOB_STREAMS_LOCK:
+        entry = AI_JOB_STREAMS.setdefault(job_token, {'partial': None, 'cancelled': False})
+        entry['last_seen'] = time.monotonic()
+        entry['position'] = position
+
+def is_ai_job_abandoned(job_token):
+    """キャンセルされたか、ポーリングが途絶えたジョブか（再起動などで記録がなければ続行する）"""
+    with AI_JOB_STREAMS_LOCK:
+        entry = AI_JOB_STREAMS.get(job_token)
+        if entry is None:
+            return False
+        timeout = AI_JOB_ABANDON_TIMEOUT + entry.get('position', 0) * AI_JOB_ABANDON_TIMEOUT_PER_JOB
+        return entry['cancelled'] or time.monotonic() - entry['last_seen'] > timeout
 
-    # Ensure AI features are enabled for the room
-    user_room = session.get('room') or 'default'
+def set_ai_job_partial(job_token, text_value):
+    """生成途中の講評を記録する（ポーリングの応答に含める）"""
+    with AI_JOB_STREAMS_LOCK:
+        entry = AI_JOB_STREAMS.get(job_token)
+        if entry is not None:
+            entry['partial'] = text_value
+
+def ai_job_cancelled_response():
+    """中断したジョブの結果（499: クライアントが要求を取り消した）"""
+    return {'status': 'error', 'error_type': 'cancelled', 'message': '処理を中断しました。'}, 499
+
+def essay_grading_cache_key(problem_id, user_answer, feedback_style):
+    """
+    採点結果キャッシュのキー（問題ID・正規化した答案のハッシュ・講評スタイル・プロンプト版・教科書検索の方式）。
+    答案は採点プロンプトに渡す形（<u>以外のタグを除去）から空白をすべて除いて比較する。
+    """
+    normalized = re.sub(r'<(?!/?u\b)[^>]+>', '', user_answer or '')
+    normalized = re.sub(r'\s+', '', html.unescape(normalized))
+    answer_hash = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    return f"{problem_id}:{feedback_style}:{ESSAY_GRADING_PROMPT_VERSION}:{TEXTBOOK_RETRIEVAL_MODE}:{answer_hash}"
+
+def get_cached_essay_grading(cache_key):
+    """キャッシュ済みの採点結果を返す（なければNone）"""
+    if not ESSAY_GRADING_CACHE_ENABLED:
+        return None
+    cached = ESSAY_GRADING_CACHE.get(cache_key)
+    if not cached:
+        return None
+    if time.time() - cached['timestamp'] >= ESSAY_GRADING_CACHE_TTL:
+        ESSAY_GRADING_CACHE.pop(cache_key, None)
+        return None
+    return cached['data']
+
+def store_essay_grading_cache(cache_key, problem_id, data):
+    """成功した採点結果をキャッシュする（上限を超えたら古いものから破棄）"""
+    if not ESSAY_GRADING_CACHE_ENABLED:
+        return
+    if len(ESSAY_GRADING_CACHE) >= MAX_ESSAY_GRADING_CACHE_SIZE and cache_key not in ESSAY_GRADING_CACHE:
+        first_key = next(iter(ESSAY_GRADING_CACHE))
+        ESSAY_GRADING_CACHE.pop(first_key)
+    ESSAY_GRADING_CACHE[cache_key] = {'problem_id': int(problem_id), 'data': data, 'timestamp': time.time()}
+
+def invalidate_essay_grading_cache(problem_id=None):
+    """問題文・解答例・問題画像を更新したら呼ぶ（problem_id省略時は全問題分を破棄）"""
+    if problem_id is None:
+        ESSAY_GRADING_CACHE.clear()
+        return
+    for key in [k for k, v in ESSAY_GRADING_CACHE.items() if v['problem_id'] == int(problem_id)]:
+        ESSAY_GRADING_CACHE.pop(key, None)
+
+def get_ai_grading_queue_position(job):
+    """このジョブより先に処理される（待機中・処理中の）ジョブ数"""
+    if job.job_type in AI_THREAD_JOB_TYPES:
+        return 0
+    is_priority = AiGradingJob.job_type.in_(AI_PRIORITY_JOB_TYPES)
+    if job.job_type in AI_PRIORITY_JOB_TYPES:
+        ahead = db.or_(AiGradingJob.status == 'running', db.and_(is_priority, AiGradingJob.id < job.id))
+    else:
+        ahead = db.or_(AiGradingJob.id < job.id, is_priority)  # 優先ジョブは後から積まれても先に処理される
+    return AiGradingJob.query.filter(
+        AiGradingJob.status.in_(['queued', 'running']),
+        AiGradingJob.id != job.id,
+        ~AiGradingJob.job_type.in_(AI_THREAD_JOB_TYPES),
+        ahead
+    ).count()
+
+def ai_grading_job_response(job):
+    """ジョブの状態をAPIレスポンス用のdictにする（完了時は処理結果そのもの）"""
+    if job.status in ('done', 'error'):
+        try:
+            return json.loads(job.result)
+        except (TypeError, ValueError):
+            return {'status': 'error', 'message': 'AIの処理結果を読み込めませんでした。'}
+
+    response = {
+        'status': job.status,  # 'queued' or 'running'
+        'job_id': job.job_token,
+        'position': get_ai_grading_queue_position(job) if job.status == 'queued' else 0,
+        'poll_url': url_for('get_ai_grading_job', job_token=job.job_token),
+        'cancel_url': url_for('cancel_ai_grading_job', job_token=job.job_token)
+    }
+    if job.status == 'running':
+        with AI_JOB_STREAMS_LOCK:
+            partial = (AI_JOB_STREAMS.get(job.job_token) or {}).get('partial')
+        if partial:
+            response['partial'] = partial  # 生成途中の講評（添削のみ）
+    return response
+
+def _claim_next_ai_grading_job():
+    """
+    処理中のジョブがないユーザーの待機ジョブから最も古いものを1件確保する（AI_PRIORITY_JOB_TYPES は先に処理する）。
+    同じユーザーのジョブは投入順に1件ずつ処理される。
+    """
+    busy_users = db.session.query(AiGradingJob.user_id).filter(
+        AiGradingJob.status == 'running',
+        AiGradingJob.user_id.isnot(None),
+        ~AiGradingJob.job_type.in_(AI_THREAD_JOB_TYPES)  # 別スレッドのニュース更新中でも添削は待たせない
+    )
+    candidates = db.session.query(AiGradingJob.id).filter(
+        AiGradingJob.status == 'queued',
+        ~AiGradingJob.job_type.in_(AI_THREAD_JOB_TYPES),
+        db.or_(AiGradingJob.user_id.is_(None), ~AiGradingJob.user_id.in_(busy_users))
+    ).order_by(
+        case((AiGradingJob.job_type.in_(AI_PRIORITY_JOB_TYPES), 0), else_=1),
+        AiGradingJob.id
+    ).limit(5).all()
+
+    for (job_id,) in candidates:
+        # 状態を条件にした更新で確保し、他のワーカーと取り合わないようにする
+        claimed = AiGradingJob.query.filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'started_at': datetime.now(JST)},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if claimed:
+            return db.session.get(AiGradingJob, job_id)
+    return None
+
+def _run_ai_grading_job(job):
+    """ジョブを1件実行して結果を保存する"""
+    try:
+        if job.job_type in AI_CANCELLABLE_JOB_TYPES and is_ai_job_abandoned(job.job_token):
+            # 順番待ちの間に利用者が離れた場合はAPIを呼ばない
+            body, status_code = ai_job_cancelled_response()
+        elif job.job_type == 'ocr':
+            body, status_code = run_essay_ocr(job.input_data)
+        elif job.job_type == 'search':
+            payload = json.loads(job.payload or '{}')
+            body, status_code = run_essay_ai_search(payload.get('keywords', ''), payload.get('candidate_ids', []))
+        elif job.job_type == 'news':
+            body, status_code = run_news_update()
+        else:
+            payload = json.loads(job.payload or '{}')
+            body, status_code = grade_essay_answer(
+                payload.get('problem_id'),
+                payload.get('user_answer'),
+                payload.get('feedback_style', 'concise'),
+                on_partial=lambda text_value: set_ai_job_partial(job.job_token, text_value),
+                should_cancel=lambda: is_ai_job_abandoned(job.job_token)
+            )
+            if status_code == 200 and payload.get('cache_key'):
+                store_essay_grading_cache(payload['cache_key'], payload['problem_id'], body)
+    except Exception as e:
+        print(f"❌ AI採点ジョブ実行エラー (job={job.id}): {e}")
+        db.session.rollback()
+        body, status_code = {'status': 'error', 'message': f'エラーが発生しました: {e}'}, 500
+
+    if status_code == 499:
+        refund_ai_job_ticket(job)  # 取り消し・放棄で結果を返さなかった
+    job.status = 'done' if status_code == 200 else 'error'
+    job.result = json.dumps(body, ensure_ascii=False)
+    job.result_status = status_code
+    job.input_data = None  # 画像は処理が終わったら不要
+    job.finished_at = datetime.now(JST)
+    db.session.commit()
+    with AI_JOB_STREAMS_LOCK:
+        AI_JOB_STREAMS.pop(job.job_token, None)
+
+def _purge_finished_ai_grading_jobs():
+    """保持期間を過ぎた完了ジョブを削除する"""
+    threshold = datetime.now(JST) - timedelta(seconds=AI_GRADING_JOB_RETENTION)
+    AiGradingJob.query.filter(
+        AiGradingJob.status.in_(['done', 'error']),
+        AiGradingJob.finished_at < threshold
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+    # 処理されずに残った途中経過の記録も捨てる
+    now = time.monotonic()
+    with AI_JOB_STREAMS_LOCK:
+        for job_token in [t for t, entry in AI_JOB_STREAMS.items() if now - entry['last_seen'] > AI_GRADING_JOB_RETENTION]:
+            AI_JOB_STREAMS.pop(job_token, None)
+
+def run_ai_thread_job(job_id):
+    """AI_THREAD_JOB_TYPES のジョブを1件実行する（start_ai_thread_job のスレッド本体）"""
+    with app.app_context():
+        claimed = AiGradingJob.query.filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'started_at': datetime.now(JST)},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if claimed:
+            _run_ai_grading_job(db.session.get(AiGradingJob, job_id))
+        db.session.remove()
+
+def start_ai_thread_job(job):
+    """採点ワーカーの待ち行列に並べず、専用スレッドでジョブを実行する"""
+    thread = threading.Thread(target=run_ai_thread_job, args=(job.id,), name=f'ai-job-{job.id}', daemon=True)
+    thread.start()
+
+def drain_ai_grading_queue():
+    """待機ジョブがなくなるまで処理する。処理した件数を返す"""
+    processed = 0
+    while True:
+        with AI_GRADING_CLAIM_LOCK:
+            job = _claim_next_ai_grading_job()
+        if job is None:
+            return processed
+        _run_ai_grading_job(job)
+        processed += 1
+        gc.collect()
+
+def _ai_grading_worker_loop():
+    """ワーカースレッド本体: 起こされるか一定間隔ごとに待ち行列を処理する"""
+    while True:
+        try:
+            with app.app_context():
+                drain_ai_grading_queue()
+                _purge_finished_ai_grading_jobs()
+        except Exception as e:
+            print(f"❌ AI採点ワーカーエラー: {e}")
+        AI_GRADING_WAKEUP.wait(timeout=AI_GRADING_POLL_INTERVAL)
+        AI_GRADING_WAKEUP.clear()
+
+def ensure_ai_grading_workers():
+    """ワーカースレッドを起動する（初回のみ）"""
+    with AI_GRADING_WORKERS_LOCK:
+        if AI_GRADING_WORKERS:
+            return
+
+        # 前回のプロセスで処理中のまま終わったジョブは待機に戻す（ワーカーは1プロセスのみの前提）
+        # 専用スレッドのジョブは拾い直す者がいないため、中断として終わらせる
+        try:
+            AiGradingJob.query.filter(
+                AiGradingJob.status == 'running',
+                ~AiGradingJob.job_type.in_(AI_THREAD_JOB_TYPES)
+            ).update({'status': 'queued', 'started_at': None}, synchronize_session=False)
+            AiGradingJob.query.filter(
+                AiGradingJob.status.in_(['queued', 'running']),
+                AiGradingJob.job_type.in_(AI_THREAD_JOB_TYPES)
+            ).update({
+                'status': 'error',
+                'result': json.dumps({'status': 'error', 'message': 'サーバーの再起動により処理を中断しました。'}, ensure_ascii=False),
+                'result_status': 500,
+                'finished_at': datetime.now(JST)
+            }, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️ 処理中ジョブの復旧に失敗: {e}")
+
+        for i in range(AI_GRADING_CONCURRENCY):
+            worker = threading.Thread(target=_ai_grading_worker_loop, name=f'ai-grading-worker-{i}', daemon=True)
+            worker.start()
+            AI_GRADING_WORKERS.append(worker)
+        print(f"✅ AI採点ワーカーを起動しました（{AI_GRADING_CONCURRENCY}スレッド）")
+
+@app.route('/api/essay/jobs/<job_token>')
+def get_ai_grading_job(job_token):
+    """AI採点・OCRジョブの順番待ち状況、または処理結果を返す"""
+    job = AiGradingJob.query.filter_by(job_token=job_token).first()
+    if not job or (job.user_id and job.user_id != session.get('user_id')):
+        return jsonify({'status': 'error', 'message': 'ジョブが見つかりません'}), 404
+
+    # 再起動直後でもポーリングで処理が再開されるようにする
+    ensure_ai_grading_workers()
+
+    if job.status in ('done', 'error'):
+        return jsonify(ai_grading_job_response(job)), job.result_status or 200
+    response = ai_grading_job_response(job)
+    touch_ai_job(job.job_token, response.get('position', 0))
+    return jsonify(response)
+
+@app.route('/api/essay/jobs/<job_token>/cancel', methods=['POST'])
+def cancel_ai_grading_job(job_token):
+    """
+    AI採点・OCR・AI検索のジョブを中断する（ページを離れるときにブラウザから送られる）。
+    待機中ならその場で取り消し、処理中ならワーカーが次の断片を受け取った時点で生成を打ち切る。
+    """
+    job = AiGradingJob.query.filter_by(job_token=job_token).first()
+    if not job or (job.user_id and job.user_id != session.get('user_id')):
+        return jsonify({'status': 'error', 'message': 'ジョブが見つかりません'}), 404
+    if job.job_type not in AI_CANCELLABLE_JOB_TYPES or job.status in ('done', 'error'):
+        return jsonify({'status': 'success', 'cancelled': False})
+
+    with AI_JOB_STREAMS_LOCK:
+        entry = AI_JOB_STREAMS.setdefault(job_token, {'partial': None, 'last_seen': time.monotonic()})
+        entry['cancelled'] = True
+
+    body, status_code = ai_job_cancelled_response()
+    cancelled = AiGradingJob.query.filter_by(id=job.id, status='queued').update({
+        'status': 'error',
+        'result': json.dumps(body, ensure_ascii=False),
+        'result_status': status_code,
+        'input_data': None,
+        'finished_at': datetime.now(JST)
+    }, synchronize_session=False)
+    db.session.commit()
+    if cancelled:
+        refund_ai_job_ticket(job)  # 処理中のジョブはワーカーが打ち切った時点で戻す
+    return jsonify({'status': 'success', 'cancelled': True})
+
+@app.route('/api/essay/ocr', methods=['POST'])
+def essay_ocr():
+    """アップロードされた画像をOCRの待ち行列に積む（結果は /api/essay/jobs/<job_id> で取得）"""
+    if not GEMINI_API_KEY:
+        return jsonify({'status': 'error', 'message': 'Gemini API key not configured'}), 500
+
+    # Ensure AI features are enabled for the room
+    user_room = session.get('room') or 'default'
     room_setting = RoomSetting.query.filter_by(room_number=user_room).first()
     if room_setting and not room_setting.feature_ai:
         return jsonify({'status': 'error', 'message': 'この機能は現在の部屋では利用できません'}), 403
@@ -15262,30 +16536,84 @@ def essay_ocr():
     if file.filename == '':
         return jsonify({'status': 'error', 'message': 'No image selected'}), 400
 
-    # === 同時実行制限 (メモリ節約) ===
-    # 採点機能とリソースを共有
-    if not ai_grading_semaphore.acquire(blocking=False):
-        return jsonify({'status': 'busy', 'message': '現在AI機能が混雑しています。少し待ってから再試行してください。'}), 503
+    # 縮小・正規化してから積む（DBへの保存もAPIへの送信も小さい画像で済む）
+    try:
+        image_bytes, preprocess_stats = preprocess_ocr_image(file.read())
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    # 採点機能と同じ待ち行列に積む（混雑時も拒否せず順番に処理）
+    job = enqueue_ai_grading_job('ocr', session.get('user_id'), input_data=image_bytes)
+    response = ai_grading_job_response(job)
+    response['preprocess'] = preprocess_stats
+    return jsonify(response), 202
+
+def preprocess_ocr_image(image_bytes):
+    """
+    OCR用に画像を縮小・正規化する。戻り値は (JPEGのbytes, 縮小前後のサイズの統計dict)。
+    JPEGはdraftモードで縮小しながら展開し、EXIFの向きを補正してからグレースケール化・コントラスト補正する。
+    画像として読めない・解像度が大きすぎる場合は ValueError。
+    """
+    from PIL import Image, ImageOps
+
+    with OCR_PREPROCESS_SLOTS:
+        try:
+            source = Image.open(io.BytesIO(image_bytes))
+        except Exception as e:
+            raise ValueError('画像を読み込めませんでした。JPEGまたはPNGの画像を選んでください。') from e
+
+        with source:
+            source_size = source.size
+            if source_size[0] * source_size[1] > OCR_IMAGE_MAX_SOURCE_PIXELS:
+                raise ValueError('画像の解像度が大きすぎます。')
+            if source.format == 'JPEG':
+                # DCTの段階で1/2〜1/8に縮小して展開する（フル解像度のビットマップを作らない）
+                source.draft('L', (OCR_IMAGE_MAX_SIDE, OCR_IMAGE_MAX_SIDE))
+            try:
+                image = ImageOps.exif_transpose(source)  # スマホの縦撮り写真の向きを直す
+                image = image.convert('L')
+            except Exception as e:
+                raise ValueError('画像を読み込めませんでした。') from e
+
+        image.thumbnail((OCR_IMAGE_MAX_SIDE, OCR_IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+        image = ImageOps.autocontrast(image, cutoff=1)  # 薄い鉛筆書き・暗い写真のコントラストを揃える
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=OCR_IMAGE_JPEG_QUALITY, optimize=True)
+        processed = output.getvalue()
+        output_size = image.size
+        image.close()
+
+    stats = {
+        'bytes_in': len(image_bytes),
+        'bytes_out': len(processed),
+        'pixels_in': source_size[0] * source_size[1],
+        'pixels_out': output_size[0] * output_size[1],
+    }
+    logger.info(
+        f"OCR image preprocessed: {source_size[0]}x{source_size[1]} -> {output_size[0]}x{output_size[1]}, "
+        f"{stats['bytes_in'] // 1024}KB -> {stats['bytes_out'] // 1024}KB"
+    )
+    return processed, stats
+
+def run_essay_ocr(image_bytes):
+    """
+    画像から手書き文字を読み取り、HTML形式で返す（ワーカースレッドから呼ばれる）。
+    戻り値は (レスポンス本体のdict, HTTPステータス)。
+    """
+    import PIL.Image
+    from google.genai import types  # 遅延インポート（メモリ節約）
 
     try:
-        with PIL.Image.open(file) as image:
-            # 画像のリサイズ（長辺最大1280px）- メモリ節約
-            max_size = 1280
-            if max(image.size) > max_size:
-                ratio = max_size / max(image.size)
-                new_size = (int(image.size[0] * ratio), int(image.size[1] * ratio))
-                image = image.resize(new_size, PIL.Image.Resampling.LANCZOS)
-                logger.info(f"Image resized to {new_size}")
+        # Gemini 2.0 Flash を使用 (高速・高性能OCR)
+        if not AI_GATEWAY.available():
+             raise Exception("Gemini client could not be loaded")
 
-            # Gemini 2.0 Flash を使用 (高速・高性能OCR)
-            client = get_genai_client()
-            if not client:
-                 raise Exception("Gemini client could not be loaded")
-            
-            # PIL Image を bytes に変換 (新APIで必要)
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
+        # 受付時に前処理済み（長辺1280px以下のJPEG）。前処理導入前に積まれたジョブなどはここで処理する
+        with PIL.Image.open(io.BytesIO(image_bytes)) as image:
+            needs_preprocess = image.format != 'JPEG' or max(image.size) > OCR_IMAGE_MAX_SIDE
+        if needs_preprocess:
+            image_bytes, _ = preprocess_ocr_image(image_bytes)
+        img_byte_arr = image_bytes
         
         prompt = """
         この画像の論述答案にある手書き文字を読み取ってください。
@@ -15302,31 +16630,14 @@ def essay_ocr():
         4. 縦書きの場合は横書きに直してください。
         """
         
-        # === OCR: モデルフォールバックロジック ===
-        current_model = 'gemini-3.5-flash'
-        response = None
-        
+        # === OCR: 混雑・障害時は AI_GATEWAY が軽量モデルにフォールバックする ===
         # Use types.Part explicitly to avoid mixed type issues
         content_payload = [
             types.Part.from_text(text=prompt),
-            types.Part.from_bytes(data=img_byte_arr, mime_type='image/png')
+            types.Part.from_bytes(data=img_byte_arr, mime_type='image/jpeg')
         ]
         
-        try:
-            response = client.models.generate_content(
-                model=current_model,
-                contents=content_payload
-            )
-        except Exception as e:
-            if '429' in str(e) or 'RESOURCE_EXHAUSTED' in str(e):
-                print(f"⚠️ OCR Rate Limit ({current_model}). Switching to fallback...")
-                current_model = 'gemini-3.1-flash-lite'
-                response = client.models.generate_content(
-                    model=current_model,
-                    contents=content_payload
-                )
-            else:
-                raise e
+        response = AI_GATEWAY.generate(AI_PRIMARY_MODEL, content_payload, fallback_models=(AI_FALLBACK_MODEL,), purpose='essay_ocr')
         text = response.text
         
         # クリーニング（改行削除 & 不要なタグ削除）
@@ -15334,20 +16645,20 @@ def essay_ocr():
         text = text.replace('\n', '') # 改行を完全に削除
         text = text.replace('<br>', '') # 万が一生成されたタグも削除
         
-        return jsonify({'status': 'success', 'text': text})
+        return {'status': 'success', 'text': text}, 200
         
     except Exception as e:
         error_msg = str(e)
         print(f"OCR Error: {error_msg}")
         
         # レート制限エラーハンドリング
-        if '429' in error_msg or 'RESOURCE_EXHAUSTED' in error_msg:
-             return jsonify({
+        if is_ai_rate_limit_error(e):
+             return {
                 'status': 'error', 
                 'error_type': 'rate_limit',
                 'message': 'AI機能が混雑しています（利用制限）。数分待ってから再度お試しください。',
                 'retry_after': 300
-            }), 429
+            }, 429
 
         try:
             # エラー時に利用可能なモデル一覧をログに出力
@@ -15359,24 +16670,153 @@ def essay_ocr():
             print("------------------------")
         except:
             pass
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return {'status': 'error', 'message': str(e)}, 500
     
     finally:
         # リソース解放
-        ai_grading_semaphore.release()
         gc.collect()
 
+# ====================================================================
+# Embedding Cache
+# ====================================================================
+def _normalize_embedding_text(text_value):
+    """キャッシュキー・埋め込み入力用に文章を正規化する（全角半角の揺れと空白の違いを吸収）"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text_value or '')).strip()
+
+def _remember_embedding(key, vector):
+    """メモリ上のLRUに登録する（上限を超えたら最も古く参照されたものから破棄）"""
+    with EMBEDDING_CACHE_LOCK:
+        EMBEDDING_CACHE.pop(key, None)
+        if len(EMBEDDING_CACHE) >= MAX_EMBEDDING_CACHE_SIZE:
+            first_key = next(iter(EMBEDDING_CACHE))
+            EMBEDDING_CACHE.pop(first_key)
+        EMBEDDING_CACHE[key] = vector
+
+def get_text_embedding(text_value, model=EMBEDDING_MODEL):
+    """
+    文章の埋め込みベクトル(array('f'))を返す。失敗時はNone。
+    メモリ上のLRU → EmbeddingCacheテーブル → 埋め込みAPI の順に探し、APIの結果は両方に保存する。
+    テーブルへの読み書きは呼び出し元のセッションを巻き込まないよう別コネクションで行う。
+    """
+    normalized = _normalize_embedding_text(text_value)
+    if not normalized:
+        return None
+    key = (model, hashlib.sha256(normalized.encode('utf-8')).hexdigest())
+
+    with EMBEDDING_CACHE_LOCK:
+        vector = EMBEDDING_CACHE.get(key)
+        if vector is not None:
+            EMBEDDING_CACHE[key] = EMBEDDING_CACHE.pop(key)  # 末尾（最新）へ移動
+            EMBEDDING_CACHE_STATS['memory_hits'] += 1
+            return vector
+
+    table = EmbeddingCache.__table__
+    try:
+        with db.engine.connect() as conn:
+            stored = conn.execute(
+                select(table.c.vector).where(table.c.model == model, table.c.text_hash == key[1])
+            ).scalar()
+    except Exception as e:
+        print(f"⚠️ Embedding cache lookup failed: {e}")
+        stored = None
+    if stored is not None:
+        vector = array('f')
+        vector.frombytes(stored)
+        _remember_embedding(key, vector)
+        with EMBEDDING_CACHE_LOCK:
+            EMBEDDING_CACHE_STATS['db_hits'] += 1
+        return vector
+
+    with EMBEDDING_CACHE_LOCK:
+        EMBEDDING_CACHE_STATS['misses'] += 1
+
+    if not AI_GATEWAY.available():
+        return None
+    try:
+        vector = array('f', AI_GATEWAY.embed(model, normalized, purpose='query_embedding'))
+    except Exception as e:
+        print(f"⚠️ Query embedding failed: {e}")
+        return None
+
+    _remember_embedding(key, vector)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                model=model, text_hash=key[1], vector=vector.tobytes(), created_at=datetime.now(JST)
+            ))
+    except Exception as e:
+        # 別スレッドが同じ文章を先に保存した場合など。次回もメモリ上のLRUから返せる
+        print(f"⚠️ Embedding cache store skipped: {e}")
+    return vector
+
+def get_embedding_cache_stats():
+    """埋め込みキャッシュのヒット・ミス件数"""
+    with EMBEDDING_CACHE_LOCK:
+        stats = dict(EMBEDDING_CACHE_STATS)
+        stats['memory_size'] = len(EMBEDDING_CACHE)
+    lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 3) if lookups else None
+    return stats
+
+@app.route('/admin/api/embedding_cache_stats')
+def admin_embedding_cache_stats():
+    if not session.get('admin_logged_in'):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+    return jsonify({'status': 'success', 'stats': get_embedding_cache_stats()})
+
+@app.route('/admin/api/ai_gateway_metrics')
+def admin_ai_gateway_metrics():
+    """AI呼び出しのモデル別集計（呼び出し数・エラー種別・所要時間・トークン数・ブレーカー状態）"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+    return jsonify({'status': 'success', 'metrics': AI_GATEWAY.snapshot()})
+
+@app.route('/admin/api/image_variant_stats')
+def admin_image_variant_stats():
+    """画像の派生版（縮小・WebP）の件数と削減バイト数"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+    return jsonify({'status': 'success', 'variants': image_variant_report()})
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """複数の順位リストをRRF（各リストで 1 / (k + 順位) を合計）で1つにまとめる。同点は先に現れた方を優先"""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
+
 # ====================================================================
 # Textbook Manager (Dynamic Context Selection)
 # ====================================================================
 class TextbookManager:
     _instance = None
     _lock = threading.Lock()
+
+    # scripts/build_vector_db.py が出力するベクトルDB
+    VECTOR_MATRIX_FILENAME = 'textbook_vectors.npy'        # 行ごとにL2正規化済みのfloat32行列
+    VECTOR_TITLES_FILENAME = 'textbook_vector_titles.json' # 行に対応するセクション名
+    VECTOR_INT8_FILENAME = 'textbook_vectors_int8.npy'     # 同じ行列のint8量子化版（1次検索用）
+    VECTOR_SCALES_FILENAME = 'textbook_vector_scales.npy'  # int8版の行ごとのスケール
+    BM25_INDEX_FILENAME = 'textbook_bm25.npz'              # 本文の文字bigram BM25インデックス（なければ本文から構築）
+    SECTION_INDEX_FILENAME = 'textbook_sections.json'      # 見出し → 教科書内のバイト位置（なければ起動後に構築）
+    LEGACY_VECTOR_FILENAME = 'textbook_vectors.pkl'        # 旧形式 [{title, content, vector}]
+    VECTOR_RERANK_FACTOR = 4     # int8で top_k x これ だけ候補を残し、float32で並べ直す
+    VECTOR_RERANK_MIN = 20
+    VECTOR_SCAN_CHUNK_ROWS = 1024  # int8行列をfloat32に変換しながら走査する単位（一時配列の大きさを抑える）
+    RRF_CANDIDATES = 20            # hybrid検索で各方式から統合に使う件数
     
     def __init__(self):
+        self.data_dir = os.path.join(app.root_path, 'data')
         self.sections = None # Lazy load: { "Title": "Content" }
         self.toc = None      # Lazy load: [ "Title1", "Title2", ... ]
-        self.vectors = None  # List of {title, content, vector}
+        self.vectors = None  # List of {title, content, vector} (旧形式のみ)
+        self.vector_matrix = None  # np.load(mmap_mode='r') した行列（ページキャッシュ上にありヒープを使わない）
+        self.vector_titles = None
+        self.vector_codes = None   # int8版（なければfloat32行列で全件検索）
+        self.vector_scales = None
+        self.bm25_index = None     # build_textbook_bm25_index() の配列
+        self.section_index = None  # build_textbook_section_index() の結果（本文は持たない）
         # self._load_textbook() # Removed: Lazy load
         # self._load_vectors() # REMOVED: Load on demand to save memory
 
@@ -15401,13 +16841,90 @@ class TextbookManager:
         self.sections = None
         self.toc = None
         self.vectors = None
+        self.vector_matrix = None
+        self.vector_titles = None
+        self.vector_codes = None
+        self.vector_scales = None
+        self.bm25_index = None
+        self.section_index = None
         gc.collect()
         print("🧹 TextbookManager memory cleared.")
 
 
+    def has_vector_db(self):
+        """ベクトルDB（新形式または旧形式）が配置されているか"""
+        return (
+            os.path.exists(os.path.join(self.data_dir, self.VECTOR_MATRIX_FILENAME))
+            or os.path.exists(os.path.join(self.data_dir, self.LEGACY_VECTOR_FILENAME))
+        )
+
+    def _load_vector_matrix(self):
+        """
+        正規化済みベクトル行列をmmapで開く（初回のみ）。使えればTrueを返す。
+        mmapなので実体はOSのページキャッシュに載り、リクエストごとの読み込みも不要。
+        """
+        if self.vector_matrix is not None:
+            return True
+
+        matrix_path = os.path.join(self.data_dir, self.VECTOR_MATRIX_FILENAME)
+        titles_path = os.path.join(self.data_dir, self.VECTOR_TITLES_FILENAME)
+        if not (os.path.exists(matrix_path) and os.path.exists(titles_path)):
+            return False
+
+        try:
+            import numpy as np  # 遅延インポート（メモリ節約）
+            matrix = np.load(matrix_path, mmap_mode='r')
+            with open(titles_path, 'r', encoding='utf-8') as f:
+                titles = json.load(f)
+            if matrix.ndim != 2 or matrix.shape[0] != len(titles):
+                print(f"❌ Vector matrix shape {matrix.shape} does not match {len(titles)} titles.")
+                return False
+        except Exception as e:
+            print(f"❌ Failed to load vector matrix: {e}")
+            return False
+
+        self.vector_matrix = matrix
+        self.vector_titles = titles
+        self._load_quantized_vectors()
+        print(f"✅ Vector matrix mapped: {matrix.shape[0]} items x {matrix.shape[1]} dims"
+              f"{' (int8 first pass)' if self.vector_codes is not None else ''}.")
+        return True
+
+    def _load_quantized_vectors(self):
+        """int8版があれば開く（1次検索はこちらを走査し、float32行列は候補行だけ読む）"""
+        import numpy as np
+
+        codes_path = os.path.join(self.data_dir, self.VECTOR_INT8_FILENAME)
+        scales_path = os.path.join(self.data_dir, self.VECTOR_SCALES_FILENAME)
+        if not (os.path.exists(codes_path) and os.path.exists(scales_path)):
+            return
+        try:
+            codes = np.load(codes_path, mmap_mode='r')
+            scales = np.load(scales_path)
+        except Exception as e:
+            print(f"⚠️ Failed to load int8 vectors: {e}")
+            return
+        if codes.shape != self.vector_matrix.shape or scales.shape != (codes.shape[0],):
+            print(f"⚠️ int8 vectors {codes.shape} do not match matrix {self.vector_matrix.shape}. Ignoring.")
+            return
+        self.vector_codes = codes
+        self.vector_scales = scales
+
+    def _int8_scores(self, query):
+        """int8版での近似コサイン類似度（チャンクごとにfloat32へ変換して内積）"""
+        import numpy as np
+
+        count = self.vector_codes.shape[0]
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, self.VECTOR_SCAN_CHUNK_ROWS):
+            end = min(start + self.VECTOR_SCAN_CHUNK_ROWS, count)
+            scores[start:end] = self.vector_codes[start:end].astype(np.float32) @ query
+        scores *= self.vector_scales
+        return scores
+
     def _load_vectors(self):
-        """Load vector DB if exists"""
-        vector_path = os.path.join(app.root_path, 'data', 'textbook_vectors.pkl')
+        """Load legacy pickle vector DB if exists"""
+        vector_path = os.path.join(self.data_dir, self.LEGACY_VECTOR_FILENAME)
         if os.path.exists(vector_path):
             try:
                 with open(vector_path, 'rb') as f:
@@ -15418,85 +16935,183 @@ class TextbookManager:
         else:
              print("⚠️ Vector DB not found. Run scripts/build_vector_db.py")
 
-    def search_relevant_sections(self, query, top_k=3):
-        """Vector Search for retrieval (numpy不要・pure Python実装)"""
-        # 0. Ensure text loaded (for logic consistency if needed later)
-        self._ensure_textbook_loaded()
+    def _embed_query(self, query):
+        """検索クエリをベクトル化する（ビルド時と同じモデル。同じ文章はキャッシュから返す）。失敗時はNone"""
+        return get_text_embedding(query, model=EMBEDDING_MODEL)
 
-        # 1. Load vectors on demand
-        self._load_vectors()
+    def _search_vector_matrix(self, query_vector, top_k):
+        """行列とクエリの1回の積でコサイン類似度を求め、上位top_k件のセクション名を返す"""
+        import numpy as np
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm_q = float(np.linalg.norm(query))
+        if norm_q == 0 or query.shape[0] != self.vector_matrix.shape[1]:
+            print("⚠️ Query vector is empty or has unexpected dimensions.")
+            return []
 
-        if not self.vectors:
-            print("⚠️ No vectors loaded, falling back to empty.")
+        query = query / norm_q
+        count = self.vector_matrix.shape[0]
+        k = min(top_k, count)
+        if k <= 0:
             return []
 
+        if self.vector_codes is not None:
+            # 1次検索: int8版で候補を絞り、候補行だけfloat32で採点し直す
+            candidate_count = min(count, max(k * self.VECTOR_RERANK_FACTOR, self.VECTOR_RERANK_MIN))
+            approx_scores = self._int8_scores(query)
+            candidates = np.sort(np.argpartition(-approx_scores, candidate_count - 1)[:candidate_count])
+            exact_scores = self.vector_matrix[candidates] @ query
+            top_indices = candidates[np.argsort(-exact_scores)[:k]]
+        else:
+            # 行は正規化済みなので内積 = コサイン類似度
+            scores = self.vector_matrix @ query
+            top_indices = np.argpartition(-scores, k - 1)[:k]
+            top_indices = top_indices[np.argsort(-scores[top_indices])]
+        return [self.vector_titles[i] for i in top_indices]
+
+    def _search_legacy_vectors(self, query_vector, top_k):
+        """旧形式(pickle)のベクトルDBを使ったコサイン類似度検索（pure Python）"""
+        # Pre-compute query vector norm
+        norm_q = math.sqrt(sum(x * x for x in query_vector))
+        
+        scores = []
+        for item in self.vectors:
+            vec = item['vector']  # already a list of floats
+            # Dot product
+            dot = sum(a * b for a, b in zip(query_vector, vec))
+            # Vector norm
+            norm_v = math.sqrt(sum(x * x for x in vec))
+            
+            if norm_q == 0 or norm_v == 0:
+                score = 0
+            else:
+                score = dot / (norm_q * norm_v)
+            
+            scores.append((score, item['title']))
+
+        scores.sort(key=lambda x: x[0], reverse=True)
+        return [title for _, title in scores[:top_k]]
+
+    def _vector_search(self, query, top_k):
+        """ベクトル検索（mmapした正規化済み行列。旧形式のみの環境ではpickle）。使えない場合はNone"""
+        # 1. Open vector DB
+        use_matrix = self._load_vector_matrix()
+        if not use_matrix:
+            self._load_vectors()
+            if not self.vectors:
+                print("⚠️ No vectors loaded.")
+                return None
+
         # 2. Embed query (using same model as build script)
-        client = get_genai_client()
-        if not client:
-             return []
+        query_vector = self._embed_query(query)
 
         try:
-            # model must match the one used in build logic
-            result = client.models.embed_content(
-                model="models/gemini-embedding-001",
-                contents=query
-            )
-            query_vector = result.embeddings[0].values  # list of floats
-        except Exception as e:
-            print(f"⚠️ Query embedding failed: {e}")
-            # Unload vectors even on fail
-            self.vectors = None
-            gc.collect()
-            return []
+            if query_vector is None:
+                return None
 
-        try:
-            # 3. Cosine Similarity Calculation (pure Python, no numpy)
-            # Pre-compute query vector norm
-            norm_q = math.sqrt(sum(x * x for x in query_vector))
-            
-            scores = []
-            for item in self.vectors:
-                vec = item['vector']  # already a list of floats
-                # Dot product
-                dot = sum(a * b for a, b in zip(query_vector, vec))
-                # Vector norm
-                norm_v = math.sqrt(sum(x * x for x in vec))
-                
-                if norm_q == 0 or norm_v == 0:
-                    score = 0
-                else:
-                    score = dot / (norm_q * norm_v)
-                
-                scores.append((score, item))
+            # 3. Similarity & Top-k
+            if use_matrix:
+                return self._search_vector_matrix(query_vector, top_k)
+            return self._search_legacy_vectors(query_vector, top_k)
         except Exception as sim_err:
             print(f"⚠️ Similarity calculation failed: {sim_err}")
-            self.vectors = None
-            gc.collect()
+            return None
+        finally:
+            if not use_matrix:
+                # 旧形式は全件をヒープに読むため毎回解放する
+                self.vectors = None
+                gc.collect()
+
+    def _load_bm25_index(self):
+        """BM25インデックスを読み込む（ファイルがなければ教科書本文から構築）。使えない場合はNone"""
+        if self.bm25_index is not None:
+            return self.bm25_index
+
+        try:
+            import numpy as np  # 遅延インポート（メモリ節約）
+            index_path = os.path.join(self.data_dir, self.BM25_INDEX_FILENAME)
+            if os.path.exists(index_path):
+                with np.load(index_path) as data:
+                    index = {key: data[key] for key in data.files}
+            else:
+                self._ensure_textbook_loaded()
+                if not self.sections:
+                    return None
+                print("⚠️ BM25 index not found. Building from textbook (run scripts/build_vector_db.py to precompute).")
+                index = build_textbook_bm25_index(self.sections.items())
+        except Exception as e:
+            print(f"❌ Failed to load BM25 index: {e}")
+            return None
+
+        index['titles'] = index['titles'].tolist()
+        self.bm25_index = index
+        return index
+
+    def bm25_search_sections(self, query, top_k=3, k1=1.2, b=0.75):
+        """教科書本文の文字bigram BM25で上位のセクション名を返す（埋め込みAPIを使わない）"""
+        index = self._load_bm25_index()
+        if index is None or not index['titles']:
             return []
+        import numpy as np
 
-        # 4. Sort & Select
-        scores.sort(key=lambda x: x[0], reverse=True)
-        
-        top_items = scores[:top_k]
-        
-        selected_titles = [x[1]['title'] for x in top_items]
-        
-        # Log results for verification
-        print(f"🔍 Vector Search Results for: {query[:20]}...")
-            
-        # Clean up large objects explicitly
-        self.vectors = None # Important: Unload vectors to free memory
-        del client
-        del result
-        del query_vector
-        del scores
-        del top_items
-        gc.collect()
+        query_grams = {}
+        for gram in _essay_search_bigrams(_normalize_essay_search_text(query)):
+            query_grams[gram] = query_grams.get(gram, 0) + 1
+        if not query_grams:
+            return []
+
+        grams = index['grams']
+        indptr = index['indptr']
+        doc_lengths = index['doc_lengths']
+        doc_count = len(doc_lengths)
+        norms = k1 * (1 - b + b * doc_lengths / (float(doc_lengths.mean()) or 1.0))
+        scores = np.zeros(doc_count, dtype=np.float64)
+        positions = np.searchsorted(grams, np.array(list(query_grams), dtype=grams.dtype))
+        for (gram, query_tf), pos in zip(query_grams.items(), positions):
+            if pos >= len(grams) or grams[pos] != gram:
+                continue
+            docs = index['doc_ids'][indptr[pos]:indptr[pos + 1]]
+            tfs = index['tfs'][indptr[pos]:indptr[pos + 1]]
+            idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += query_tf * idf * tfs * (k1 + 1) / (tfs + norms[docs])
 
-        return selected_titles
+        matched = np.flatnonzero(scores > 0)
+        top_indices = matched[np.argsort(-scores[matched], kind='stable')][:top_k]
+        return [index['titles'][i] for i in top_indices]
+
+    def retrieve_sections(self, query, top_k=3, mode=None):
+        """
+        関連セクション名と実際に使った検索方式を (titles, source) で返す。
+        mode: 'hybrid'（ベクトルとBM25の順位をRRFで統合）/ 'vector' / 'bm25'（APIを使わない）。省略時は TEXTBOOK_RETRIEVAL_MODE。
+        ベクトル検索が使えない場合（APIエラー・ベクトルDBなし）はBM25のみにフォールバックする。
+        """
+        mode = mode or TEXTBOOK_RETRIEVAL_MODE
+
+        vector_titles = None
+        if mode != 'bm25':
+            vector_titles = self._vector_search(query, top_k if mode == 'vector' else self.RRF_CANDIDATES)
+            if vector_titles and mode == 'vector':
+                print(f"🔍 Vector Search Results for: {query[:20]}...")
+                return vector_titles[:top_k], 'vector'
+
+        lexical_titles = self.bm25_search_sections(query, top_k if not vector_titles else self.RRF_CANDIDATES)
+        if not vector_titles:
+            if mode != 'bm25':
+                print("⚠️ Vector search unavailable. Using BM25 only.")
+            return lexical_titles[:top_k], 'bm25'
+        if not lexical_titles:
+            return vector_titles[:top_k], 'vector'
+
+        print(f"🔍 Hybrid Search Results for: {query[:20]}...")
+        return reciprocal_rank_fusion([vector_titles, lexical_titles])[:top_k], 'hybrid'
+
+    def search_relevant_sections(self, query, top_k=3, mode=None):
+        """Retrieval for grading context（retrieve_sections の titles だけを返す）"""
+        titles, _ = self.retrieve_sections(query, top_k, mode)
+        return titles
 
     def _load_textbook(self):
-        textbook_path = os.path.join(app.root_path, 'data', 'textbook.txt')
+        textbook_path = os.path.join(self.data_dir, 'textbook.txt')
         if not os.path.exists(textbook_path):
             print(f"Textbook file not found at: {textbook_path}")
             return
@@ -15515,10 +17130,8 @@ class TextbookManager:
             current_header = "Introduction"
             current_content = []
             
-            header_pattern = re.compile(r'^(第[０-９0-9]+[部章].*|[０-９0-9]+　.*|●.*|【.*】.*)') 
-            
             for line in lines:
-                if header_pattern.match(line):
+                if TEXTBOOK_HEADER_PATTERN.match(line):
                     # Save previous section
                     if current_content:
                         self.sections[current_header] = "\\n".join(current_content)
@@ -15540,33 +17153,148 @@ class TextbookManager:
         except Exception as e:
             print(f"❌ Failed to parse textbook: {e}")
 
+    def _load_section_index(self, rebuild=False):
+        """見出しのバイト位置の索引を返す（ファイルがない・教科書と大きさが違う場合はその場で作る）。教科書がなければNone"""
+        if self.section_index is not None and not rebuild:
+            return self.section_index
+
+        textbook_path = os.path.join(self.data_dir, 'textbook.txt')
+        if not os.path.exists(textbook_path):
+            print(f"Textbook file not found at: {textbook_path}")
+            return None
+
+        index = None
+        index_path = os.path.join(self.data_dir, self.SECTION_INDEX_FILENAME)
+        if not rebuild and os.path.exists(index_path):
+            try:
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                if index.get('source_size') != os.path.getsize(textbook_path):
+                    print("⚠️ Section index is stale. Rebuilding in memory.")
+                    index = None
+            except Exception as e:
+                print(f"⚠️ Failed to load section index: {e}")
+                index = None
+        if index is None:
+            index = build_textbook_section_index(textbook_path)
+
+        self.section_index = index
+        return index
+
+    def _resolve_section_title(self, title):
+        """完全一致 → 表記揺れ（正規化した見出し）→ 部分一致 の順に索引の見出しを探す"""
+        sections = self.section_index['sections']
+        if title in sections:
+            return title
+        alias = self.section_index['aliases'].get(_normalize_section_title(title))
+        if alias:
+            return alias
+        # Fuzzy match attempt
+        for real_title in sections:
+            if title in real_title or real_title in title:
+                return real_title
+        return None
+
+    def _read_section(self, title, retry=True):
+        """索引の位置から1セクション分だけ読む（見出しがずれていたら索引を作り直して1回だけ読み直す）"""
+        offset, length = self.section_index['sections'][title]
+        with open(os.path.join(self.data_dir, 'textbook.txt'), 'rb') as f:
+            f.seek(offset)
+            content = f.read(length).decode('utf-8', errors='replace')
+        # 次の見出しの直前の改行1つだけを除く（空行は本文の一部として残す）
+        if content.endswith('\n'):
+            content = content[:-2] if content.endswith('\r\n') else content[:-1]
+        if title != "Introduction" and not content.startswith(title):
+            if not retry:
+                return None
+            index = self._load_section_index(rebuild=True)
+            if title not in index['sections']:
+                return None
+            return self._read_section(title, retry=False)
+        return content
+
     def get_toc_text(self):
-        self._ensure_textbook_loaded()
-        return "\\n".join(self.toc)
+        index = self._load_section_index()
+        return "\n".join(index['toc']) if index else ""
 
     def get_relevant_content(self, selected_titles):
-        self._ensure_textbook_loaded()
-        content = ""
+        """選ばれた見出しの本文をつなげて返す（教科書全体は読まず、索引の位置から該当部分だけを読む）"""
+        index = self._load_section_index()
+        if index is None:
+            return "", []
 
+        content = ""
         used_titles = []
         for title in selected_titles:
             # Flexible matching: exact or partial
             if isinstance(title, list):
                 if not title: continue
                 title = title[0] # Unwrap list if needed
-            
-            if title in self.sections:
-                content += f"\n\n--- {title} ---\n" + self.sections[title]
-                used_titles.append(title)
-            else:
-                # Fuzzy match attempt
-                for real_title in self.sections.keys():
-                    if title in real_title or real_title in title:
-                         content += f"\n\n--- {real_title} ---\n" + self.sections[real_title]
-                         used_titles.append(real_title)
-                         break
+
+            real_title = self._resolve_section_title(title)
+            if real_title is None:
+                continue
+            section = self._read_section(real_title)
+            if section is None:
+                continue
+            content += f"\n\n--- {real_title} ---\n" + section
+            used_titles.append(real_title)
         return content, used_titles
 
+def map_essay_problems_to_textbook(problem_ids=None, force=False, batch_size=50):
+    """
+    論述問題ごとに関連教科書セクションをベクトル検索して保存する。
+    問題の追加・編集・CSV取込後と scripts/build_vector_db.py から呼ばれ、採点時の埋め込みAPI呼び出しを省く。
+    force=False なら計算済み（問題文が変わっていない）の問題は飛ばす。保存した件数を返す。
+    """
+    tm = TextbookManager.get_instance()
+    if not tm.has_vector_db():
+        return 0
+
+    query = EssayProblem.query.with_entities(
+        EssayProblem.id, EssayProblem.question, EssayProblem.textbook_sections_key
+    )
+    if problem_ids is not None:
+        if not problem_ids:
+            return 0
+        query = query.filter(EssayProblem.id.in_(problem_ids))
+    target_ids = [
+        row.id for row in query.order_by(EssayProblem.id).all()
+        if force or row.textbook_sections_key != essay_textbook_sections_key(row.question)
+    ]
+
+    mapped = 0
+    for start in range(0, len(target_ids), batch_size):
+        batch_ids = target_ids[start:start + batch_size]
+        for problem in EssayProblem.query.filter(EssayProblem.id.in_(batch_ids)).all():
+            titles, source = tm.retrieve_sections(problem.question, top_k=ESSAY_TEXTBOOK_SECTIONS_TOP_K)
+            # BM25のみ（埋め込み失敗時）の結果は保存せず、次回ベクトル検索できたときに計算する
+            if titles and source != 'bm25':
+                problem.set_textbook_sections(titles)
+                mapped += 1
+        db.session.commit()
+        db.session.expunge_all()  # メモリ節約
+    return mapped
+
+def schedule_essay_textbook_mapping(problem_ids):
+    """追加・編集した問題の関連セクション計算をバックグラウンドで行う（管理画面の応答を待たせない）"""
+    problem_ids = [pid for pid in problem_ids if pid]
+    if not problem_ids or not TextbookManager.get_instance().has_vector_db():
+        return
+
+    def run_mapping():
+        with app.app_context():
+            try:
+                mapped = map_essay_problems_to_textbook(problem_ids)
+                print(f"📚 論述問題 {mapped}件の関連セクションを計算しました")
+            except Exception as e:
+                print(f"⚠️ 関連セクション計算エラー: {e}")
+                db.session.rollback()
+
+    thread = threading.Thread(target=run_mapping)
+    thread.daemon = True
+    thread.start()
+
 def check_and_reset_ai_tickets(user):
     """日付をまたいでいればチケットを10にリセットする"""
     from datetime import datetime
@@ -15588,11 +17316,25 @@ def consume_ai_ticket(user):
         return True
     return False
 
+def refund_ai_ticket(user):
+    """consume_ai_ticket で消費したチケットを1枚戻す（日付が変わってリセット済みなら戻さない）"""
+    if user.last_ai_ticket_date == datetime.now(JST).date() and user.ai_tickets < 10:
+        user.ai_tickets += 1
+        db.session.commit()
+
+def refund_ai_job_ticket(job):
+    """結果を返さずに中断したジョブ（payload の ticket_consumed が真）のチケットを戻す"""
+    try:
+        payload = json.loads(job.payload or '{}')
+    except ValueError:
+        return
+    user = db.session.get(User, job.user_id) if job.user_id and payload.get('ticket_consumed') else None
+    if user:
+        refund_ai_ticket(user)
+
 @app.route('/api/essay/grade', methods=['POST'])
 def essay_grade():
-    """論述問題の添削を行う"""
-    import PIL.Image
-    from google.genai import types  # 遅延インポート（メモリ節約）
+    """論述問題の添削を待ち行列に積む（結果は /api/essay/jobs/<job_id> で取得）"""
     if not GEMINI_API_KEY:
         return jsonify({'status': 'error', 'message': 'Gemini API key not configured'}), 500
 
@@ -15605,8 +17347,23 @@ def essay_grade():
     data = request.json
     if not data:
         return jsonify({'status': 'error', 'message': 'No data provided'}), 400
+
+    feedback_style = data.get('feedback_style', 'concise')
+    problem_id = data.get('problem_id')
+    user_answer = data.get('user_answer')
+    
+    if not problem_id or not user_answer:
+        return jsonify({'status': 'error', 'message': 'Missing problem_id or user_answer'}), 400
+
+    # 同じ答案の採点結果があれば即座に返す（チケットは消費しない）
+    cache_key = essay_grading_cache_key(problem_id, user_answer, feedback_style)
+    if not data.get('bypass_cache'):
+        cached = get_cached_essay_grading(cache_key)
+        if cached:
+            return jsonify(dict(cached, cached=True))
         
     # チケット消費チェック
+    user = None
     if 'user_id' in session and session['user_id']:
         user = User.query.get(session['user_id'])
         if user and not consume_ai_ticket(user):
@@ -15614,50 +17371,31 @@ def essay_grade():
                 'status': 'error', 
                 'message': '本日のAIチケットを使い切りました！\n残りの時間は自力で考えるか、先生に質問してみよう！'
             }), 403
-
-    feedback_style = data.get('feedback_style', 'concise')
-    problem_id = data.get('problem_id')
-    user_answer = data.get('user_answer')
-    
-    if not problem_id or not user_answer:
-        return jsonify({'status': 'error', 'message': 'Missing problem_id or user_answer'}), 400
     
-    # ====================================================================
-    # AI採点の同時実行制限（メモリクラッシュ防止）
-    # ====================================================================
-    # 現在処理中のAI採点が3件以上の場合は一時的に拒否
-    if not ai_grading_semaphore.acquire(blocking=False):
-        print(f"⚠️ AI採点制限: 同時実行数が上限に達しました（ユーザー: {session.get('username', 'unknown')}）")
-        
-        # 答案を一時的にセッションに保存（ユーザーがリロードしても失わないように）
-        try:
-            if 'user_id' in session and session['user_id']:
-                user = User.query.get(session['user_id'])
-                if user:
-                    # ユーザーの一時答案を保存（上書きOK）
-                    user.temp_answer_data = json.dumps({
-                        'problem_id': problem_id,
-                        'user_answer': user_answer,
-                        'feedback_style': feedback_style,
-                        'saved_at': datetime.now(JST).isoformat()
-                    })
-                    db.session.commit()
-                    print(f"✅ 答案を一時保存しました（ユーザーID: {user.id}）")
-        except Exception as save_error:
-            print(f"⚠️ 答案の一時保存に失敗: {save_error}")
-            db.session.rollback()
-        
-        return jsonify({
-            'status': 'busy',
-            'message': '現在、AI採点機能が混雑しています。答案は自動保存されました。30秒ほど待ってから「AI採点」ボタンを再度押してください。',
-            'retry_after': 30,
-            'answer_saved': True
-        }), 503  # Service Unavailable
+    # 同時実行数はワーカースレッド数で制限し、混雑時も拒否せず順番に処理する
+    job = enqueue_ai_grading_job('grade', session.get('user_id'), payload={
+        'problem_id': problem_id,
+        'user_answer': user_answer,
+        'feedback_style': feedback_style,
+        'cache_key': cache_key,
+        'ticket_consumed': user is not None  # 完了前に中断したら戻す
+    })
+    return jsonify(ai_grading_job_response(job)), 202
+
+def grade_essay_answer(problem_id, user_answer, feedback_style='concise', on_partial=None, should_cancel=None):
+    """
+    論述問題の添削を行う（ワーカースレッドから呼ばれる）。
+    戻り値は (レスポンス本体のdict, HTTPステータス)。
+    講評はストリーミングで受け取り、断片ごとに on_partial(それまでの全文) を呼ぶ。
+    should_cancel() が真になったら生成を打ち切る（クライアントが離れた場合）。
+    """
+    import PIL.Image
+    from google.genai import types  # 遅延インポート（メモリ節約）
 
     try:
         problem = EssayProblem.query.get(problem_id)
         if not problem:
-             return jsonify({'status': 'error', 'message': 'Problem not found'}), 404
+             return {'status': 'error', 'message': 'Problem not found'}, 404
 
 
         # ============================================================
@@ -15665,14 +17403,22 @@ def essay_grade():
         # ============================================================
         
         # 1. Initialize Textbook Manager
-        genai = get_genai_client()  # Needed for later model init
         tm = TextbookManager.get_instance()
         
-        # 2. Vector Search Retrieval (Cost: 0 Tokens for Selection!)
-        print("🔍 Searching textbook (Vector Search mode)...")
-        # Search using the question text
-        # Using 3 sections as requested (reduced from 5)
-        selected_titles = tm.search_relevant_sections(problem.question, top_k=3)
+        # 2. 事前計算した関連セクションを使う（未計算の問題のみベクトル検索 = 埋め込みAPIを呼ぶ）
+        selected_titles = problem.get_textbook_sections()
+        if selected_titles is None:
+            print("🔍 Searching textbook (Vector Search mode)...")
+            # Search using the question text
+            selected_titles, source = tm.retrieve_sections(problem.question, top_k=ESSAY_TEXTBOOK_SECTIONS_TOP_K)
+            if selected_titles and source != 'bm25':
+                # 次回以降の採点では検索を省略できるよう保存しておく（BM25のみの結果は一時的なものとして保存しない）
+                try:
+                    problem.set_textbook_sections(selected_titles)
+                    db.session.commit()
+                except Exception as e:
+                    print(f"⚠️ 関連セクションの保存に失敗: {e}")
+                    db.session.rollback()
         
         if not selected_titles:
              # Fallback logic if vector search fails (e.g., empty DB)
@@ -15687,9 +17433,8 @@ def essay_grade():
 
         # 4. Grading Step (Pro) - 高精度モデルで採点（したかった・・・）
         # Use gemini-flash-exp for cost performance
-        client = get_genai_client()
-        if not client:
-            return jsonify({'status': 'error', 'message': 'AI機能が利用できません'}), 503
+        if not AI_GATEWAY.available():
+            return {'status': 'error', 'message': 'AI機能が利用できません'}, 503
 
 
         # Clean user answer for accurate counting (Robust & Spaces Excluded)
@@ -15714,47 +17459,14 @@ def essay_grade():
 
         # Rewrite Length Check
         # =========================================================
-        # Priority 1: Extract from Question text (e.g., "100字以内で")
+        # Priority 1: Limits extracted from Question text (e.g., "100字以内で") - precomputed on save
         # Priority 2: Use problem.answer_length if valid
-        # Priority 3: Measure model answer length
-        target_len = 0 # Max length
-        min_limit_len = 0 # Min length (explicit)
-        
-        # 1. Regex Match from Question (Robust Logic)
-        limit_match_max = re.search(r'(\d+)字(?:以内|以下)', problem.question)
-        if limit_match_max:
-             target_len = int(limit_match_max.group(1))
-             print(f"INFO: Detected character limit (max) from Question: {target_len}")
-        
-        # Check for Explicit Minimum "XX字以上"
-        limit_match_min = re.search(r'(\d+)字以上', problem.question)
-        if limit_match_min:
-             min_limit_len = int(limit_match_min.group(1))
-             print(f"INFO: Detected character limit (min) from Question: {min_limit_len}")
-
-        # Fallback: Range "XX〜YY字" (Sets both min and max)
-        if target_len == 0:
-             limit_match_range = re.search(r'(\d+)[〜~-](\d+)字', problem.question)
-             if limit_match_range:
-                 min_limit_len = int(limit_match_range.group(1))
-                 target_len = int(limit_match_range.group(2))
-                 print(f"INFO: Detected character limit (range {min_limit_len}-{target_len}) from Question")
-
-        # Fallback: Heuristic "XX字" (ignoring "以上")
-        if target_len == 0:
-             # Find all candidates, ignore those followed by '以上' (already handled or valid max)
-             candidates = []
-             matches = re.finditer(r'(\d+)字(以上|程度)?', problem.question)
-             for m in matches:
-                 val = int(m.group(1))
-                 suffix = m.group(2)
-                 if suffix == '以上':
-                     continue # Skip, already checked in min logic or irrelevant for max fallback
-                 candidates.append(val)
-             
-             if candidates:
-                 target_len = max(candidates)
-                 print(f"INFO: Detected character limit (heuristic) from Question: {target_len}")
+        # Priority 3: Model answer length - precomputed on save
+        grading_metadata = problem.get_grading_metadata()
+        target_len = grading_metadata['grading_max_length'] # Max length
+        min_limit_len = grading_metadata['grading_min_length'] # Min length (explicit)
+        if target_len or min_limit_len:
+             print(f"INFO: Character limit from Question: max={target_len}, min={min_limit_len}")
         
         # 2. DB Value Fallback
         if target_len == 0 and isinstance(problem.answer_length, int) and problem.answer_length > 0:
@@ -15762,9 +17474,7 @@ def essay_grade():
 
         # 3. Model Answer Length Fallback
         if target_len == 0 and problem.answer:
-             # Strip HTML tags (like <u>) from model answer for accurate length calculation
-             match_clean_answer = strip_tags(problem.answer)
-             target_len = len(re.sub(r'\s+', '', match_clean_answer))
+             target_len = grading_metadata['model_answer_clean_length']
         
         # Default fallback
         if target_len == 0:
@@ -16002,50 +17712,36 @@ def essay_grade():
         )
 
         # === 頑健な生成ロジック (Model Fallback) ===
+        # 混雑・障害時は AI_GATEWAY が軽量モデルに切り替える。両方失敗したら外側のexceptへ
+        # 応答は断片ごとに受け取り、途中経過をポーリング側へ渡す（最初の断片から表示できる）
         response = None
-        current_model = 'gemini-3.5-flash'
-        
+        output_parts = []
         try:
-            print(f"🤖 User-AI Trying with Primary Model: {current_model}")
-            
-            # Debugging types before call
-            # print(f"DEBUG: content_parts types: {[type(x) for x in content_parts]}")
-            
-            response = client.models.generate_content(
-                model=current_model,
-                contents=content_parts,
-                config=generation_config
-            )
+            print(f"🤖 User-AI Trying with Primary Model: {AI_PRIMARY_MODEL}")
+            for chunk in AI_GATEWAY.generate_stream(
+                AI_PRIMARY_MODEL,
+                content_parts,
+                config=generation_config,
+                fallback_models=(AI_FALLBACK_MODEL,),
+                purpose='essay_grade'
+            ):
+                response = chunk  # finish_reason は最後の断片に付く
+                output_parts.append(chunk.text or '')
+                if on_partial:
+                    on_partial(''.join(output_parts).replace('```html', '').replace('```', ''))
+                if should_cancel and should_cancel():
+                    print("⚠️ クライアントが離れたためAI採点を中断しました")
+                    return ai_job_cancelled_response()
         except TypeError as te:
             print(f"❌ TypeError during generation: {te}")
             # 詳細なデバッグ情報を出力
             import traceback
             traceback.print_exc()
-            # print(f"DEBUG: content_parts: {content_parts}")
             raise te
-            
-        except Exception as e_primary:
-            error_str = str(e_primary)
-            if '429' in error_str or 'RESOURCE_EXHAUSTED' in error_str:
-                print(f"⚠️ Primary Model ({current_model}) Rate Limited. Switching to Fallback...")
-                try:
-                    current_model = 'gemini-3.1-flash-lite'
-                    print(f"🔄 User-AI Retry with Fallback Model: {current_model}")
-                    response = client.models.generate_content(
-                        model=current_model,
-                        contents=content_parts,
-                        config=generation_config
-                    )
-                    print(f"✅ Fallback Model ({current_model}) Succeeded!")
-                except Exception as e_secondary:
-                    print(f"❌ Fallback Model failed: {e_secondary}")
-                    raise e_secondary # フォールバックも失敗したら元のエラーフローへ
-            else:
-                raise e_primary # 429以外のエラーはそのままスロー
         
         # Debug Logging for Truncation/Safety
         try:
-            if response.candidates:
+            if response is not None and response.candidates:
                 candidate = response.candidates[0]
                 # print(f"DEBUG: Gen Finish Reason: {candidate.finish_reason}")
                 # print(f"DEBUG: Gen Safety Ratings: {candidate.safety_ratings}")
@@ -16059,11 +17755,10 @@ def essay_grade():
         
         # === Post-Processing: AI Auto-Repair for Length Constraint ===
         # Check if response has valid parts before accessing text
-        if not response.candidates or not response.candidates[0].content.parts:
-             print(f"ERROR: Gemini response contained no valid parts. Finish Reason: {response.candidates[0].finish_reason if response.candidates else 'Unknown'}")
-             return jsonify({'status': 'error', 'message': 'AIからの応答が空でした。再試行してください。'}), 500
-
-        final_output = response.text
+        final_output = ''.join(output_parts)
+        if not final_output.strip():
+             print(f"ERROR: Gemini response contained no valid parts. Finish Reason: {response.candidates[0].finish_reason if response is not None and response.candidates else 'Unknown'}")
+             return {'status': 'error', 'message': 'AIからの応答が空でした。再試行してください。'}, 500
         
         try:
              # Basic Cleaning first
@@ -16100,17 +17795,14 @@ def essay_grade():
                     """
                     
                     try:
-                        # Fix: Use client.models.generate_content instead of undefined 'model'
                         # Fix: Use types.GenerateContentConfig instead of dict
                         repair_config = types.GenerateContentConfig(
                             temperature=0.1, 
                             max_output_tokens=500
                         )
                         
-                        repair_response = client.models.generate_content(
-                            model='gemini-3.5-flash',
-                            contents=repair_prompt,
-                            config=repair_config
+                        repair_response = AI_GATEWAY.generate(
+                            AI_PRIMARY_MODEL, repair_prompt, config=repair_config, purpose='essay_grade_repair'
                         )
                         repaired_text = repair_response.text.strip()
                         
@@ -16165,23 +17857,23 @@ def essay_grade():
                 print(f"Prompt Feedback: {getattr(response, 'prompt_feedback', 'N/A')}")
                 if getattr(response, 'candidates', None):
                     print(f"Candidates: {response.candidates}")
-            return jsonify({'status': 'error', 'message': 'AIからの応答が取得できませんでした。時間をおいて再試行するか、入力内容を確認してください。'}), 500
+            return {'status': 'error', 'message': 'AIからの応答が取得できませんでした。時間をおいて再試行するか、入力内容を確認してください。'}, 500
         
-        return jsonify({'status': 'success', 'feedback': feedback})
+        return {'status': 'success', 'feedback': feedback}, 200
     
     except Exception as e:
         error_message = str(e)
         print(f"Grading Error: {error_message}")
         
-        # Gemini APIのレート制限エラー（429）を特別処理
-        if '429' in error_message or 'RESOURCE_EXHAUSTED' in error_message:
+        # Gemini APIのレート制限エラー（429）・障害による遮断中を特別処理
+        if is_ai_rate_limit_error(e):
             print(f"⚠️ Gemini APIレート制限に達しました")
-            return jsonify({
+            return {
                 'status': 'error',
                 'error_type': 'rate_limit',
                 'message': 'Gemini APIの使用量制限に達しました。数分待ってから再度お試しください。頻繁に発生する場合は、管理者にご連絡ください。',
                 'retry_after': 300  # 5分後に再試行を推奨
-            }), 429
+            }, 429
         
         # その他のAPIエラー
         try:
@@ -16195,59 +17887,298 @@ def essay_grade():
         except:
             pass
         
-        return jsonify({'status': 'error', 'message': f'エラーが発生しました: {error_message}'}), 500
+        return {'status': 'error', 'message': f'エラーが発生しました: {error_message}'}, 500
     
     finally:
-        # 必ずSemaphoreを解放（次のリクエストが処理できるように）
-        ai_grading_semaphore.release()
-        
         # Explicit Garbage Collection
         try:
              # Check if variables exist before deleting
              if 'content_parts' in locals(): del content_parts
              if 'response' in locals(): del response
+             if 'output_parts' in locals(): del output_parts
              if 'final_output' in locals(): del final_output
              if 'img_data' in locals(): del img_data
         except:
              pass
         
         gc.collect()
-        print("✅ AI採点スロット解放 (GC executed)")
+        print("✅ AI採点完了 (GC executed)")
+
+# ========================================
+# 論述問題公開設定 ヘルパー関数
+# ========================================
+def get_essay_visibility_matrix(room_number):
+    """
+    部屋の公開設定を {(chapter, problem_type): is_visible} の形で返す（キャッシュ対応）。
+    部屋の全設定を1回のSELECTで読み込むため、問題ごとのSQL発行が不要になる。
+    設定のない組み合わせはデフォルト公開として扱うこと。
+    """
+    cache_key = str(room_number)
+    current_time = time.time()
+    cached = ESSAY_VISIBILITY_CACHE.get(cache_key)
+    if cached and (current_time - cached['timestamp'] < CACHE_TTL):
+        return cached['data']
+
+    try:
+        with db.engine.connect() as conn:
+            rows = conn.execute(text("""
+                SELECT chapter, problem_type, is_visible
+                FROM essay_visibility_setting
+                WHERE room_number = :room_number
+            """), {'room_number': cache_key}).fetchall()
+    except Exception as e:
+        print(f"Error loading essay visibility matrix: {e}")
+        return {}  # エラー時はデフォルトで公開（キャッシュしない）
+
+    matrix = {(row[0], row[1]): bool(row[2]) for row in rows}
+
+    if len(ESSAY_VISIBILITY_CACHE) >= MAX_ROOM_SETTING_CACHE_SIZE and cache_key not in ESSAY_VISIBILITY_CACHE:
+        first_key = next(iter(ESSAY_VISIBILITY_CACHE))
+        ESSAY_VISIBILITY_CACHE.pop(first_key)
+
+    ESSAY_VISIBILITY_CACHE[cache_key] = {'data': matrix, 'timestamp': current_time}
+    return matrix
+
+def invalidate_essay_visibility_cache(room_number=None):
+    """公開設定の更新後に呼ぶ（room_number省略時は全部屋分を破棄）"""
+    if room_number is None:
+        ESSAY_VISIBILITY_CACHE.clear()
+    else:
+        ESSAY_VISIBILITY_CACHE.pop(str(room_number), None)
+    # 章別統計は公開設定に依存する
+    ESSAY_CHAPTER_STATS_CACHE.clear()
+
+def is_essay_problem_visible(room_number, chapter, problem_type):
+    """特定の部屋で論述問題が公開されているかチェック（キャッシュ済みの公開設定表を参照）"""
+    return get_essay_visibility_matrix(room_number).get((chapter, problem_type), True)
+
+# ========================================
+# 論述問題 全文検索インデックス（文字bigram）
+# ========================================
+def get_essay_search_index():
+    """
+    論述問題の文字bigram転置インデックスを返す（キャッシュ対応）。
+    分かち書き辞書を使わずに日本語の部分一致検索を絞り込むため、問題文・解答・大学名を
+    2文字ずつに分解して {bigram: (問題IDの昇順配列, 出現回数の配列)} を持つ。
+    BM25用に問題ごとのbigram数（文書長）も保持する。
+    問題の追加・編集・CSVアップロード時に invalidate_essay_search_index() で破棄し、次の検索時に再構築する。
+    構築に失敗した場合は None を返す（呼び出し側は通常の部分一致検索にフォールバックする）。
+    """
+    with ESSAY_SEARCH_INDEX_LOCK:
+        cached = ESSAY_SEARCH_INDEX.get('data')
+        if cached and (time.time() - ESSAY_SEARCH_INDEX['timestamp'] < ESSAY_SEARCH_INDEX_TTL):
+            return cached
+
+        try:
+            rows = db.session.query(
+                EssayProblem.id,
+                EssayProblem.university,
+                EssayProblem.question,
+                EssayProblem.answer
+            ).order_by(EssayProblem.id).yield_per(500)
+
+            postings = {}
+            doc_lengths = {}
+            for row in rows:
+                # フィールドをまたぐbigramを作らないよう個別に分解する
+                gram_counts = {}
+                for value in (row.university, row.question, row.answer):
+                    for gram in _essay_search_bigrams(_normalize_essay_search_text(value)):
+                        gram_counts[gram] = gram_counts.get(gram, 0) + 1
+                for gram, count in gram_counts.items():
+                    entry = postings.get(gram)
+                    if entry is None:
+                        entry = postings[gram] = (array('I'), array('H'))
+                    entry[0].append(row.id)  # ID順に読むので配列は昇順のまま
+                    entry[1].append(min(count, 65535))
+                doc_lengths[row.id] = sum(gram_counts.values())
+        except Exception as e:
+            print(f"Error building essay search index: {e}")
+            return None
+
+        doc_count = len(doc_lengths)
+        data = {
+            'postings': postings,
+            'doc_lengths': doc_lengths,
+            'doc_count': doc_count,
+            'avg_doc_length': (sum(doc_lengths.values()) / doc_count) if doc_count else 0.0
+        }
+        ESSAY_SEARCH_INDEX['data'] = data
+        ESSAY_SEARCH_INDEX['timestamp'] = time.time()
+        return data
+
+def invalidate_essay_search_index():
+    """論述問題の追加・編集・CSVアップロード後に呼ぶ"""
+    ESSAY_SEARCH_INDEX.clear()
+
+def search_essay_candidate_ids(term):
+    """
+    語を含む可能性のある問題IDの集合を返す（bigramの積集合）。
+    bigramが揃っていても連続して現れるとは限らないため、実際に含むかは呼び出し側で照合すること。
+    インデックスで絞り込めない場合（1文字の語・インデックス構築失敗）は None を返す。
+    """
+    normalized = _normalize_essay_search_text(term)
+    if len(normalized) < 2:
+        return None
+
+    index = get_essay_search_index()
+    if index is None:
+        return None
+
+    posting_lists = []
+    for gram in set(_essay_search_bigrams(normalized)):
+        entry = index['postings'].get(gram)
+        if not entry:
+            return set()
+        posting_lists.append(entry[0])
+
+    # 短い配列から積を取ると中間集合が小さく済む
+    posting_lists.sort(key=len)
+    candidates = set(posting_lists[0])
+    for ids in posting_lists[1:]:
+        candidates.intersection_update(ids)
+        if not candidates:
+            break
+    return candidates
+
+def rank_essays_bm25(query_text, candidate_ids=None, limit=15, k1=1.2, b=0.75):
+    """
+    全文検索インデックス上でBM25スコアを計算し、上位の問題IDを (id, score) のリストで返す。
+    query_text は空白区切りのキーワードで、各語をbigramに分解して採点する。
+    1文字の語（唐・宋など）はbigramにならないため、対象の問題の本文を読んで出現回数で採点する。
+    candidate_ids を渡すとその集合に含まれる問題だけを採点する（DB側の絞り込み結果）。
+    インデックスが使えない場合は None を返す。
+    """
+    index = get_essay_search_index()
+    if index is None:
+        return None
+
+    query_grams = {}
+    query_chars = {}
+    for term in re.split(r'[\s　]+', query_text or ''):
+        normalized = _normalize_essay_search_text(term)
+        if len(normalized) == 1:
+            query_chars[normalized] = query_chars.get(normalized, 0) + 1
+        for gram in _essay_search_bigrams(normalized):
+            query_grams[gram] = query_grams.get(gram, 0) + 1
+
+    doc_count = index['doc_count']
+    doc_lengths = index['doc_lengths']
+    avg_doc_length = index['avg_doc_length'] or 1.0
+    scores = {}
+
+    def add_scores(query_tf, doc_freq, problem_tfs):
+        idf = math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+        for problem_id, tf in problem_tfs:
+            if candidate_ids is not None and problem_id not in candidate_ids:
+                continue
+            norm = k1 * (1 - b + b * doc_lengths.get(problem_id, avg_doc_length) / avg_doc_length)
+            scores[problem_id] = scores.get(problem_id, 0.0) + query_tf * idf * tf * (k1 + 1) / (tf + norm)
+
+    for gram, query_tf in query_grams.items():
+        entry = index['postings'].get(gram)
+        if not entry:
+            continue
+        ids, tfs = entry
+        add_scores(query_tf, len(ids), zip(ids, tfs))
+
+    if query_chars:
+        char_tfs = {char: {} for char in query_chars}
+        text_query = db.session.query(
+            EssayProblem.id,
+            EssayProblem.university,
+            EssayProblem.question,
+            EssayProblem.answer
+        )
+        if candidate_ids is None:
+            chunks = [text_query.yield_per(500)]
+        else:
+            sorted_ids = sorted(candidate_ids)
+            chunks = (text_query.filter(EssayProblem.id.in_(sorted_ids[start:start + ESSAY_SEARCH_MAX_IN_IDS]))
+                      for start in range(0, len(sorted_ids), ESSAY_SEARCH_MAX_IN_IDS))
+        for rows in chunks:
+            for row in rows:
+                text = ''.join(_normalize_essay_search_text(value) for value in (row.university, row.question, row.answer))
+                for char, tfs in char_tfs.items():
+                    tf = text.count(char)
+                    if tf:
+                        tfs[row.id] = tf
+        # 出現問題数は採点対象の中で数える（全問題を読むと絞り込みの意味がない）
+        for char, tfs in char_tfs.items():
+            add_scores(query_chars[char], len(tfs), tfs.items())
+
+    # 同点は新しいID（後から追加された問題）を優先
+    ranked = sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)
+    return ranked[:limit]
+
+def search_essays_ranked(query_text, limit=50):
+    """
+    キーワード（空白区切りはAND）を含む有効な論述問題を関連度順に返す。
+    スコアは各語の出現回数とIDF（インデックス上の出現問題数）から計算し、大学名に一致した語は加点する。
+    戻り値は (id, chapter, university, year, type, question) を持つ行のリスト。
+    """
+    terms = [_normalize_essay_search_text(t) for t in re.split(r'[\s　]+', query_text or '')]
+    terms = [t for t in terms if t]
+    if not terms:
+        return []
+
+    candidate_ids = None
+    doc_freq = {}
+    for term in terms:
+        ids = search_essay_candidate_ids(term)
+        if ids is None:
+            continue  # 1文字の語は後段の照合のみで判定する
+        doc_freq[term] = len(ids)
+        candidate_ids = ids if candidate_ids is None else candidate_ids & ids
+        if not candidate_ids:
+            return []
 
-def is_essay_problem_visible_sql(room_number, chapter, problem_type):
-    """SQLベースの公開設定チェック（モデル問題回避版）"""
-    try:
-        with db.engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT is_visible 
-                FROM essay_visibility_setting 
-                WHERE room_number = :room_number 
-                AND chapter = :chapter 
-                AND problem_type = :problem_type
-            """), {
-                'room_number': room_number,
-                'chapter': chapter,
-                'problem_type': problem_type
-            })
-            
-            row = result.fetchone()
-            if row:
-                is_visible = row[0]
-                # print(f"📊 公開設定確認 - 部屋{room_number} 第{chapter}章 タイプ{problem_type}: {'公開' if is_visible else '非公開'}")
-                return is_visible
-            else:
-                # print(f"⚠️ 公開設定なし - 部屋{room_number} 第{chapter}章 タイプ{problem_type}: デフォルト公開")
-                return True  # 設定がない場合はデフォルトで公開
-    except Exception as e:
-        print(f"Error checking essay visibility (SQL): {e}")
-        return True  # エラー時はデフォルトで公開
+    base_query = db.session.query(
+        EssayProblem.id,
+        EssayProblem.chapter,
+        EssayProblem.university,
+        EssayProblem.year,
+        EssayProblem.type,
+        EssayProblem.question,
+        EssayProblem.answer
+    ).filter(EssayProblem.enabled == True)
+
+    if candidate_ids is None:
+        # インデックスが使えない場合は従来どおりDBの部分一致で探す
+        rows = base_query.filter(*[
+            db.or_(
+                EssayProblem.question.like(f'%{term}%'),
+                EssayProblem.answer.like(f'%{term}%'),
+                EssayProblem.university.like(f'%{term}%')
+            ) for term in terms
+        ]).all()
+    else:
+        rows = []
+        sorted_ids = sorted(candidate_ids)
+        for start in range(0, len(sorted_ids), ESSAY_SEARCH_MAX_IN_IDS):
+            chunk = sorted_ids[start:start + ESSAY_SEARCH_MAX_IN_IDS]
+            rows.extend(base_query.filter(EssayProblem.id.in_(chunk)).all())
+
+    index = get_essay_search_index()
+    total_docs = max(index['doc_count'] if index else len(rows), 1)
+
+    scored = []
+    for row in rows:
+        university = _normalize_essay_search_text(row.university)
+        body = _normalize_essay_search_text(row.question) + '\n' + _normalize_essay_search_text(row.answer)
+        score = 0.0
+        for term in terms:
+            tf = body.count(term)
+            in_university = term in university
+            if not tf and not in_university:
+                break
+            idf = math.log(1 + total_docs / max(doc_freq.get(term, total_docs), 1))
+            score += idf * ((1 + math.log(tf) if tf else 0) + (2 if in_university else 0))
+        else:
+            scored.append((score, row))
 
-# ========================================
-# 論述問題公開設定 ヘルパー関数
-# ========================================
-def is_essay_problem_visible(room_number, chapter, problem_type):
-    """特定の部屋で論述問題が公開されているかチェック（SQL版）"""
-    return is_essay_problem_visible_sql(room_number, chapter, problem_type)
+    scored.sort(key=lambda item: (item[0], item[1].year or 0), reverse=True)
+    return [row for _, row in scored[:limit]]
 
 def get_essay_visibility_settings(room_number):
     """部屋の論述問題公開設定を全て取得"""
@@ -16292,6 +18223,7 @@ def set_essay_visibility_setting(room_number, chapter, problem_type, is_visible)
             db.session.add(setting)
         
         db.session.commit()
+        invalidate_essay_visibility_cache(room_number)
         return True
         
     except Exception as e:
@@ -16323,6 +18255,12 @@ def get_filtered_essay_problems_with_visibility(chapter, room_number, type_filte
             query = query.filter(EssayProblem.year <= year_to)
         
         if keyword:
+            # 全文検索インデックスで候補を絞ってから部分一致で確定する
+            candidate_ids = search_essay_candidate_ids(keyword)
+            if candidate_ids is not None and len(candidate_ids) <= ESSAY_SEARCH_MAX_IN_IDS:
+                if not candidate_ids:
+                    return []
+                query = query.filter(EssayProblem.id.in_(candidate_ids))
             keyword_filter = f'%{keyword}%'
             query = query.filter(
                 db.or_(
@@ -16340,35 +18278,44 @@ def get_filtered_essay_problems_with_visibility(chapter, room_number, type_filte
         
         results = query.all()
         
-        # 結果を処理し、公開設定でフィルタリング
-        problems = []
-        for problem in results:
-            if not is_essay_problem_visible(room_number, problem.chapter, problem.type):
-                continue
-            
+        # 結果を処理し、公開設定でフィルタリング（部屋の公開設定は1回だけ取得）
+        visibility = get_essay_visibility_matrix(room_number)
+        problems = [p for p in results if visibility.get((p.chapter, p.type), True)]
+        
+        # 進捗情報は1回のクエリでまとめて取得し、問題IDで引く
+        progress_by_problem = {}
+        if user_id and problems:
+            try:
+                progress_rows = db.session.query(
+                    EssayProgress.problem_id,
+                    EssayProgress.viewed_answer,
+                    EssayProgress.understood,
+                    EssayProgress.difficulty_rating,
+                    EssayProgress.review_flag
+                ).filter(
+                    EssayProgress.user_id == user_id,
+                    EssayProgress.problem_id.in_([p.id for p in problems])
+                ).all()
+                progress_by_problem = {row.problem_id: row for row in progress_rows}
+            except Exception as progress_error:
+                print(f"Error getting essay progress for user {user_id}: {progress_error}")
+        
+        for problem in problems:
             progress_data = {
                 'viewed_answer': False, 'understood': False,
                 'difficulty_rating': None, 'review_flag': False
             }
             
-            if user_id:
-                try:
-                    progress = EssayProgress.query.filter_by(
-                        user_id=user_id, problem_id=problem.id
-                    ).first()
-                    
-                    if progress:
-                        progress_data.update({
-                            'viewed_answer': progress.viewed_answer,
-                            'understood': progress.understood,
-                            'difficulty_rating': progress.difficulty_rating,
-                            'review_flag': progress.review_flag
-                        })
-                except Exception as progress_error:
-                    print(f"Error getting progress for problem {problem.id}: {progress_error}")
+            progress = progress_by_problem.get(problem.id)
+            if progress:
+                progress_data.update({
+                    'viewed_answer': progress.viewed_answer,
+                    'understood': progress.understood,
+                    'difficulty_rating': progress.difficulty_rating,
+                    'review_flag': progress.review_flag
+                })
             
             problem.progress = progress_data
-            problems.append(problem)
         
         # print(f"📋 公開設定適用後の問題数: {len(problems)}件, 進捗情報付与完了")
         return problems
@@ -16377,77 +18324,74 @@ def get_filtered_essay_problems_with_visibility(chapter, room_number, type_filte
         print(f"Error getting filtered essay problems with visibility: {e}")
         return []
 
+def get_essay_chapter_progress_counts(user_id, room_number):
+    """
+    公開設定を考慮した章別の問題数と進捗数を1回の集計クエリで取得する（ユーザーごとに短時間キャッシュ）。
+    戻り値: {chapter: {'total': 問題数, 'touched': 進捗レコードのある問題数, 'viewed': 解答閲覧数, 'understood': 理解数}}
+    """
+    room_key = str(room_number)
+    current_time = time.time()
+    cached = ESSAY_CHAPTER_STATS_CACHE.get(user_id)
+    if cached and cached['room_number'] == room_key and (current_time - cached['timestamp'] < ESSAY_CHAPTER_STATS_TTL):
+        return cached['data']
+
+    # 公開設定がない組み合わせはデフォルト公開
+    rows = db.session.query(
+        EssayProblem.chapter,
+        func.count(EssayProblem.id).label('total_count'),
+        func.count(EssayProgress.id).label('touched_count'),
+        func.sum(case((EssayProgress.viewed_answer == True, 1), else_=0)).label('viewed_count'),
+        func.sum(case((EssayProgress.understood == True, 1), else_=0)).label('understood_count')
+    ).outerjoin(
+        EssayProgress,
+        db.and_(EssayProgress.problem_id == EssayProblem.id, EssayProgress.user_id == user_id)
+    ).outerjoin(
+        EssayVisibilitySetting,
+        db.and_(
+            EssayVisibilitySetting.room_number == room_key,
+            EssayVisibilitySetting.chapter == EssayProblem.chapter,
+            EssayVisibilitySetting.problem_type == EssayProblem.type
+        )
+    ).filter(
+        EssayProblem.enabled == True,
+        db.or_(EssayVisibilitySetting.is_visible.is_(None), EssayVisibilitySetting.is_visible == True)
+    ).group_by(EssayProblem.chapter).all()
+
+    counts = {
+        row.chapter: {
+            'total': int(row.total_count or 0),
+            'touched': int(row.touched_count or 0),
+            'viewed': int(row.viewed_count or 0),
+            'understood': int(row.understood_count or 0)
+        }
+        for row in rows
+    }
+
+    if len(ESSAY_CHAPTER_STATS_CACHE) >= MAX_ESSAY_CHAPTER_STATS_CACHE_SIZE and user_id not in ESSAY_CHAPTER_STATS_CACHE:
+        first_key = next(iter(ESSAY_CHAPTER_STATS_CACHE))
+        ESSAY_CHAPTER_STATS_CACHE.pop(first_key)
+
+    ESSAY_CHAPTER_STATS_CACHE[user_id] = {'room_number': room_key, 'data': counts, 'timestamp': current_time}
+    return counts
+
 def get_essay_chapter_stats_with_visibility(user_id, room_number):
-    """公開設定を考慮した章別統計情報を取得（進捗データ修正版）"""
+    """公開設定を考慮した章別統計情報を取得（集計クエリ1回）"""
     try:
-        # 1. 公開設定を考慮したすべての問題を取得
-        all_problems_query = db.session.query(
-            EssayProblem.chapter,
-            EssayProblem.type,
-            EssayProblem.id
-        ).filter(
-            EssayProblem.enabled == True
-        ).all()
+        counts = get_essay_chapter_progress_counts(user_id, room_number)
         
-        # 公開設定でフィルタリング
-        visible_problems = []
-        for problem in all_problems_query:
-            if is_essay_problem_visible(room_number, problem.chapter, problem.type):
-                visible_problems.append(problem)
-        
-        # 2. 章別に問題をグループ化
-        chapter_problems = {}
-        for problem in visible_problems:
-            if problem.chapter not in chapter_problems:
-                chapter_problems[problem.chapter] = []
-            chapter_problems[problem.chapter].append(problem.id)
-        
-        # 3. 各章の進捗データを取得
-        chapter_stats = {}
-        for chapter, problem_ids in chapter_problems.items():
-            # 該当章の進捗データを取得
-            progress_query = db.session.query(
-                func.count(EssayProgress.id).label('total_progress'),
-                func.sum(
-                    db.case(
-                        (EssayProgress.viewed_answer == True, 1),
-                        else_=0
-                    )
-                ).label('viewed_count'),
-                func.sum(
-                    db.case(
-                        (EssayProgress.understood == True, 1),
-                        else_=0
-                    )
-                ).label('understood_count')
-            ).filter(
-                EssayProgress.user_id == user_id,
-                EssayProgress.problem_id.in_(problem_ids)
-            ).first()
-            
-            total_problems = len(problem_ids)
-            viewed_problems = int(progress_query.viewed_count or 0)
-            understood_problems = int(progress_query.understood_count or 0)
-            
-            chapter_stats[chapter] = {
+        sorted_chapters = []
+        for chapter in sorted(counts.keys(), key=lambda x: (x != 'com', x)):
+            chapter_counts = counts[chapter]
+            total_problems = chapter_counts['total']
+            understood_problems = chapter_counts['understood']
+            sorted_chapters.append({
                 'chapter_name': '総合問題' if chapter == 'com' else f'第{chapter}章',
                 'total_problems': total_problems,
-                'viewed_problems': viewed_problems,
+                'viewed_problems': chapter_counts['viewed'],
                 'understood_problems': understood_problems,
-                'progress_rate': round((understood_problems / total_problems * 100) if total_problems > 0 else 0, 1)
-            }
-        
-        # 4. ソートして返す
-        sorted_chapters = []
-        for chapter_key in sorted(chapter_stats.keys(), key=lambda x: (x != 'com', x)):
-            chapter_data = chapter_stats[chapter_key]
-            chapter_data['chapter'] = chapter_key
-            sorted_chapters.append(chapter_data)
-        
-        # print(f"📊 章別統計（修正版）: {len(sorted_chapters)}章")
-        # for chapter_data in sorted_chapters:
-        #     print(f"  {chapter_data['chapter_name']}: 総数={chapter_data['total_problems']}, "
-        #           f"閲覧={chapter_data['viewed_problems']}, 理解={chapter_data['understood_problems']}")
+                'progress_rate': round((understood_problems / total_problems * 100) if total_problems > 0 else 0, 1),
+                'chapter': chapter
+            })
         
         return sorted_chapters
         
@@ -16455,6 +18399,7 @@ def get_essay_chapter_stats_with_visibility(user_id, room_number):
         print(f"Error getting essay chapter stats with visibility (fixed): {e}")
         import traceback
         traceback.print_exc()
+        db.session.rollback()
         return []
 
 # ========================================
@@ -16911,6 +18856,7 @@ def admin_save_essay_visibility_settings():
                             saved_count += 1
                 
                 conn.commit()
+                invalidate_essay_visibility_cache(room_number)
                 print(f"✅ 保存完了: 新規{saved_count}件, 更新{updated_count}件")
         
         except Exception as save_error:
@@ -17214,10 +19160,12 @@ def admin_add_map_image():
             genre_id=genre_id, 
             filename=unique_filename, 
             image_data=file_content, # Persistent BLOB
+            image_hash=hashlib.md5(file_content).hexdigest() if file_content else None,
             is_active=False
         )
         db.session.add(new_map)
         db.session.commit()
+        generate_image_variants('map', new_map.id)
         
         flash(f'地図「{name}」を追加しました', 'success')
         return redirect(url_for('admin_page', _anchor='section-map-quiz'))
@@ -17229,16 +19177,27 @@ def admin_add_map_image():
 
 @app.route('/serve_map_image/<path:filename>')
 def serve_map_image(filename):
-    # Try serving from DB first (Persistent)
-    map_obj = MapImage.query.filter_by(filename=filename).first()
-    if map_obj and map_obj.image_data:
-        import io
-        return send_file(
-            io.BytesIO(map_obj.image_data),
-            mimetype='image/png',
-            as_attachment=False,
-            download_name=map_obj.filename
+    """
+    地図画像を配信する
+    クエリの v が画像内容のハッシュと一致すれば immutable として長期キャッシュ
+    """
+    # Try serving from DB first (Persistent) - 画像バイナリは読み込まず、メタデータのみ取得
+    row = db.session.query(MapImage.id, MapImage.image_hash).filter(
+        MapImage.filename == filename, MapImage.image_data.isnot(None)
+    ).first()
+    if row:
+        map_id, image_hash = row
+        version = request.args.get('v')
+
+        def load_content():
+            return db.session.query(MapImage.image_data).filter(MapImage.id == map_id).scalar()
+
+        response = make_cached_image_response(
+            image_hash, mimetypes.guess_type(filename)[0] or 'image/png', load_content,
+            immutable=bool(version and image_hash and version == image_hash)
         )
+        if response is not None:
+            return response
         
     # Fallback to filesystem
     directory = os.path.join(app.root_path, 'uploads', 'maps')
@@ -17267,6 +19226,7 @@ def api_delete_map(map_id):
         if os.path.exists(file_path):
             os.remove(file_path)
         
+        delete_image_variants('map', map_obj.id)
         db.session.delete(map_obj)
         db.session.commit()
         return jsonify({'status': 'success'})
@@ -17588,6 +19548,7 @@ def api_crop_map_image(map_id):
             # CRITICAL_FIX: Read the file back and save to DB for persistence
             with open(new_file_path, 'rb') as f:
                 map_obj.image_data = f.read()
+            map_obj.image_hash = hashlib.md5(map_obj.image_data).hexdigest()
                 
             # Note: Commit happens later
             
@@ -17623,6 +19584,7 @@ def api_crop_map_image(map_id):
                 removed_count += 1
                 
         db.session.commit()
+        generate_image_variants('map', map_id)
         
         # Cleanup old file
         try:
@@ -17686,8 +19648,10 @@ def api_replace_map_image(map_id):
         old_filename = map_obj.filename
         map_obj.filename = new_filename
         map_obj.image_data = file_content # Save to DB!
+        map_obj.image_hash = hashlib.md5(file_content).hexdigest() if file_content else None
         
         db.session.commit()
+        generate_image_variants('map', map_obj.id)
         
         # Cleanup old file
         try:
@@ -18055,7 +20019,9 @@ def api_get_map_study_data(map_id):
 
     return jsonify({
         'status': 'success',
-        'map': {'id': map_obj.id, 'name': map_obj.name, 'filename': map_obj.filename},
+        'map': {'id': map_obj.id, 'name': map_obj.name, 'filename': map_obj.filename,
+                'image_url': image_variant_url('map', map_obj.id, map_obj.image_hash, 0) if map_obj.image_hash
+                             else map_image_url(map_obj.filename)},
         'locations': loc_data
     })
 
@@ -18109,7 +20075,9 @@ def api_get_map_play_data(map_id):
     
     return jsonify({
         'status': 'success',
-        'map': {'id': map_obj.id, 'name': map_obj.name, 'filename': map_obj.filename},
+        'map': {'id': map_obj.id, 'name': map_obj.name, 'filename': map_obj.filename,
+                'image_url': image_variant_url('map', map_obj.id, map_obj.image_hash, 0) if map_obj.image_hash
+                             else map_image_url(map_obj.filename)},
         'locations': [{'id': l.id, 'x': l.x_coordinate, 'y': l.y_coordinate, 'name': l.name, 'shape_type': getattr(l, 'shape_type', 'point'), 'radius': getattr(l, 'radius', 0), 'radius_x': getattr(l, 'radius_x', 0), 'radius_y': getattr(l, 'radius_y', 0), 'rotation': getattr(l, 'rotation', 0)} for l in locations],
         'problems': [{
             'id': p.id, 
@@ -18438,7 +20406,11 @@ def admin_essay_update_problem():
             else:
                 problem.answer_length = len(clean_answer)
         
+        problem.refresh_grading_metadata()
         db.session.commit()
+        invalidate_essay_search_index()
+        invalidate_essay_grading_cache(problem.id)
+        schedule_essay_textbook_mapping([problem.id])
         
         return jsonify({
             'status': 'success',
@@ -18603,6 +20575,7 @@ def admin_essay_add_problem():
             enabled=enabled,
             count_half_width_digits_as_half=count_half_width_digits_as_half
         )
+        new_problem.refresh_grading_metadata()
         
         db.session.add(new_problem)
         db.session.flush()  # IDを取得するためフラッシュ
@@ -18672,6 +20645,8 @@ def admin_essay_add_problem():
         
         # 全てをコミット
         db.session.commit()
+        invalidate_essay_search_index()
+        schedule_essay_textbook_mapping([new_problem.id])
         
         logger.info(f"論述問題追加成功: ID={new_problem.id}, 画像={image_saved}")
         
@@ -18737,6 +20712,7 @@ def admin_essay_upload_csv():
             EssayProblem.query.delete()
             EssayProgress.query.delete()  # 関連する進捗も削除
             db.session.commit()
+            invalidate_essay_grading_cache()
             logger.info("既存の論述問題を全削除しました")
         
         # CSVファイルを読み込み
@@ -18788,6 +20764,7 @@ def admin_essay_upload_csv():
         updated_count = 0
         error_count = 0
         error_details = []
+        saved_problems = []  # 関連セクション計算の対象
         
         for row_num, row in enumerate(csv_reader, start=2):  # ヘッダーを除いて2行目から
             try:
@@ -18860,6 +20837,8 @@ def admin_essay_upload_csv():
                     existing_problem.enabled = enabled
                     if image_url: # 画像URLが指定されている場合のみ更新
                         existing_problem.image_url = image_url
+                    existing_problem.refresh_grading_metadata()
+                    saved_problems.append(existing_problem)
                     
                     updated_count += 1
                     logger.info(f"問題更新: ID={existing_problem.id}, 章={chapter}")
@@ -18877,6 +20856,8 @@ def admin_essay_upload_csv():
                         enabled=enabled,
                         image_url=image_url if image_url else None
                     )
+                    new_problem.refresh_grading_metadata()
+                    saved_problems.append(new_problem)
                     
                     db.session.add(new_problem)
                     added_count += 1
@@ -18893,6 +20874,11 @@ def admin_essay_upload_csv():
         if added_count > 0 or updated_count > 0:
             try:
                 db.session.commit()
+                invalidate_essay_search_index()
+                for problem in saved_problems:
+                    invalidate_essay_grading_cache(problem.id)
+                # 問題文が変わっていないものは map_essay_problems_to_textbook 側で飛ばす
+                schedule_essay_textbook_mapping([problem.id for problem in saved_problems])
                 logger.info(f"論述問題 追加{added_count}件/更新{updated_count}件 を保存しました")
             except Exception as commit_error:
                 db.session.rollback()
@@ -19018,6 +21004,9 @@ def admin_essay_delete_problem():
         # メイン問題を削除
         db.session.delete(problem)
         db.session.commit()
+        invalidate_essay_search_index()
+        # IDが再利用されると別の問題の講評を返しかねないため、全件破棄する
+        invalidate_essay_grading_cache()
         
         return jsonify({
             'status': 'success',
@@ -19127,10 +21116,13 @@ def add_essay_problem():
             answer_length=answer_length,
             enabled=bool(data.get('enabled', True))
         )
+        new_problem.refresh_grading_metadata()
         
         # データベースに保存
         db.session.add(new_problem)
         db.session.commit()
+        invalidate_essay_search_index()
+        schedule_essay_textbook_mapping([new_problem.id])
         
         app.logger.info(f"論述問題を追加しました: ID={new_problem.id}, 大学={new_problem.university}, 年={new_problem.year}")
         
@@ -19201,9 +21193,12 @@ def edit_essay_problem(problem_id):
         
         # 更新日時を設定
         problem.updated_at = datetime.utcnow()
+        problem.refresh_grading_metadata()
         
         # データベースに保存
         db.session.commit()
+        invalidate_essay_search_index()
+        invalidate_essay_grading_cache(problem_id)
         
         app.logger.info(f"論述問題を更新しました: ID={problem_id}")
         
@@ -19229,35 +21224,38 @@ def edit_essay_problem(problem_id):
         }), 500
     
 @app.route('/essay_image/<int:problem_id>')
-def essay_image(problem_id):
-    """データベースから論述問題の画像を取得"""
+@app.route('/essay_image/<int:problem_id>/<string:version>')
+def essay_image(problem_id, version=None):
+    """
+    データベースから論述問題の画像を取得
+    version: 画像内容のハッシュ（一致すれば immutable として長期キャッシュ）
+    """
     try:
-        from flask import Response, abort  # ← ここでも局所的にインポート可能
-        
-        essay_image = EssayImage.query.filter_by(problem_id=problem_id).first()
-        
-        if not essay_image:
-            app.logger.warning(f"画像が見つかりません: problem_id={problem_id}")
-            abort(404)
-        
-        # バイナリデータからレスポンスを作成
-        mimetype = f'image/{essay_image.image_format.lower()}'
-        
-        app.logger.info(f"画像を配信: problem_id={problem_id}, format={essay_image.image_format}, size={len(essay_image.image_data)}bytes")
-        
-        return Response(
-            essay_image.image_data,
-            mimetype=mimetype,
-            headers={
-                'Content-Disposition': f'inline; filename=essay_{problem_id}.{essay_image.image_format.lower()}',
-                'Cache-Control': 'public, max-age=31536000'
-            }
-        )
-        
+        # 画像バイナリは読み込まず、メタデータのみ取得
+        row = db.session.query(EssayImage.image_format, EssayImage.image_hash).filter(
+            EssayImage.problem_id == problem_id
+        ).first()
+        response = None
+        if row:
+            image_format, image_hash = row
+
+            def load_content():
+                return db.session.query(EssayImage.image_data).filter(EssayImage.problem_id == problem_id).scalar()
+
+            response = make_cached_image_response(
+                image_hash, IMAGE_FORMAT_MIMETYPES.get(image_format.upper(), 'image/png'), load_content,
+                immutable=bool(version and image_hash and version == image_hash)
+            )
     except Exception as e:
         app.logger.error(f"画像配信エラー: problem_id={problem_id}, error={str(e)}")
         abort(500)
 
+    if response is None:
+        app.logger.warning(f"画像が見つかりません: problem_id={problem_id}")
+        abort(404)
+    response.headers.set('Content-Disposition', f'inline; filename=essay_{problem_id}.{image_format.lower()}')
+    return response
+
 # ========================================
 # API エンドポイント
 # ========================================
@@ -19321,6 +21319,7 @@ def update_essay_progress():
         progress.last_updated = now
         
         db.session.commit()
+        ESSAY_CHAPTER_STATS_CACHE.pop(current_user.id, None)
         
         return jsonify({
             'status': 'success',
@@ -19638,6 +21637,15 @@ def has_essay_image(problem_id):
     essay_image = EssayImage.query.filter_by(problem_id=problem_id).first()
     return essay_image is not None
 
+@app.template_global()
+def essay_image_src(problem_id):
+    """テンプレートから論述問題画像のバージョン付きURLを取得（画像がなければNone）"""
+    row = db.session.query(EssayImage.image_hash).filter(EssayImage.problem_id == problem_id).first()
+    return essay_image_url(problem_id, row.image_hash) if row else None
+
+app.add_template_global(essay_image_url)
+app.add_template_global(correction_image_url)
+
 @app.context_processor
 def inject_room_settings():
     """テンプレートで部屋設定（論述特化など）を利用可能にする"""
@@ -21822,37 +23830,64 @@ def find_related_essays():
     if not user:
         return jsonify({'status': 'error', 'message': 'ユーザーが見つかりません'}), 404
 
+    # 短すぎる単語や一般的すぎる単語を除外
+    stop_words = {'年', '月', '日', 'の', 'は', 'が', 'を'}
+    keywords = [k for k in keywords if k and len(k) > 1 and k not in stop_words]
+
+    # 全文検索インデックスでキーワードを含みうる問題に絞る（いずれかのキーワードを含めばよい）
+    candidate_ids = set()
+    for keyword in keywords:
+        ids = search_essay_candidate_ids(keyword)
+        if ids is None:
+            candidate_ids = None
+            break
+        candidate_ids |= ids
+    if candidate_ids is not None and not candidate_ids:
+        return jsonify({'essays': []})
+
     # 公開設定を考慮した、全ての章の問題を取得
-    visible_problems = get_filtered_essay_problems_with_visibility(
-        chapter=None,
-        room_number=user.room_number,
-        user_id=user.id
+    # 進捗情報は不要なので、必要な列だけを取得する軽量版を使う
+    visibility = get_essay_visibility_matrix(user.room_number)
+    candidate_query = db.session.query(
+        EssayProblem.id,
+        EssayProblem.chapter,
+        EssayProblem.type,
+        EssayProblem.university,
+        EssayProblem.year,
+        EssayProblem.question,
+        EssayProblem.answer
+    ).filter(
+        EssayProblem.enabled == True
     )
+    if candidate_ids is not None and len(candidate_ids) <= ESSAY_SEARCH_MAX_IN_IDS:
+        candidate_query = candidate_query.filter(EssayProblem.id.in_(candidate_ids))
+    candidate_rows = candidate_query.order_by(
+        EssayProblem.type,
+        EssayProblem.year.desc(),
+        EssayProblem.university
+    ).all()
+    visible_problems = [p for p in candidate_rows if visibility.get((p.chapter, p.type), True)]
 
     # 関連問題をフィルタリング
     related_essays = []
     found_ids = set() # 重複を防ぐためのセット
-    
-    # 短すぎる単語や一般的すぎる単語を除外
-    stop_words = {'年', '月', '日', 'の', 'は', 'が', 'を'}
 
     for problem in visible_problems:
         for keyword in keywords:
-            if keyword and len(keyword) > 1 and keyword not in stop_words:
-                if (keyword in problem.question or keyword in problem.answer) and problem.id not in found_ids:
-                    # 問題文からHTMLタグ、改行、余分な空白を削除してスニペットを作成
-                    clean_question = re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', '', problem.question)).strip()
-                    related_essays.append({
-                        'id': problem.id,
-                        'university': problem.university,
-                        'year': problem.year,
-                        'type': problem.type,
-                        'question_snippet': (clean_question[:50] + '...') if len(clean_question) > 50 else clean_question,
-                        'chapter': problem.chapter
-                    })
-                    found_ids.add(problem.id)
-                    # 一致する問題が見つかったら、この問題に対するキーワード検索は終了
-                    break
+            if (keyword in problem.question or keyword in problem.answer) and problem.id not in found_ids:
+                # 問題文からHTMLタグ、改行、余分な空白を削除してスニペットを作成
+                clean_question = re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', '', problem.question)).strip()
+                related_essays.append({
+                    'id': problem.id,
+                    'university': problem.university,
+                    'year': problem.year,
+                    'type': problem.type,
+                    'question_snippet': (clean_question[:50] + '...') if len(clean_question) > 50 else clean_question,
+                    'chapter': problem.chapter
+                })
+                found_ids.add(problem.id)
+                # 一致する問題が見つかったら、この問題に対するキーワード検索は終了
+                break
 
     # --- ▼ここが優先順位付けのロジックです▼ ---
     # 1. 解いた問題と同じ章かどうか (True=1, False=0)
@@ -22109,15 +24144,16 @@ def get_rpg_status():
     
     balance_score = user_stats.balance_score if user_stats else 0
     # Removed hardcoded check for < 1000. RPG availability now depends on boss availability.
-         
-    rpg_state = RpgState.query.filter_by(user_id=user_id).first()
-    
+
+    # RpgStateはキャッシュ経由（撃破・挑戦時に破棄される）
+    rpg_user_state = get_rpg_user_state_cached(user_id)
+
     # クールタイム判定
     is_cooldown = False
     next_challenge_time = None
 
-    if rpg_state and rpg_state.last_challenge_at:
-        last_challenge = rpg_state.last_challenge_at
+    if rpg_user_state['last_challenge_at']:
+        last_challenge = rpg_user_state['last_challenge_at']
         current_time = datetime.now(JST)
         
         last_logic_date = get_logic_date(last_challenge)
@@ -22136,78 +24172,166 @@ def get_rpg_status():
                 
             next_challenge_time = next_7am.strftime('%Y-%m-%d %H:%M:%S')
             
-    # 現在のボスを判定
-    target_boss = get_current_boss(user_id, rpg_state)
+    # 現在のボスを判定（ボス一覧はキャッシュから）
+    target_boss = find_current_boss_entry(balance_score, rpg_user_state['cleared_stages'])
     # print(f"DEBUG_RPG: user={user_id}, score={balance_score}, target={target_boss}, cooldown={is_cooldown}")
-    
+
     # ターゲットが存在するか確認
     is_cleared = False
     if target_boss:
         # 撃破済み判定を型に依存しないよう文字列に統一して行う
-        cleared_ids = {str(sid) for sid in rpg_state.cleared_stages} if rpg_state else set()
-        is_cleared = str(target_boss.id) in cleared_ids
-        
+        is_cleared = str(target_boss['id']) in rpg_user_state['cleared_stages']
+
     if not target_boss:
         return jsonify({'available': False, 'reason': 'no_boss_found', 'current_score': balance_score})
-    
+
     # ストリークボーナスの計算
     streak = calculate_user_streak(user_id)
     bonus_percentage = min(streak * 0.01, 0.30)
-    bonus_time_seconds = int(target_boss.time_limit * bonus_percentage)
-    total_time_limit = target_boss.time_limit + bonus_time_seconds
-    
+    bonus_time_seconds = int(target_boss['time_limit'] * bonus_percentage)
+    total_time_limit = target_boss['time_limit'] + bonus_time_seconds
+
     return jsonify({
         'available': not is_cooldown, # クールダウン中でなければバナーを出す
         'is_cooldown': is_cooldown,
         'next_challenge_time': next_challenge_time,
-        'is_cleared': is_cleared, 
-        'current_stage': target_boss.id,
-        'boss_name': target_boss.name,
-        'boss_icon': url_for('serve_rpg_image', enemy_id=target_boss.id, image_type='icon'),
-        'difficulty': target_boss.difficulty,
-        'intro_dialogue': target_boss.intro_dialogue,
+        'is_cleared': is_cleared,
+        'current_stage': target_boss['id'],
+        'boss_name': target_boss['name'],
+        'boss_icon': rpg_image_url(target_boss['id'], 'icon', target_boss['icon_image_hash']),
+        'difficulty': target_boss['difficulty'],
+        'intro_dialogue': target_boss['intro_dialogue'],
         'time_limit': total_time_limit,
-        'base_time_limit': target_boss.time_limit,
+        'base_time_limit': target_boss['time_limit'],
         'bonus_time_seconds': bonus_time_seconds,
         'streak': streak,
-        'clear_correct_count': target_boss.clear_correct_count,
-        'clear_max_mistakes': target_boss.clear_max_mistakes,
+        'clear_correct_count': target_boss['clear_correct_count'],
+        'clear_max_mistakes': target_boss['clear_max_mistakes'],
         'current_score': balance_score
     })
 
+def get_rpg_boss_ladder():
+    """
+    有効なボスを出現必要スコア昇順に並べた一覧（キャッシュ）を返す。
+    敵キャラは管理画面からしか変更されないため、追加・編集・削除時に破棄する。
+    """
+    ladder = RPG_BOSS_LADDER_CACHE.get('bosses')
+    if ladder is not None:
+        return RPG_BOSS_LADDER_CACHE['scores'], ladder
+
+    # 画像BLOBは読み込まない（必要な列のみ取得）
+    rows = db.session.query(
+        RpgEnemy.id, RpgEnemy.name, RpgEnemy.difficulty, RpgEnemy.intro_dialogue,
+        RpgEnemy.time_limit, RpgEnemy.clear_correct_count, RpgEnemy.clear_max_mistakes,
+        RpgEnemy.display_order, RpgEnemy.appearance_required_score, RpgEnemy.is_active,
+        RpgEnemy.icon_image_hash
+    ).filter(RpgEnemy.is_active == True).order_by(RpgEnemy.appearance_required_score, RpgEnemy.id).all()
+
+    ladder = [{
+        'id': r.id,
+        'name': r.name,
+        'difficulty': r.difficulty,
+        'intro_dialogue': r.intro_dialogue,
+        'time_limit': r.time_limit,
+        'clear_correct_count': r.clear_correct_count,
+        'clear_max_mistakes': r.clear_max_mistakes,
+        'display_order': r.display_order or 0,
+        'appearance_required_score': r.appearance_required_score or 0,
+        'is_active': r.is_active,
+        'icon_image_hash': r.icon_image_hash
+    } for r in rows]
+    scores = [b['appearance_required_score'] for b in ladder]
+
+    RPG_BOSS_LADDER_CACHE['scores'] = scores
+    RPG_BOSS_LADDER_CACHE['bosses'] = ladder
+    return scores, ladder
+
+def invalidate_rpg_boss_ladder():
+    RPG_BOSS_LADDER_CACHE.clear()
+
+def get_rpg_user_state_cached(user_id):
+    """ユーザーのRPG進行状況（撃破済みID・最終挑戦日時）をキャッシュ経由で取得する"""
+    current_time = time.time()
+    cached = RPG_USER_STATE_CACHE.get(user_id)
+    if cached and (current_time - cached['timestamp'] < CACHE_TTL):
+        return cached
+
+    rpg_state = RpgState.query.filter_by(user_id=user_id).first()
+    cached = {
+        # 撃破済み判定を型に依存しないよう文字列に統一
+        'cleared_stages': frozenset(str(sid) for sid in (rpg_state.cleared_stages or [])) if rpg_state else frozenset(),
+        'last_challenge_at': rpg_state.last_challenge_at if rpg_state else None,
+        'timestamp': current_time
+    }
+
+    if len(RPG_USER_STATE_CACHE) >= MAX_RPG_USER_STATE_CACHE_SIZE and user_id not in RPG_USER_STATE_CACHE:
+        first_key = next(iter(RPG_USER_STATE_CACHE))
+        RPG_USER_STATE_CACHE.pop(first_key)
+
+    RPG_USER_STATE_CACHE[user_id] = cached
+    return cached
+
+def invalidate_rpg_user_state(user_id=None):
+    """RpgState更新後に呼ぶ（user_id省略時は全ユーザー分を破棄）"""
+    if user_id is None:
+        RPG_USER_STATE_CACHE.clear()
+    else:
+        RPG_USER_STATE_CACHE.pop(user_id, None)
+
+def find_current_boss_entry(current_score, cleared_stages):
+    """
+    出現必要スコアを満たす有効ボスのうち、未クリアでdisplay_orderが最小のものを返す。
+    cleared_stages は文字列化したボスIDの集合。
+    """
+    scores, ladder = get_rpg_boss_ladder()
+
+    # 条件: 出現必要スコアを満たしていること (balance_score >= appearance_required_score)
+    unlocked_count = bisect.bisect_right(scores, current_score)
+
+    target = None
+    for boss in ladder[:unlocked_count]:
+        if str(boss['id']) in cleared_stages:
+            continue
+        if target is None or (boss['display_order'], boss['id']) < (target['display_order'], target['id']):
+            target = boss
+    return target
+
 def get_current_boss(user_id, rpg_state=None):
     """
     ユーザーの現在のスコアに基づいて出現すべきボスを判定する
     """
     if not rpg_state:
         rpg_state = RpgState.query.filter_by(user_id=user_id).first()
-        
+
     # use balance_score instead of monthly total score
     user_stats = UserStats.query.filter_by(user_id=user_id).first()
     current_score = user_stats.balance_score if user_stats else 0
-    
+
     cleared_stages = {str(sid) for sid in (rpg_state.cleared_stages if rpg_state else [])}
-    
-    # 条件1: 有効(is_active)であること
-    # 条件2: 出現必要スコアを満たしていること (balance_score >= appearance_required_score)
-    candidates = RpgEnemy.query.filter(
-        RpgEnemy.is_active == True,
-        RpgEnemy.appearance_required_score <= current_score
-    ).order_by(RpgEnemy.display_order).all()
-    
-    if not candidates:
+
+    entry = find_current_boss_entry(current_score, cleared_stages)
+    if not entry:
+        # 全てクリア済み、または出現条件を満たすボスなし
         return None
-        
-    # 未クリアのボスの中で、display_order順に最初のボスを選択
-    for enemy in candidates:
-        if str(enemy.id) not in cleared_stages:
-            return enemy
-            
-    # 全てクリア済み
-    return None
+    return RpgEnemy.query.get(entry['id'])
 
 def calculate_user_streak(user_id):
     """ユーザーの「今日の10問」の連続クリア日数（ストリーク）を計算する"""
+    today = get_logic_date(datetime.now(JST))
+    current_time = time.time()
+    cached = STREAK_CACHE.get(user_id)
+    if cached and cached['logic_date'] == today and (current_time - cached['timestamp'] < CACHE_TTL):
+        return cached['streak']
+
+    streak = _calculate_user_streak_uncached(user_id, today)
+
+    if len(STREAK_CACHE) >= MAX_RPG_USER_STATE_CACHE_SIZE and user_id not in STREAK_CACHE:
+        first_key = next(iter(STREAK_CACHE))
+        STREAK_CACHE.pop(first_key)
+    STREAK_CACHE[user_id] = {'logic_date': today, 'streak': streak, 'timestamp': current_time}
+    return streak
+
+def _calculate_user_streak_uncached(user_id, today):
     results = db.session.query(DailyQuiz.date)\
         .join(DailyQuizResult, DailyQuiz.id == DailyQuizResult.quiz_id)\
         .filter(DailyQuizResult.user_id == user_id)\
@@ -22219,7 +24343,6 @@ def calculate_user_streak(user_id):
         return 0
         
     dates = [r[0] for r in results]
-    today = get_logic_date(datetime.now(JST))
     
     streak = 0
     
@@ -22244,6 +24367,114 @@ def calculate_user_streak(user_id):
             
     return streak
 
+def get_rpg_problem_pool(room_number, word_data, room_setting):
+    """
+    RPGで出題可能な問題（Z問題以外・CSVで有効・部屋設定で公開中）と解答候補一覧を返す。
+    プールはword_dataを保持するWORD_DATA_CACHEのエントリに部屋ごとに保存するので、
+    CSVの再読込・キャッシュからの追い出しと一緒に破棄される（単語リストを余分に抱え込まない）。
+    """
+    if room_setting:
+        version = (room_setting.csv_filename, room_setting.updated_at,
+                   room_setting.max_enabled_unit_number, room_setting.enabled_units)
+    else:
+        version = None
+
+    # キャッシュ外のword_data（フォールバック読込など）はプールも保存しない
+    entry = next((e for e in list(WORD_DATA_CACHE.values()) if e['data'] is word_data), None)
+    pools = entry.setdefault('rpg_pools', {}) if entry is not None else {}
+    cached = pools.get(room_number)
+    if cached and cached['version'] == version:
+        return cached['pool'], cached['all_answers']
+
+    pool = []
+    for word in word_data:
+        # Z問題除外
+        if str(word.get('number', '')).upper() == 'Z':
+            continue
+
+        # ヘルパー関数を使用して厳密にチェック（enabled_units対応）
+        if word['enabled'] and is_unit_enabled_by_room_setting(word['number'], room_setting):
+            pool.append(word)
+
+    all_answers = list(set(w['answer'] for w in word_data if w.get('answer')))
+
+    if len(pools) >= MAX_RPG_PROBLEM_POOL_CACHE_SIZE and room_number not in pools:
+        first_key = next(iter(pools))
+        pools.pop(first_key)
+
+    pools[room_number] = {
+        'version': version,
+        'pool': pool,
+        'all_answers': all_answers
+    }
+    return pool, all_answers
+
+def create_rpg_battle(user_id, answers, stage_id):
+    """ボス戦の状態をDBに保存し、戦闘IDを返す"""
+    now = datetime.utcnow()
+    battle_id = uuid.uuid4().hex
+    expires_at = now + timedelta(seconds=RPG_BATTLE_TTL)
+
+    # 期限切れの戦闘を掃除
+    RpgBattle.query.filter(RpgBattle.expires_at <= now).delete(synchronize_session=False)
+    db.session.add(RpgBattle(battle_id=battle_id, user_id=user_id, stage_id=stage_id,
+                             answers=answers, expires_at=expires_at))
+    db.session.commit()
+
+    with RPG_BATTLE_STORE_LOCK:
+        expired = [bid for bid, b in RPG_BATTLE_STORE.items() if b['expires_at'] <= now]
+        for bid in expired:
+            RPG_BATTLE_STORE.pop(bid, None)
+        RPG_BATTLE_STORE[battle_id] = {
+            'user_id': user_id,
+            'answers': answers,
+            'stage_id': stage_id,
+            'expires_at': expires_at
+        }
+    return battle_id
+
+def get_rpg_battle(battle_id, user_id):
+    """
+    有効期限内かつ本人の戦闘データ（正解リスト・ステージID）を返す（なければNone）。
+    正誤数は含まない（get_rpg_battle_score 参照）。メモリになければ（再起動後など）DBから読み直す。
+    """
+    if not battle_id:
+        return None
+    battle = RPG_BATTLE_STORE.get(battle_id)
+    if battle is None:
+        row = RpgBattle.query.filter_by(battle_id=battle_id).first()
+        if not row:
+            return None
+        battle = {
+            'user_id': row.user_id,
+            'answers': row.answers,
+            'stage_id': row.stage_id,
+            'expires_at': row.expires_at
+        }
+        with RPG_BATTLE_STORE_LOCK:
+            RPG_BATTLE_STORE[battle_id] = battle
+    if battle['user_id'] != user_id or battle['expires_at'] <= datetime.utcnow():
+        return None
+    return battle
+
+def record_rpg_battle_answer(battle_id, is_correct):
+    """正誤数をDB上で加算する（同時に届いた回答も取りこぼさない）"""
+    column = RpgBattle.correct_count if is_correct else RpgBattle.incorrect_count
+    RpgBattle.query.filter_by(battle_id=battle_id).update({column: column + 1}, synchronize_session=False)
+    db.session.commit()
+
+def get_rpg_battle_score(battle_id):
+    """(正解数, 不正解数) を返す（戦闘がなければNone）"""
+    row = db.session.query(RpgBattle.correct_count, RpgBattle.incorrect_count).filter_by(battle_id=battle_id).first()
+    return (row.correct_count, row.incorrect_count) if row else None
+
+def discard_rpg_battle(battle_id):
+    if battle_id:
+        with RPG_BATTLE_STORE_LOCK:
+            RPG_BATTLE_STORE.pop(battle_id, None)
+        RpgBattle.query.filter_by(battle_id=battle_id).delete(synchronize_session=False)
+        db.session.commit()
+
 @app.route('/api/rpg/start', methods=['POST'])
 def start_rpg_battle():
     if 'user_id' not in session:
@@ -22255,25 +24486,13 @@ def start_rpg_battle():
     
     # 問題データロード
     word_data = load_word_data_for_room(room_number)
-    
-    # Z問題以外、かつ有効な問題をフィルタリング
-    valid_problems = []
-    
+
     # RoomSettingから有効な単元を取得
     room_setting = RoomSetting.query.filter_by(room_number=room_number).first()
-    
-    for word in word_data:
-        # Z問題除外
-        if str(word.get('number', '')).upper() == 'Z':
-            continue
-            
-        is_word_enabled_in_csv = word['enabled']
-        # 修正: ヘルパー関数を使用して厳密にチェック（enabled_units対応）
-        is_unit_valid = is_unit_enabled_by_room_setting(word['number'], room_setting)
-        
-        if is_word_enabled_in_csv and is_unit_valid:
-            valid_problems.append(word)
-            
+
+    # Z問題以外、かつ有効な問題（部屋ごとにキャッシュ）
+    valid_problems, all_answers = get_rpg_problem_pool(room_number, word_data, room_setting)
+
     if len(valid_problems) < 10:
         return jsonify({'status': 'error', 'message': '出題可能な問題が少なすぎます（10問以上必要）'}), 400
         
@@ -22324,6 +24543,7 @@ def start_rpg_battle():
         if target_boss:
             rpg_state.last_challenge_at = current_time
             db.session.commit()
+            invalidate_rpg_user_state(user_id)
     
     if not target_boss:
         return jsonify({'status': 'error', 'message': '現在挑戦できるボスはいません。学習を進めてスコアを貯めましょう！'}), 404
@@ -22331,7 +24551,6 @@ def start_rpg_battle():
     # ランダムに30問選択
     sample_size = min(len(valid_problems), 30)
     selected_problems_data = random.sample(valid_problems, sample_size)
-    all_answers = list(set(w['answer'] for w in word_data if w.get('answer')))
 
     final_problems = []
     for i, problem in enumerate(selected_problems_data):
@@ -22363,11 +24582,14 @@ def start_rpg_battle():
             'choices': choices
         })
     
-    session['rpg_battle_pids'] = [get_problem_id(p) for p in selected_problems_data]
-    session['rpg_correct_count'] = 0
-    session['rpg_incorrect_count'] = 0
-    session['rpg_battle_stage_id'] = target_boss.id
-        
+    # 戦闘データはサーバー側に保持し、セッションには戦闘IDのみ載せる
+    session['rpg_battle_id'] = create_rpg_battle(
+        user_id, [p['answer'] for p in selected_problems_data], target_boss.id
+    )
+    # 旧形式（Cookieセッションに問題IDを保持していた頃）のキーを掃除
+    for legacy_key in ('rpg_battle_pids', 'rpg_correct_count', 'rpg_incorrect_count', 'rpg_battle_stage_id'):
+        session.pop(legacy_key, None)
+
     # ストリークボーナスの計算
     streak = calculate_user_streak(user_id)
     bonus_percentage = min(streak * 0.01, 0.30)  # 最大30%
@@ -22401,35 +24623,17 @@ def check_rpg_answer():
     if index is None:
         return jsonify({'status': 'error', 'message': '問題インデックスが必要です'}), 400
         
-    # セッションから現在の戦闘の問題リストを取得
-    battle_pids = session.get('rpg_battle_pids')
-    if not battle_pids or index < 0 or index >= len(battle_pids):
+    # サーバー側の戦闘データから正解を取得
+    battle_id = session.get('rpg_battle_id')
+    battle = get_rpg_battle(battle_id, session['user_id'])
+    if not battle or not isinstance(index, int) or index < 0 or index >= len(battle['answers']):
         return jsonify({'status': 'error', 'message': '不正なインデックスまたは戦闘データが見つかりません'}), 400
-        
-    problem_id = battle_pids[index]
-    
-    # 単語データをロードして正解を確認
-    user = User.query.get(session['user_id'])
-    all_words = load_word_data_for_room(user.room_number)
-    
-    # 生IDとハッシュIDの両方で引けるようにマップ化 (DailyQuizと同様)
-    word_by_id = {}
-    for w in all_words:
-        word_by_id[generate_raw_id(w)] = w
-        word_by_id[generate_problem_id(w)] = w
-        
-    question_word = word_by_id.get(problem_id)
-    if not question_word:
-         return jsonify({'status': 'error', 'message': '問題データが見つかりません'}), 404
-         
-    correct_answer = question_word['answer']
+
+    correct_answer = battle['answers'][index]
     is_correct = (user_choice == correct_answer)
-    
-    if is_correct:
-        session['rpg_correct_count'] = session.get('rpg_correct_count', 0) + 1
-    else:
-        session['rpg_incorrect_count'] = session.get('rpg_incorrect_count', 0) + 1
-    
+
+    record_rpg_battle_answer(battle_id, is_correct)
+
     return jsonify({
         'status': 'success',
         'is_correct': is_correct,
@@ -22451,23 +24655,27 @@ def submit_rpg_result():
         return jsonify({'status': 'error', 'message': 'Stage ID is required'}), 400
     
     # サーバー側での勝利判定バリデーション (Win Forgery対策)
-    session_stage_id = session.get('rpg_battle_stage_id')
+    battle_id = session.get('rpg_battle_id')
+    battle = get_rpg_battle(battle_id, user_id)
     if is_win:
-        if session_stage_id != stage_id:
+        if not battle or battle['stage_id'] != stage_id:
              return jsonify({'status': 'error', 'message': '不正なステージIDです'}), 403
-             
+
         enemy = RpgEnemy.query.get(stage_id)
         if not enemy:
              return jsonify({'status': 'error', 'message': 'ボスが見つかりません'}), 404
-             
-        server_correct = session.get('rpg_correct_count', 0)
-        server_incorrect = session.get('rpg_incorrect_count', 0)
+
+        server_correct, server_incorrect = get_rpg_battle_score(battle_id) or (0, 0)
         
         # 合格条件の照合
         if server_correct < enemy.clear_correct_count or server_incorrect > enemy.clear_max_mistakes:
              print(f"⚠️ Win Forge detected for user {user_id}: Client claimed win, but Server has {server_correct} correct / {server_incorrect} incorrect")
              return jsonify({'status': 'error', 'message': 'スコアが合格基準に達していません'}), 403
 
+    # 結果送信をもって戦闘終了（同じ戦闘データでの再送信を防ぐ）
+    session.pop('rpg_battle_id', None)
+    discard_rpg_battle(battle_id)
+
     # RpgState取得または作成
     rpg_state = RpgState.query.filter_by(user_id=user_id).first()
     if not rpg_state:
@@ -22532,6 +24740,7 @@ def submit_rpg_result():
              enemy = RpgEnemy.query.get(stage_id)
 
         db.session.commit()
+        invalidate_rpg_user_state(user_id)
         
         # 統計再計算（ボーナス反映のため）
         UserStats.get_or_create(user_id).update_stats()
@@ -22613,17 +24822,12 @@ def status():
         # Check both int and str to be robust
         is_earned = enemy.id in cleared_set or str(enemy.id) in cleared_set
         
-        # Cache preventing timestamp
-        ts = int(datetime.now(JST).timestamp())
-        
         # アイコンのパス調整
         # Priority: Defeated Image (討伐後画像) > Badge Image (称号アイコン)
-        # 修正: serve_rpg_image経由のURLを使用する
-        badge_icon_url = url_for('serve_rpg_image', enemy_id=enemy.id, image_type='badge') if enemy.badge_image else None
-        if badge_icon_url: badge_icon_url += f"?t={ts}"
+        # 修正: serve_rpg_image経由のURLを使用する（内容ハッシュ付きURLでブラウザキャッシュを効かせる）
+        badge_icon_url = rpg_image_url(enemy.id, 'badge', enemy.badge_image_hash) if enemy.badge_image else None
         
-        defeated_icon_url = url_for('serve_rpg_image', enemy_id=enemy.id, image_type='defeated') if enemy.defeated_image else None
-        if defeated_icon_url: defeated_icon_url += f"?t={ts}"
+        defeated_icon_url = rpg_image_url(enemy.id, 'defeated', enemy.defeated_image_hash) if enemy.defeated_image else None
 
         final_badge_icon = defeated_icon_url if enemy.defeated_image else (badge_icon_url if enemy.badge_image else 'fas fa-medal')
         
@@ -22633,12 +24837,20 @@ def status():
              final_badge_icon = enemy.badge_image
 
         # ボスアイコンも同様
-        final_boss_icon = url_for('serve_rpg_image', enemy_id=enemy.id, image_type='icon') if enemy.icon_image else 'None'
-        if final_boss_icon != 'None': final_boss_icon += f"?t={ts}"
+        final_boss_icon = rpg_image_url(enemy.id, 'icon', enemy.icon_image_hash) if enemy.icon_image else 'None'
+
+        # 縮小版の srcset（バッジ一覧は小さく表示するので元画像を読ませない）
+        if enemy.defeated_image:
+            defeated_icon_srcset = image_variant_srcset('rpg_defeated', enemy.id, enemy.defeated_image_hash)
+            badge_icon_srcset = defeated_icon_srcset
+        else:
+            defeated_icon_srcset = image_variant_srcset('rpg_icon', enemy.id, enemy.icon_image_hash) if enemy.icon_image else ''
+            badge_icon_srcset = image_variant_srcset('rpg_badge', enemy.id, enemy.badge_image_hash) if enemy.badge_image else ''
 
         all_badges.append({
             'name': enemy.badge_name,
             'icon': final_badge_icon,
+            'icon_srcset': badge_icon_srcset,
             'description': enemy.description if enemy.description else f"{enemy.name}を討伐した証", # 修正: 豆知識を表示
             'earned': is_earned,
             'boss_name': enemy.name,
@@ -22646,6 +24858,7 @@ def status():
             'boss_description': enemy.description,
             # 修正: 討伐後画像URL (Status Modal用)
             'defeated_icon': defeated_icon_url if (defeated_icon_url and enemy.defeated_image) else final_boss_icon,
+            'defeated_icon_srcset': defeated_icon_srcset,
             'id': enemy.id, #  追加: フロントエンドで敵IDを参照するため
             'time_limit': enemy.time_limit, #  プレビュー用
             'pass_score': enemy.clear_correct_count, #  プレビュー用
@@ -22888,12 +25101,15 @@ def upload_essay_image(problem_id):
         new_image = EssayImage(
             problem_id=problem_id,
             image_data=image_data,
-            image_format=file_ext.upper()
+            image_format=file_ext.upper(),
+            image_hash=hashlib.md5(image_data).hexdigest()
         )
         
         try:
             db.session.add(new_image)
             db.session.commit()
+            invalidate_essay_grading_cache(problem_id)
+            generate_image_variants('essay', problem_id)
             app.logger.info(f"問題{problem_id}の画像をデータベースに保存しました（サイズ: {len(image_data):,}bytes）")
         except Exception as insert_error:
             db.session.rollback()
@@ -22939,7 +25155,7 @@ def admin_upload_essay_image_form(problem_id):
             image_section = f'''
                 <div class="current-image">
                     <h3>現在の画像</h3>
-                    <img src="{url_for('essay_image', problem_id=problem_id)}" alt="現在の画像">
+                    <img src="{essay_image_src(problem_id)}" alt="現在の画像">
                     <p><small>現在の画像が表示されています</small></p>
                 </div>
             '''
@@ -23013,8 +25229,10 @@ def delete_essay_image(problem_id):
         # 画像の存在確認と削除
         existing_image = EssayImage.query.filter_by(problem_id=problem_id).first()
         if existing_image:
+            delete_image_variants('essay', problem_id)
             db.session.delete(existing_image)
             db.session.commit()
+            invalidate_essay_grading_cache(problem_id)  # 画像を前提にした採点結果を使わない
             
             app.logger.info(f"問題{problem_id}の画像を削除しました")
             return jsonify({
@@ -23365,7 +25583,8 @@ def submit_daily_quiz():
         db.session.add(new_result)
         db.session.commit()
         db.session.refresh(new_result)
-        
+        STREAK_CACHE.pop(user.id, None)
+
         # (日次ランキング計算)
         top_5_ranking, current_user_rank_info, total_participants = get_daily_ranking_data(daily_quiz.id, user.id)
         
@@ -23838,15 +26057,18 @@ def admin_add_rpg_enemy():
             icon_image=icon_filename,
             icon_image_content=icon_content,
             icon_image_mimetype=icon_mimetype,
+            icon_image_hash=hashlib.md5(icon_content).hexdigest() if icon_content else None,
             badge_name=request.form.get('badge_name', 'Unknown Badge'),
             
             badge_image=badge_filename_or_class,
             badge_image_content=badge_content,
             badge_image_mimetype=badge_mimetype,
+            badge_image_hash=hashlib.md5(badge_content).hexdigest() if badge_content else None,
             
             defeated_image=defeated_filename,
             defeated_image_content=defeated_content,
             defeated_image_mimetype=defeated_mimetype,
+            defeated_image_hash=hashlib.md5(defeated_content).hexdigest() if defeated_content else None,
             
             is_active=request.form.get('is_active') == 'true',
             display_order=final_display_order,
@@ -23865,6 +26087,9 @@ def admin_add_rpg_enemy():
 
         db.session.add(new_enemy)
         db.session.commit()
+        invalidate_rpg_boss_ladder()
+        for source_type in ('rpg_icon', 'rpg_badge', 'rpg_defeated'):
+            generate_image_variants(source_type, new_enemy.id)
 
         #  Handle RpgEnemyDialogue rows for initial creation
         # Get lists of content and expression
@@ -23936,6 +26161,7 @@ def _revoke_rpg_progress(enemy_id, badge_name):
                 affected_count += 1
                 
         db.session.commit()
+        invalidate_rpg_user_state()
         print(f"🔄 Revoked RPG progress for enemy {enemy_id}. Affected users: {affected_count}")
         return True
         
@@ -23962,8 +26188,11 @@ def admin_delete_rpg_enemy(enemy_id):
         # ★ ボーナス剥奪処理
         _revoke_rpg_progress(enemy.id, enemy.badge_name)
             
+        for source_type in ('rpg_icon', 'rpg_badge', 'rpg_defeated'):
+            delete_image_variants(source_type, enemy.id)
         db.session.delete(enemy)
         db.session.commit()
+        invalidate_rpg_boss_ladder()
         return jsonify({'status': 'success', 'message': '敵キャラを削除し、関連するユーザースコアを再計算しました'})
     except Exception as e:
         db.session.rollback()
@@ -24046,6 +26275,7 @@ def admin_edit_rpg_enemy(enemy_id):
             
             enemy.icon_image_content = content
             enemy.icon_image_mimetype = icon_file.mimetype
+            enemy.icon_image_hash = hashlib.md5(content).hexdigest() if content else None
             
             # S3/Local保存
             icon_file.seek(0)
@@ -24072,6 +26302,7 @@ def admin_edit_rpg_enemy(enemy_id):
             badge_file.seek(0)
             enemy.badge_image_content = badge_file.read()
             enemy.badge_image_mimetype = badge_file.mimetype
+            enemy.badge_image_hash = hashlib.md5(enemy.badge_image_content).hexdigest() if enemy.badge_image_content else None
             
             # S3/Local
             badge_file.seek(0)
@@ -24096,6 +26327,7 @@ def admin_edit_rpg_enemy(enemy_id):
             defeated_file.seek(0)
             enemy.defeated_image_content = defeated_file.read()
             enemy.defeated_image_mimetype = defeated_file.mimetype
+            enemy.defeated_image_hash = hashlib.md5(enemy.defeated_image_content).hexdigest() if enemy.defeated_image_content else None
             
             defeated_file.seek(0)
             s3_url = upload_image_to_s3(defeated_file, unique_filename, folder='rpg_images')
@@ -24133,6 +26365,9 @@ def admin_edit_rpg_enemy(enemy_id):
             # Non-fatal?
             
         db.session.commit()
+        invalidate_rpg_boss_ladder()
+        for source_type in ('rpg_icon', 'rpg_badge', 'rpg_defeated'):
+            generate_image_variants(source_type, enemy.id)  # 差し替えた画像の分だけ作られる
         return jsonify({'status': 'success', 'message': '敵キャラ情報を更新しました', 'enemy': enemy.to_dict()})
         
     except Exception as e:
@@ -24176,6 +26411,26 @@ def check_and_migrate_rpg_columns():
                         conn.execute(text("ALTER TABLE rpg_enemy ADD COLUMN is_manual_order BOOLEAN DEFAULT FALSE"))
                     else:
                         conn.execute(text("ALTER TABLE rpg_enemy ADD COLUMN is_manual_order BOOLEAN DEFAULT 0"))
+
+                # 画像内容ハッシュ (ETag・URLバージョン用)
+                for image_type in ('icon', 'badge', 'defeated'):
+                    if f'{image_type}_image_hash' not in columns:
+                        print(f"Migrating: Adding {image_type}_image_hash column")
+                        conn.execute(text(f"ALTER TABLE rpg_enemy ADD COLUMN {image_type}_image_hash VARCHAR(32)"))
+
+                # 既存画像のハッシュをバックフィル（1件ずつ読み込んでメモリを節約）
+                for image_type in ('icon', 'badge', 'defeated'):
+                    missing_ids = [r[0] for r in conn.execute(text(
+                        f"SELECT id FROM rpg_enemy WHERE {image_type}_image_hash IS NULL AND {image_type}_image_content IS NOT NULL"
+                    ))]
+                    for enemy_id in missing_ids:
+                        content = conn.execute(text(
+                            f"SELECT {image_type}_image_content FROM rpg_enemy WHERE id = :id"
+                        ), {'id': enemy_id}).scalar()
+                        if content:
+                            conn.execute(text(
+                                f"UPDATE rpg_enemy SET {image_type}_image_hash = :h WHERE id = :id"
+                            ), {'h': hashlib.md5(bytes(content)).hexdigest(), 'id': enemy_id})
                 
                 conn.commit()
                 # print("Migration check completed.")
@@ -25014,6 +27269,7 @@ def _create_map_quiz_tables():
                     if os.path.exists(file_path):
                         with open(file_path, 'rb') as f:
                             m.image_data = f.read()
+                        m.image_hash = hashlib.md5(m.image_data).hexdigest()
                         synced_count += 1
                 if synced_count > 0:
                     db.session.commit()
@@ -25063,7 +27319,7 @@ def _add_ellipse_columns_to_map_location():
         print(f"⚠️ MapLocation ellipse migration warning: {e}")
 
 def _add_essay_problem_columns_safe():
-    """EssayProblemテーブルにcount_half_width_digits_as_halfカラムを追加（安全版）"""
+    """EssayProblemテーブルにcount_half_width_digits_as_half・採点用事前計算カラム・関連セクションカラムを追加（安全版）"""
     try:
         with db.engine.connect() as conn:
             inspector = inspect(db.engine)
@@ -25076,12 +27332,76 @@ def _add_essay_problem_columns_safe():
                          conn.execute(text("ALTER TABLE essay_problems ADD COLUMN count_half_width_digits_as_half BOOLEAN DEFAULT FALSE NOT NULL"))
                     else:
                          conn.execute(text("ALTER TABLE essay_problems ADD COLUMN count_half_width_digits_as_half BOOLEAN DEFAULT 0 NOT NULL"))
+
+                # AI添削用の事前計算値（既存行はNULL = 未計算。backfill_essay_grading_metadata() で埋める）
+                for column_name, column_type in [
+                    ('grading_max_length', 'INTEGER'),
+                    ('grading_min_length', 'INTEGER'),
+                    ('model_answer_clean_length', 'INTEGER'),
+                    ('clean_question', 'TEXT'),
+                    ('textbook_sections', 'TEXT'),
+                    ('textbook_sections_key', 'VARCHAR(64)')
+                ]:
+                    if column_name not in columns:
+                        print(f"🔄 EssayProblem: {column_name}を追加")
+                        conn.execute(text(f"ALTER TABLE essay_problems ADD COLUMN {column_name} {column_type}"))
                     
                 conn.commit()
                 # print("✅ EssayProblemカラム追加完了")
     except Exception as e:
         print(f"⚠️ EssayProblem migration warning: {e}")
 
+def _add_image_hash_columns_safe():
+    """論述・添削・地図画像テーブルに内容ハッシュ (ETag・URLバージョン用) を追加し、既存画像を1件ずつバックフィル"""
+    try:
+        with db.engine.connect() as conn:
+            inspector = inspect(db.engine)
+            table_names = inspector.get_table_names()
+            for table_name in ('essay_images', 'correction_request_images', 'mq_image'):
+                if table_name not in table_names:
+                    continue
+                columns = [col['name'] for col in inspector.get_columns(table_name)]
+                if 'image_hash' not in columns:
+                    print(f"🔄 {table_name}: image_hashを追加")
+                    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN image_hash VARCHAR(32)"))
+
+                # 1件ずつ読み込んでメモリを節約
+                missing_ids = [r[0] for r in conn.execute(text(
+                    f"SELECT id FROM {table_name} WHERE image_hash IS NULL AND image_data IS NOT NULL"
+                ))]
+                for image_id in missing_ids:
+                    content = conn.execute(text(
+                        f"SELECT image_data FROM {table_name} WHERE id = :id"
+                    ), {'id': image_id}).scalar()
+                    if content:
+                        conn.execute(text(
+                            f"UPDATE {table_name} SET image_hash = :h WHERE id = :id"
+                        ), {'h': hashlib.md5(bytes(content)).hexdigest(), 'id': image_id})
+
+            conn.commit()
+    except Exception as e:
+        print(f"⚠️ Image hash migration warning: {e}")
+
+def backfill_essay_grading_metadata(force=False, batch_size=200):
+    """
+    既存の論述問題に採点用の事前計算値を埋める（scripts/backfill_essay_grading_metadata.py から実行）。
+    force=True なら計算済みの問題も再計算する。更新した件数を返す。
+    """
+    query = EssayProblem.query
+    if not force:
+        query = query.filter(EssayProblem.model_answer_clean_length.is_(None))
+    problem_ids = [row.id for row in query.with_entities(EssayProblem.id).order_by(EssayProblem.id).all()]
+
+    updated = 0
+    for start in range(0, len(problem_ids), batch_size):
+        batch_ids = problem_ids[start:start + batch_size]
+        for problem in EssayProblem.query.filter(EssayProblem.id.in_(batch_ids)).all():
+            problem.refresh_grading_metadata()
+            updated += 1
+        db.session.commit()
+        db.session.expunge_all()  # メモリ節約
+    return updated
+
 def _create_chronological_tables():
     """Chronological sorting related tables creation"""
     from sqlalchemy import inspect
@@ -25140,6 +27460,7 @@ def _create_chronological_tables():
         print(f"⚠️ Chronological tables creation warning: {e}")
 
 with app.app_context():
+    _add_image_hash_columns_safe()  # ORMでの画像テーブル参照より先に実行する
     _create_map_quiz_tables()
     _add_mq_complete_columns_safe()
     _add_shape_columns_to_map_location()
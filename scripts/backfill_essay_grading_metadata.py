@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Add parent directory to path to import app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, backfill_essay_grading_metadata
+
+def main():
+    # --force: 計算済みの問題も再計算する（字数制限の読み取りルールを変えた場合など）
+    force = '--force' in sys.argv[1:]
+    with app.app_context():
+        updated = backfill_essay_grading_metadata(force=force)
+        print(f"✅ 論述問題 {updated}件の採点用データを更新しました")
+
+if __name__ == "__main__":
+    main()
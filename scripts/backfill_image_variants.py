@@ -0,0 +1,24 @@
+import os
+import sys
+
+# Add parent directory to path to import app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, backfill_image_variants, image_variant_report, IMAGE_VARIANT_WIDTHS
+
+def main():
+    # 引数で種類を絞れる（例: python scripts/backfill_image_variants.py map essay）
+    source_types = [t for t in sys.argv[1:] if t in IMAGE_VARIANT_WIDTHS] or None
+    with app.app_context():
+        counts = backfill_image_variants(source_types)
+        for source_type, count in counts.items():
+            print(f"✅ {source_type}: 元画像 {count}件の派生版を作成/確認しました")
+
+        mb = 1024 * 1024
+        print(f"\n{'type':<14}{'width':>6}{'count':>7}{'original MB':>13}{'variant MB':>12}{'saved MB':>10}")
+        for row in image_variant_report():
+            print(f"{row['source_type']:<14}{row['width'] or 'orig':>6}{row['variants']:>7}"
+                  f"{row['source_bytes'] / mb:>13.2f}{row['variant_bytes'] / mb:>12.2f}{row['saved_bytes'] / mb:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+教科書ベクトル検索の形式ごとの比較（scripts/build_vector_db.py の出力を使う）。
+- recall@k: float32での全件検索（正解）に対する int8のみ / int8 + float32並べ直し の一致率
+- メモリ: 旧形式(pickleのfloatリスト) / float32行列 / int8行列+スケール の大きさ
+- 1クエリあたりの検索時間
+
+使い方:
+    python scripts/benchmark_vector_search.py            # data/textbook_vectors.npy を使う
+    python scripts/benchmark_vector_search.py --synthetic  # ベクトルDBがない環境向けの合成データ
+オプション: --k 3 --queries 200 --noise 0.05
+"""
+import os
+import sys
+import time
+import pickle
+import argparse
+import tempfile
+
+import numpy as np
+
+# Add parent directory to path to import app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import TextbookManager, quantize_vectors_int8
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def synthetic_matrix(rows=800, dims=3072, clusters=40, seed=0):
+    """章ごとにまとまりのある埋め込みを模した正規化済み行列"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    matrix = centers[rng.integers(0, clusters, rows)] + 0.6 * rng.standard_normal((rows, dims)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def make_queries(matrix, count, noise, seed=1):
+    """既存の行にノイズを加えたものを問題文のクエリとみなす"""
+    rng = np.random.default_rng(seed)
+    base = matrix[rng.integers(0, matrix.shape[0], count)]
+    queries = base + noise * rng.standard_normal(base.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def legacy_pickle_size(matrix, sample_rows=20):
+    """旧形式 [{'title', 'content', 'vector': [float, ...]}] のファイルサイズと読み込み後のヒープ使用量の見積もり"""
+    sample = [{'title': str(i), 'content': '', 'vector': matrix[i].astype(float).tolist()}
+              for i in range(min(sample_rows, matrix.shape[0]))]
+    per_row_file = len(pickle.dumps(sample)) / len(sample)
+    per_row_heap = sys.getsizeof(sample[0]['vector']) + matrix.shape[1] * sys.getsizeof(0.1)
+    return per_row_file * matrix.shape[0], per_row_heap * matrix.shape[0]
+
+
+def recall(results, expected):
+    return sum(len(set(r) & set(e)) for r, e in zip(results, expected)) / sum(len(e) for e in expected)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--noise', type=float, default=0.05)
+    args = parser.parse_args()
+
+    matrix_path = os.path.join(DATA_DIR, TextbookManager.VECTOR_MATRIX_FILENAME)
+    if not args.synthetic and os.path.exists(matrix_path):
+        matrix = np.load(matrix_path)
+        print(f"Using {matrix_path}")
+    else:
+        matrix = synthetic_matrix()
+        print("Using synthetic vectors")
+    rows, dims = matrix.shape
+    codes, scales = quantize_vectors_int8(matrix)
+    queries = make_queries(matrix, args.queries, args.noise)
+    print(f"{rows} vectors x {dims} dims, {args.queries} queries, k={args.k}\n")
+
+    # アプリと同じ読み込み方（mmap）で検索させる
+    with tempfile.TemporaryDirectory() as tmpdir:
+        np.save(os.path.join(tmpdir, TextbookManager.VECTOR_MATRIX_FILENAME), matrix)
+        np.save(os.path.join(tmpdir, TextbookManager.VECTOR_INT8_FILENAME), codes)
+        np.save(os.path.join(tmpdir, TextbookManager.VECTOR_SCALES_FILENAME), scales)
+        manager = TextbookManager()
+        manager.data_dir = tmpdir
+        manager.vector_matrix = np.load(os.path.join(tmpdir, TextbookManager.VECTOR_MATRIX_FILENAME), mmap_mode='r')
+        manager.vector_titles = list(range(rows))
+
+        def run(label, search):
+            start = time.perf_counter()
+            results = [search(q) for q in queries]
+            elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            return label, results, elapsed_ms
+
+        # 正解: float32で全件
+        exact = run('float32 exact', lambda q: manager._search_vector_matrix(q, args.k))
+
+        manager._load_quantized_vectors()
+        int8_only = run('int8 only', lambda q: list(np.argsort(-manager._int8_scores(q))[:args.k]))
+        reranked = run('int8 + rerank', lambda q: manager._search_vector_matrix(q, args.k))
+
+        print(f"{'method':<16}{'recall@' + str(args.k):>10}{'ms/query':>10}")
+        for label, results, elapsed_ms in (exact, int8_only, reranked):
+            print(f"{label:<16}{recall(results, exact[1]):>10.3f}{elapsed_ms:>10.3f}")
+        manager.clear_memory()
+
+    pickle_file, pickle_heap = legacy_pickle_size(matrix)
+    mb = 1024 * 1024
+    print(f"\n{'format':<24}{'size (MB)':>10}")
+    print(f"{'pickle file (legacy)':<24}{pickle_file / mb:>10.2f}")
+    print(f"{'pickle heap (legacy)':<24}{pickle_heap / mb:>10.2f}")
+    print(f"{'float32 matrix':<24}{matrix.nbytes / mb:>10.2f}")
+    print(f"{'int8 matrix + scales':<24}{(codes.nbytes + scales.nbytes) / mb:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
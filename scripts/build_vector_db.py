@@ -1,54 +1,83 @@
+"""
+教科書ベクトルDBのビルド（差分ビルド対応）。
+
+各セクションの本文のハッシュを前回のビルド結果（textbook_vector_manifest.json）と比べ、
+変わっていないセクションは前回のベクトルを再利用し、新規・変更セクションだけを
+スレッドプールで並行して埋め込む（呼び出し間隔は --rate で制限）。
+埋め込み結果は1件ごとにチェックポイントに追記するので、途中で止まっても次回はその続きから再開できる。
+
+使い方:
+    python scripts/build_vector_db.py                 # 差分ビルド
+    python scripts/build_vector_db.py --full          # 前回の結果を使わず全件埋め込む
+    python scripts/build_vector_db.py --fake          # ネットワークを使わない偽の埋め込み（動作確認用）
+    python scripts/build_vector_db.py --bm25-only     # BM25・セクション位置の索引だけ作る（APIを使わない）
+    python scripts/build_vector_db.py --from-pickle   # 旧形式の textbook_vectors.pkl を変換する
+オプション: --workers 4 --rate 5（1秒あたりの呼び出し上限）--skip-essay-map
+"""
 import os
 import sys
-import re
+import json
+import time
 import pickle
+import hashlib
+import argparse
 import threading
-from google import genai
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import numpy as np
 
 # 親ディレクトリのモジュールをインポートできるようにパスを追加
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# 分かち方・見出しの判定・量子化の方式はアプリ側の検索と揃える（app を読み込むとDB初期化が走るため共有モジュールから）
+from textbook_index import (TEXTBOOK_HEADER_PATTERN, quantize_vectors_int8, build_textbook_bm25_index,
+                            build_textbook_section_index)
+
 # .envの読み込み（親ディレクトリにある想定）
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env'))
 
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    print("Error: GEMINI_API_KEY not found in environment variables.")
-    sys.exit(1)
-
-# 新API: Client初期化
-client = genai.Client(api_key=GEMINI_API_KEY)
-
-TEXTBOOK_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'textbook.txt')
-OUTPUT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'textbook_vectors.pkl')
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+TEXTBOOK_FILENAME = 'textbook.txt'
+# app.py の TextbookManager が np.load(mmap_mode='r') で開く形式
+MATRIX_FILENAME = 'textbook_vectors.npy'
+TITLES_FILENAME = 'textbook_vector_titles.json'
+# int8量子化版（1次検索用。候補はfloat32行列で並べ直す）
+INT8_MATRIX_FILENAME = 'textbook_vectors_int8.npy'
+INT8_SCALES_FILENAME = 'textbook_vector_scales.npy'
+# 本文の文字bigram BM25インデックス（埋め込みAPIが使えないときの検索用）
+BM25_INDEX_FILENAME = 'textbook_bm25.npz'
+# 見出し → 教科書内のバイト位置（採点時にセクション本文だけを読むための索引）
+SECTION_INDEX_FILENAME = 'textbook_sections.json'
+# 差分ビルド用: 行ごとの本文ハッシュと埋め込みモデル
+MANIFEST_FILENAME = 'textbook_vector_manifest.json'
+# 埋め込み済みの結果を1行ずつ追記する（ビルド完了時に削除）
+CHECKPOINT_FILENAME = 'textbook_vectors.checkpoint.jsonl'
+# 旧形式（--from-pickle での変換元）
+LEGACY_PICKLE_FILENAME = 'textbook_vectors.pkl'
 
 class TextbookManagerLogic:
     """app.pyからロジックだけ拝借（依存関係回避のため再定義）"""
-    def __init__(self):
-        self.sections = {} 
+    def __init__(self, textbook_path=None):
+        self.textbook_path = textbook_path or os.path.join(DATA_DIR, TEXTBOOK_FILENAME)
+        self.sections = {}
         self.toc = []
         self._load_textbook()
 
     def _load_textbook(self):
-        if not os.path.exists(TEXTBOOK_PATH):
-            print(f"Textbook file not found at: {TEXTBOOK_PATH}")
+        if not os.path.exists(self.textbook_path):
+            print(f"Textbook file not found at: {self.textbook_path}")
             return
 
         try:
-            with open(TEXTBOOK_PATH, 'r', encoding='utf-8') as f:
+            with open(self.textbook_path, 'r', encoding='utf-8') as f:
                 content = f.read()
 
             lines = content.splitlines()
             current_header = "Introduction"
             current_content = []
-            
-            # app.py と同じ正規表現
-            header_pattern = re.compile(r'^(第[０-９0-9]+[部章].*|[０-９0-9]+　.*|●.*|【.*】.*)') 
-            
+
             for line in lines:
-                if header_pattern.match(line):
+                if TEXTBOOK_HEADER_PATTERN.match(line):
                     if current_content:
                         self.sections[current_header] = "\n".join(current_content)
                         self.toc.append(current_header)
@@ -56,70 +85,293 @@ class TextbookManagerLogic:
                     current_content = [line]
                 else:
                     current_content.append(line)
-            
+
             if current_content:
                 self.sections[current_header] = "\n".join(current_content)
                 self.toc.append(current_header)
-                
+
             print(f"✅ Textbook loaded: {len(self.toc)} sections parsed.")
-            
+
         except Exception as e:
             print(f"❌ Failed to parse textbook: {e}")
 
-def get_embedding(text):
-    """Gemini APIを使ってテキストをベクトル化（新API）"""
+class GeminiEmbeddingBackend:
+    """Gemini APIを使ってテキストをベクトル化（アプリと同じ AI_GATEWAY 経由。障害時は即座に失敗しチェックポイントから再開する）"""
+    def __init__(self):
+        from app import AI_GATEWAY, EMBEDDING_MODEL  # --fake / --bm25-only では不要
+        self.gateway = AI_GATEWAY
+        self.model = EMBEDDING_MODEL
+
+    def embed(self, text):
+        return self.gateway.embed(self.model, text, purpose='build_vector_db')
+
+class FakeEmbeddingBackend:
+    """ネットワークを使わない決定的な埋め込み（テスト・動作確認用。同じ文章なら同じベクトル）"""
+    model = "fake-embedding"
+
+    def __init__(self, dims=64):
+        self.dims = dims
+        self.calls = []
+
+    def embed(self, text):
+        self.calls.append(text)
+        seed = int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:16], 16)
+        return np.random.default_rng(seed).standard_normal(self.dims).tolist()
+
+class RateLimiter:
+    """呼び出し間隔を 1 / rate_per_sec 秒以上に保つ（スレッド間で共有）"""
+    def __init__(self, rate_per_sec):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec and rate_per_sec > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def section_text(title, content):
+    # テキストを結合（タイトルも含めると検索精度が上がる可能性がある）
+    return f"{title}\n{content}"
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def load_manifest(data_dir):
+    """前回のビルドのマニフェスト {'model', 'hashes'}（なければ空のdict）"""
+    manifest_path = os.path.join(data_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
     try:
-        # gemini-embedding-001 モデルを使用（app.pyと合わせる）
-        result = client.models.embed_content(
-            model="models/gemini-embedding-001",
-            contents=text
-        )
-        return result.embeddings[0].values
-    except Exception as e:
-        print(f"⚠️ Embedding failed: {e}")
-        return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def load_previous_vectors(data_dir, model):
+    """
+    前回のビルド結果とチェックポイントから {本文ハッシュ: ベクトル} を作る。
+    埋め込みモデルが違う結果は使わない。
+    """
+    reusable = {}
+    manifest = load_manifest(data_dir)
+    matrix_path = os.path.join(data_dir, MATRIX_FILENAME)
+    if manifest and os.path.exists(matrix_path):
+        try:
+            matrix = np.load(matrix_path)
+            if manifest.get('model') == model and len(manifest.get('hashes', [])) == matrix.shape[0]:
+                # 保存済みの行は正規化済みだが、検索時も正規化するのでそのまま再利用できる
+                reusable.update(zip(manifest['hashes'], matrix))
+        except Exception as e:
+            print(f"⚠️ Failed to read previous build: {e}")
+
+    checkpoint_path = os.path.join(data_dir, CHECKPOINT_FILENAME)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で止まった最終行
+                if entry.get('model') == model:
+                    reusable[entry['hash']] = np.asarray(entry['vector'], dtype=np.float32)
+    return reusable
 
-def build_vector_db():
+def embed_with_retry(backend, limiter, text, attempts=3, retry_delay=2.0):
+    """レート制限を守って埋め込む。失敗したら間隔を倍にしながら再試行し、最後まで失敗したらNone"""
+    for attempt in range(attempts):
+        limiter.wait()
+        try:
+            return backend.embed(text)
+        except Exception as e:
+            print(f"⚠️ Embedding failed (attempt {attempt + 1}/{attempts}): {e}")
+            if attempt + 1 < attempts:
+                time.sleep(retry_delay * (2 ** attempt))
+    return None
+
+def save_vector_matrix(titles, vectors, data_dir=DATA_DIR, hashes=None, model=None):
+    """
+    行ごとにL2正規化したfloat32行列(.npy)・タイトル一覧(.json)と、
+    そのint8量子化版（行列 + 行ごとのスケール）、差分ビルド用のマニフェストを書き出す
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    codes, scales = quantize_vectors_int8(matrix)
+
+    # 書き込み途中のファイルをアプリが開かないよう一時ファイル経由で置き換える
+    outputs = []
+    for filename, array in [(MATRIX_FILENAME, matrix), (INT8_MATRIX_FILENAME, codes), (INT8_SCALES_FILENAME, scales)]:
+        path = os.path.join(data_dir, filename)
+        np.save(path + '.tmp.npy', array)
+        outputs.append((path + '.tmp.npy', path))
+    json_outputs = [(TITLES_FILENAME, list(titles))]
+    if hashes is not None:
+        json_outputs.append((MANIFEST_FILENAME, {'model': model, 'hashes': list(hashes)}))
+    for filename, data in json_outputs:
+        path = os.path.join(data_dir, filename)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        outputs.append((path + '.tmp', path))
+    for tmp_path, path in outputs:
+        os.replace(tmp_path, path)
+    print(f"💾 Saved {matrix.shape[0]} x {matrix.shape[1]} matrix to {os.path.join(data_dir, MATRIX_FILENAME)} "
+          f"({matrix.nbytes / 1024 / 1024:.1f} MB, int8: {(codes.nbytes + scales.nbytes) / 1024 / 1024:.1f} MB)")
+
+def save_bm25_index(tm, data_dir=DATA_DIR):
+    """教科書本文のBM25インデックスを書き出す（APIを使わないので --bm25-only で単独実行も可）"""
+    index = build_textbook_bm25_index(tm.sections.items())
+    index_path = os.path.join(data_dir, BM25_INDEX_FILENAME)
+    np.savez(index_path + '.tmp.npz', **index)
+    os.replace(index_path + '.tmp.npz', index_path)
+    print(f"💾 Saved BM25 index ({len(index['titles'])} sections, {len(index['grams'])} bigrams) to {index_path}")
+
+def save_section_index(data_dir=DATA_DIR):
+    """見出しごとのバイト位置の索引を書き出す（APIを使わない）"""
+    index = build_textbook_section_index(os.path.join(data_dir, TEXTBOOK_FILENAME))
+    index_path = os.path.join(data_dir, SECTION_INDEX_FILENAME)
+    with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(index_path + '.tmp', index_path)
+    print(f"💾 Saved section index ({len(index['sections'])} sections) to {index_path}")
+
+def map_essay_problems():
+    """
+    新しいベクトルDBで全論述問題の関連セクションを計算し直す（採点時の埋め込みAPI呼び出しを省くため）。
+    ビルド中の依存を増やさないよう、ここで初めて app を読み込む。
+    """
+    from app import app, map_essay_problems_to_textbook
+
+    with app.app_context():
+        mapped = map_essay_problems_to_textbook(force=True)
+    print(f"📚 Mapped {mapped} essay problems to textbook sections.")
+
+def convert_legacy_pickle(data_dir=DATA_DIR, map_essays=True):
+    """既存の textbook_vectors.pkl を再埋め込みせずに新形式へ変換する"""
+    from app import EMBEDDING_MODEL  # 旧形式もアプリと同じモデルで埋め込まれている
+
+    legacy_path = os.path.join(data_dir, LEGACY_PICKLE_FILENAME)
+    if not os.path.exists(legacy_path):
+        print(f"❌ Legacy vector DB not found at: {legacy_path}")
+        return
+    with open(legacy_path, 'rb') as f:
+        vector_db = pickle.load(f)
+    save_vector_matrix(
+        [item['title'] for item in vector_db], [item['vector'] for item in vector_db], data_dir,
+        hashes=[text_hash(section_text(item['title'], item['content'])) for item in vector_db],
+        model=EMBEDDING_MODEL
+    )
+    save_bm25_index(TextbookManagerLogic(os.path.join(data_dir, TEXTBOOK_FILENAME)), data_dir)
+    save_section_index(data_dir)
+    if map_essays:
+        map_essay_problems()
+    print("✅ Done!")
+
+def build_vector_db(backend, data_dir=DATA_DIR, workers=4, rate_per_sec=5.0, full=False,
+                    map_essays=True, retry_delay=2.0):
+    """
+    差分ビルド。変わっていないセクションは前回のベクトルを使い、新規・変更分だけを並行して埋め込む。
+    戻り値は件数の集計 {'total', 'reused', 'embedded', 'failed'}。
+    """
     print("🚀 Starting Vector DB Build...")
-    
-    tm = TextbookManagerLogic()
+
+    tm = TextbookManagerLogic(os.path.join(data_dir, TEXTBOOK_FILENAME))
     if not tm.sections:
         print("❌ No sections found. Exiting.")
-        return
+        return None
+
+    # 同じ見出しが複数ある場合は後の本文（tm.sections の値）を使う
+    items = [(title, section_text(title, content)) for title, content in tm.sections.items()]
+    hashes = [text_hash(text) for _, text in items]
+    previous_hashes = load_manifest(data_dir).get('hashes')
+    reusable = {} if full else load_previous_vectors(data_dir, backend.model)
+    vectors = {h: reusable[h] for h in hashes if h in reusable}
+    pending = [(title, text, h) for (title, text), h in zip(items, hashes) if h not in vectors]
+    stats = {'total': len(items), 'reused': len(vectors), 'embedded': 0, 'failed': 0}
+    print(f"Processing {len(items)} sections: {len(vectors)} unchanged, {len(pending)} to embed...")
+
+    checkpoint_path = os.path.join(data_dir, CHECKPOINT_FILENAME)
+    if full and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint_lock = threading.Lock()
+    limiter = RateLimiter(rate_per_sec)
+
+    if pending:
+        with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, \
+                ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {
+                executor.submit(embed_with_retry, backend, limiter, text, retry_delay=retry_delay): (title, h)
+                for title, text, h in pending
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                title, h = futures[future]
+                vector = future.result()
+                if vector is None:
+                    stats['failed'] += 1
+                    print(f"[{done}/{len(pending)}] Embed FAILED: {title}")
+                    continue
+                vectors[h] = np.asarray(vector, dtype=np.float32)
+                stats['embedded'] += 1
+                with checkpoint_lock:
+                    checkpoint.write(json.dumps({'model': backend.model, 'hash': h, 'vector': list(map(float, vector))}) + "\n")
+                    checkpoint.flush()
+                print(f"[{done}/{len(pending)}] Embed success: {title}")
+
+    rows = [(title, h) for (title, _), h in zip(items, hashes) if h in vectors]
+    if not rows:
+        print("❌ No embeddings were created. Exiting.")
+        return stats
 
-    vector_db = [] # List of {'title': title, 'content': content, 'vector': vector}
-    
-    total = len(tm.toc)
-    print(f"Processing {total} sections...")
-    
-    for i, title in enumerate(tm.toc):
-        content = tm.sections[title]
-        # 内容が短すぎる場合はスキップするか検討（今回はすべて含める）
-        
-        # テキストを結合（タイトルも含めると検索精度が上がる可能性がある）
-        text_to_embed = f"{title}\n{content}"
-        
-        vector = get_embedding(text_to_embed)
-        
-        if vector:
-            vector_db.append({
-                'title': title,
-                'content': content,
-                'vector': vector
-            })
-            print(f"[{i+1}/{total}] Embed success: {title}")
-        else:
-            print(f"[{i+1}/{total}] Embed FAILED: {title}")
-            
-        # API制限考慮（必要なら）
-        # time.sleep(0.1) 
-
-    print(f"✨ Build complete. Saving {len(vector_db)} items to {OUTPUT_PATH}...")
-    
-    with open(OUTPUT_PATH, 'wb') as f:
-        pickle.dump(vector_db, f)
-        
+    print(f"✨ Build complete. Saving {len(rows)} items ({stats['embedded']} embedded, {stats['reused']} reused)...")
+    save_vector_matrix(
+        [title for title, _ in rows], [vectors[h] for _, h in rows], data_dir,
+        hashes=[h for _, h in rows], model=backend.model
+    )
+    save_bm25_index(tm, data_dir)
+    save_section_index(data_dir)
+    if stats['failed'] == 0 and os.path.exists(checkpoint_path):
+        # 失敗がなければ全結果がマニフェストに入ったので不要（失敗があれば次回の再開用に残す）
+        os.remove(checkpoint_path)
+    if map_essays and [h for _, h in rows] != previous_hashes:
+        # セクションの追加・変更・削除があったときだけ論述問題の対応付けをやり直す
+        map_essay_problems()
     print("✅ Done!")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the textbook vector DB")
+    parser.add_argument('--full', action='store_true', help="前回の結果を使わず全件埋め込む")
+    parser.add_argument('--fake', action='store_true', help="ネットワークを使わない偽の埋め込みを使う")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=5.0, help="1秒あたりの埋め込みAPI呼び出し上限")
+    parser.add_argument('--skip-essay-map', action='store_true')
+    parser.add_argument('--bm25-only', action='store_true')
+    parser.add_argument('--from-pickle', action='store_true')
+    args = parser.parse_args()
+
+    if args.bm25_only:
+        save_bm25_index(TextbookManagerLogic())
+        save_section_index()
+        return
+    if args.from_pickle:
+        convert_legacy_pickle(map_essays=not args.skip_essay_map)
+        return
+
+    if args.fake:
+        print("⚠️ Using fake embeddings. Search results will not be meaningful.")
+        backend = FakeEmbeddingBackend()
+    else:
+        if not os.environ.get('GEMINI_API_KEY'):
+            print("Error: GEMINI_API_KEY not found in environment variables.")
+            sys.exit(1)
+        backend = GeminiEmbeddingBackend()
+
+    build_vector_db(backend, workers=args.workers, rate_per_sec=args.rate, full=args.full,
+                    map_essays=not args.skip_essay_map)
 
 if __name__ == "__main__":
-    build_vector_db()
+    main()
@@ -16,6 +16,36 @@ document.addEventListener('DOMContentLoaded', function () {
     // File object for OCR (handles both input selection and drag & drop)
     let ocrFile = null;
 
+    // AI採点・OCRは待ち行列で処理されるため、結果が出るまでジョブの状態をポーリングする
+    // （処理中は講評の途中経過が届くので間隔を短くする）
+    let pendingAiJob = null;
+    function waitForAiJob(data, onProgress) {
+        if (data.status !== 'queued' && data.status !== 'running') {
+            pendingAiJob = null;
+            return Promise.resolve(data);
+        }
+        pendingAiJob = data;
+        if (onProgress) onProgress(data);
+        return new Promise(resolve => setTimeout(resolve, data.status === 'running' ? 1000 : 2000))
+            .then(() => fetch(data.poll_url))
+            .then(response => response.json())
+            .then(next => waitForAiJob(next, onProgress));
+    }
+
+    // ページを離れたら処理中のジョブを中断してもらう（APIの無駄な呼び出しを減らす。中断分のチケットは戻る）
+    // bfcacheに入るだけ（アプリの切り替えなど）なら戻ってきてポーリングを再開できるので中断しない
+    window.addEventListener('pagehide', (event) => {
+        if (!event.persisted && pendingAiJob && pendingAiJob.cancel_url && navigator.sendBeacon) {
+            navigator.sendBeacon(pendingAiJob.cancel_url);
+        }
+    });
+
+    function queueMessage(data) {
+        return data.status === 'queued' && data.position > 0
+            ? `順番待ち中です（前に${data.position}件）`
+            : 'AIが処理中です...';
+    }
+
     // Get Problem Data
     const problemData = document.getElementById('problem-data');
     if (!problemData) return;
@@ -217,6 +247,9 @@ document.addEventListener('DOMContentLoaded', function () {
                 body: formData
             })
                 .then(response => response.json())
+                .then(data => waitForAiJob(data, job => {
+                    processOcrBtn.innerHTML = `<i class="fas fa-spinner fa-spin"></i> ${queueMessage(job)}`;
+                }))
                 .then(data => {
                     if (data.status === 'success') {
                         // Insert into editor
@@ -348,7 +381,7 @@ document.addEventListener('DOMContentLoaded', function () {
                     <div class="spinner-border text-primary" role="status">
                         <span class="visually-hidden">Loading...</span>
                     </div>
-                    <p class="mt-2 text-muted">AIが添削中です...<br>（調子が良ければ15秒ほどで完成）</p>
+                    <p class="mt-2 text-muted"><span id="gradingQueueStatus">AIが添削中です...</span><br>（調子が良ければ15秒ほどで完成）</p>
                 ${adHtml}
                 </div>
             `;
@@ -379,7 +412,17 @@ document.addEventListener('DOMContentLoaded', function () {
                     user_answer: userAnswer,
                     feedback_style: feedbackStyle
                 })
-            }).then(response => response.json());
+            })
+                .then(response => response.json())
+                .then(data => waitForAiJob(data, job => {
+                    if (job.partial) {
+                        // 生成途中の講評を順次表示する（完成後に整形済みの講評で置き換える）
+                        gradingResult.innerHTML = `${job.partial}<p class="text-muted small mt-2"><i class="fas fa-spinner fa-spin"></i> AIが添削中です...</p>`;
+                        return;
+                    }
+                    const statusEl = document.getElementById('gradingQueueStatus');
+                    if (statusEl) statusEl.textContent = queueMessage(job);
+                }));
 
             // 2. Ad Wait Promise (The monetization guard)
             const adWaitPromise = new Promise((resolve) => {
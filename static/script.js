@@ -4386,8 +4386,8 @@ function checkRpgStatus() {
                         if (!iconUrl.startsWith('http') && !iconUrl.startsWith('/')) {
                             iconUrl = '/static/images/rpg/' + iconUrl;
                         }
-                        // Cache busting
-                        const finalUrl = iconUrl + '?t=' + new Date().getTime();
+                        // URLに画像内容のハッシュが含まれるため、そのままキャッシュを利用する
+                        const finalUrl = iconUrl;
 
                         // Pre-load logic to handle shadow
                         bossImgEl.onload = () => {
@@ -4596,8 +4596,6 @@ function startRpgGame(enemyId = null) {
                     if (iconUrl && !iconUrl.startsWith('http') && !iconUrl.startsWith('/')) {
                         iconUrl = '/static/images/rpg/' + iconUrl;
                     }
-                    // Cache busting
-                    if (iconUrl) iconUrl += '?t=' + new Date().getTime();
 
                     const introImg = document.getElementById('rpgBossImage');
                     if (introImg) introImg.src = iconUrl;
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# app のインポート（＝DB初期化）より先に一時DBへ切り替える
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import temp_db  # noqa: E402,F401
@@ -0,0 +1,57 @@
+"""
+テスト用の一時SQLiteデータベース。
+app をインポートする前に読み込むこと（conftest.py からも読み込まれる）。
+実際の quiz_data.db や DATABASE_URL のDBには書き込まない。
+"""
+import os
+import sys
+import shutil
+import atexit
+import tempfile
+import unittest
+
+if 'app' in sys.modules:
+    # 既に本番用のDBで初期化されている。drop_all で実データを消さないよう中断する
+    raise RuntimeError('temp_db は app より先にインポートしてください')
+
+_TEMP_DIR = tempfile.mkdtemp(prefix='sswordbook-test-')
+atexit.register(shutil.rmtree, _TEMP_DIR, ignore_errors=True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_TEMP_DIR, 'test.db')
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db, User, cleanup_caches
+
+
+class TempDatabaseTestCase(unittest.TestCase):
+    """テストクラスごとに空のテーブルを作り直し、終了後に削除する"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._db_context = app.app_context()
+        cls._db_context.push()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        cleanup_caches()  # DB由来のメモリ上キャッシュ（検索インデックス・採点結果など）も捨てる
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+        cleanup_caches()
+        cls._db_context.pop()
+        super().tearDownClass()
+
+    @staticmethod
+    def create_user(room_number='101', student_id='1', username='テスト生徒', **kwargs):
+        """テスト用のユーザーを作成する"""
+        user = User(room_number=room_number, student_id=student_id, username=username,
+                    original_username=username, is_first_login=False, **kwargs)
+        user.set_room_password('room')
+        user.set_individual_password('pass')
+        db.session.add(user)
+        db.session.commit()
+        return user
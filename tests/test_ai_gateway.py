@@ -0,0 +1,162 @@
+import unittest
+import sys
+import os
+import time
+from unittest.mock import patch
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, EssayProblem, AiGateway, AiGatewayError, AiTokenBucket, FakeAiBackend,
+                 AI_PRIMARY_MODEL, AI_FALLBACK_MODEL, EMBEDDING_MODEL, get_text_embedding,
+                 invalidate_essay_search_index, is_ai_rate_limit_error, drain_ai_grading_queue)
+
+
+class TestAiGateway(unittest.TestCase):
+    def _gateway(self, backend, **kwargs):
+        kwargs.setdefault('rate_limits', {})
+        kwargs.setdefault('max_wait', 0)
+        return AiGateway(backend, **kwargs)
+
+    def test_success_records_latency_and_tokens(self):
+        gateway = self._gateway(FakeAiBackend(text='こんにちは'))
+        response = gateway.generate(AI_PRIMARY_MODEL, 'prompt', purpose='test')
+        self.assertEqual(response.text, 'こんにちは')
+
+        stats = gateway.snapshot()['models'][AI_PRIMARY_MODEL]
+        self.assertEqual((stats['calls'], stats['success']), (1, 1))
+        self.assertEqual((stats['prompt_tokens'], stats['output_tokens']), (6, 5))
+        self.assertEqual(stats['purposes'], {'test': 1})
+        self.assertIsNotNone(stats['p95_latency_ms'])
+        self.assertEqual(stats['circuit'], 'closed')
+
+    def test_rate_limited_model_falls_back(self):
+        backend = FakeAiBackend(text='ok', errors={AI_PRIMARY_MODEL: RuntimeError('429 RESOURCE_EXHAUSTED')})
+        gateway = self._gateway(backend)
+        response = gateway.generate(AI_PRIMARY_MODEL, 'prompt', fallback_models=(AI_FALLBACK_MODEL,))
+        self.assertEqual(response.text, 'ok')
+        self.assertEqual(backend.calls, [('generate', AI_PRIMARY_MODEL), ('generate', AI_FALLBACK_MODEL)])
+        self.assertEqual(gateway.snapshot()['models'][AI_PRIMARY_MODEL]['errors']['rate_limited'], 1)
+
+    def test_client_errors_are_raised_unchanged(self):
+        backend = FakeAiBackend(errors={AI_PRIMARY_MODEL: ValueError('400 INVALID_ARGUMENT')})
+        gateway = self._gateway(backend, failure_threshold=1)
+        with self.assertRaises(ValueError):
+            gateway.generate(AI_PRIMARY_MODEL, 'prompt', fallback_models=(AI_FALLBACK_MODEL,))
+        # リクエスト側の問題なのでフォールバックせず、ブレーカーも開かない
+        self.assertEqual(backend.calls, [('generate', AI_PRIMARY_MODEL)])
+        self.assertEqual(gateway.snapshot()['models'][AI_PRIMARY_MODEL]['circuit'], 'closed')
+
+    def test_circuit_opens_and_recovers(self):
+        backend = FakeAiBackend(text='ok', errors={AI_PRIMARY_MODEL: [RuntimeError('503 UNAVAILABLE')] * 2})
+        gateway = self._gateway(backend, failure_threshold=2, reset_timeout=0.05)
+        for _ in range(2):
+            with self.assertRaises(AiGatewayError) as ctx:
+                gateway.generate(AI_PRIMARY_MODEL, 'prompt')
+            self.assertEqual(ctx.exception.kind, 'upstream')
+
+        # 開いている間はバックエンドを呼ばずに即座に失敗する
+        with self.assertRaises(AiGatewayError) as ctx:
+            gateway.generate(AI_PRIMARY_MODEL, 'prompt')
+        self.assertEqual(ctx.exception.kind, 'circuit_open')
+        self.assertTrue(is_ai_rate_limit_error(ctx.exception))
+        self.assertEqual(len(backend.calls), 2)
+        self.assertEqual(gateway.snapshot()['models'][AI_PRIMARY_MODEL]['rejected'], 1)
+
+        time.sleep(0.06)
+        self.assertEqual(gateway.generate(AI_PRIMARY_MODEL, 'prompt').text, 'ok')
+        self.assertEqual(gateway.snapshot()['models'][AI_PRIMARY_MODEL]['circuit'], 'closed')
+
+    def test_token_bucket_limits_calls(self):
+        backend = FakeAiBackend(text='ok')
+        gateway = self._gateway(backend, rate_limits={AI_PRIMARY_MODEL: 6})  # 1件ずつ、10秒に1回
+        gateway.generate(AI_PRIMARY_MODEL, 'prompt', fallback_models=(AI_FALLBACK_MODEL,))
+        gateway.generate(AI_PRIMARY_MODEL, 'prompt', fallback_models=(AI_FALLBACK_MODEL,))
+        self.assertEqual(backend.calls, [('generate', AI_PRIMARY_MODEL), ('generate', AI_FALLBACK_MODEL)])
+        with self.assertRaises(AiGatewayError) as ctx:
+            gateway.generate(AI_PRIMARY_MODEL, 'prompt')
+        self.assertEqual(ctx.exception.kind, 'rate_limited')
+
+        bucket = AiTokenBucket(600, capacity=1)  # 0.1秒に1回
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire(max_wait=0))
+        self.assertTrue(bucket.acquire(max_wait=0.5))
+
+    def test_rate_limited_generate_retries_with_backoff(self):
+        backend = FakeAiBackend(text='ok', errors={AI_PRIMARY_MODEL: [RuntimeError('429')]})
+        gateway = self._gateway(backend)
+        self.assertEqual(gateway.generate(AI_PRIMARY_MODEL, 'prompt', retries=1, retry_delay=0).text, 'ok')
+        self.assertEqual(len(backend.calls), 2)
+
+    def test_stream_yields_chunks_and_counts_usage_once(self):
+        backend = FakeAiBackend(text='あいうえおかきくけこ', chunk_size=4,
+                                errors={AI_PRIMARY_MODEL: RuntimeError('429')})
+        gateway = self._gateway(backend)
+        chunks = [chunk.text for chunk in gateway.generate_stream(AI_PRIMARY_MODEL, 'prompt',
+                                                                  fallback_models=(AI_FALLBACK_MODEL,))]
+        self.assertEqual(chunks, ['あいうえ', 'おかきく', 'けこ'])
+        stats = gateway.snapshot()['models'][AI_FALLBACK_MODEL]
+        self.assertEqual((stats['success'], stats['output_tokens']), (1, 10))
+
+    def test_stream_can_be_closed_early(self):
+        gateway = self._gateway(FakeAiBackend(text='x' * 100, chunk_size=10))
+        stream = gateway.generate_stream(AI_PRIMARY_MODEL, 'prompt')
+        self.assertEqual(next(stream).text, 'x' * 10)
+        stream.close()
+        self.assertEqual(gateway.snapshot()['models'][AI_PRIMARY_MODEL]['success'], 1)
+
+
+class TestAiGatewayCallSites(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        self.backend = FakeAiBackend()
+        self.patcher = patch('app.AI_GATEWAY', AiGateway(self.backend, rate_limits={}, max_wait=0))
+        self.gateway = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.app_context.pop()
+
+    def test_query_embedding_goes_through_gateway(self):
+        self.backend.embedding = [0.5, 0.25]
+        vector = get_text_embedding('ゲートウェイ経由の埋め込みテスト')
+        self.assertEqual(list(vector), [0.5, 0.25])
+        self.assertEqual(self.backend.calls, [('embed', EMBEDDING_MODEL)])
+        self.assertEqual(self.gateway.snapshot()['models'][EMBEDDING_MODEL]['purposes'], {'query_embedding': 1})
+
+    def test_ai_search_reports_rate_limit_when_circuit_is_open(self):
+        problem = EssayProblem(chapter='97', type='A', university='ゲートウェイ大学', year=2001,
+                               question='ビザンツ帝国について述べよ', answer='解答例', answer_length=100)
+        db.session.add(problem)
+        db.session.commit()
+        invalidate_essay_search_index()
+        try:
+            self.backend.errors = {AI_PRIMARY_MODEL: RuntimeError('503 UNAVAILABLE'),
+                                   AI_FALLBACK_MODEL: RuntimeError('503 UNAVAILABLE')}
+            self.gateway.failure_threshold = 1
+            client = app.test_client()
+            payload = {'keywords': 'ビザンツ帝国', 'types': ['A'], 'year_start': 2001, 'year_end': 2001}
+
+            def search():
+                with patch('app.ensure_ai_grading_workers'):
+                    poll_url = client.post('/api/search_essays_ai', json=payload).get_json()['poll_url']
+                    drain_ai_grading_queue()
+                    return client.get(poll_url)
+
+            self.assertEqual(search().status_code, 500)
+
+            # 両モデルとも遮断中になったので、APIを呼ばずに混雑として返す
+            response = search()
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.get_json()['error_type'], 'rate_limit')
+            self.assertEqual(len(self.backend.calls), 2)
+        finally:
+            db.session.delete(problem)
+            db.session.commit()
+            invalidate_essay_search_index()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,322 @@
+import unittest
+from unittest.mock import patch
+import io
+import sys
+import os
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, User, AiGradingJob, enqueue_ai_grading_job, drain_ai_grading_queue,
+                 get_ai_grading_queue_position, _claim_next_ai_grading_job, essay_grading_cache_key,
+                 invalidate_essay_grading_cache, ESSAY_GRADING_CACHE, set_ai_job_partial, is_ai_job_abandoned,
+                 run_ai_thread_job, touch_ai_job, EssayProblem, EssayImage, store_essay_grading_cache,
+                 get_cached_essay_grading, ESSAY_GRADING_CACHE_TTL)
+
+
+class TestAiGradingQueue(TempDatabaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user_id = cls.create_user().id
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        AiGradingJob.query.delete()
+        db.session.commit()
+
+        # テストではワーカースレッドを起動せず、drain_ai_grading_queue() を直接呼ぶ
+        self.workers_patch = patch('app.ensure_ai_grading_workers')
+        self.workers_patch.start()
+
+    def tearDown(self):
+        self.workers_patch.stop()
+        AiGradingJob.query.delete()
+        db.session.commit()
+        self.app_context.pop()
+
+    def _enqueue_grade(self, user_id, answer):
+        return enqueue_ai_grading_job('grade', user_id, payload={
+            'problem_id': 1, 'user_answer': answer, 'feedback_style': 'concise'
+        })
+
+    def test_jobs_are_processed_in_order(self):
+        jobs = [self._enqueue_grade(self.user_id, f'答案{i}') for i in range(3)]
+        self.assertEqual([get_ai_grading_queue_position(job) for job in jobs], [0, 1, 2])
+
+        graded = []
+
+        def fake_grade(problem_id, user_answer, feedback_style, **kwargs):
+            graded.append(user_answer)
+            if user_answer == '答案1':
+                return {'status': 'error', 'message': 'NG'}, 500
+            return {'status': 'success', 'feedback': f'講評:{user_answer}'}, 200
+
+        with patch('app.grade_essay_answer', side_effect=fake_grade):
+            self.assertEqual(drain_ai_grading_queue(), 3)
+
+        self.assertEqual(graded, ['答案0', '答案1', '答案2'])
+        statuses = [db.session.get(AiGradingJob, job.id) for job in jobs]
+        self.assertEqual([job.status for job in statuses], ['done', 'error', 'done'])
+        self.assertEqual(statuses[1].result_status, 500)
+
+    def test_same_user_waits_for_running_job(self):
+        running = self._enqueue_grade(self.user_id, '実行中')
+        running.status = 'running'
+        queued_same_user = self._enqueue_grade(self.user_id, '次の答案')
+        queued_other = self._enqueue_grade(None, '別の人')
+        db.session.commit()
+
+        claimed = _claim_next_ai_grading_job()
+        self.assertEqual(claimed.id, queued_other.id)
+        self.assertIsNone(_claim_next_ai_grading_job())
+        self.assertEqual(db.session.get(AiGradingJob, queued_same_user.id).status, 'queued')
+
+    def test_running_news_update_does_not_block_own_grading(self):
+        news = enqueue_ai_grading_job('news', self.user_id)
+        news.status = 'running'
+        grade = self._enqueue_grade(self.user_id, '答案')
+        db.session.commit()
+
+        claimed = _claim_next_ai_grading_job()
+        self.assertEqual(claimed.id, grade.id)
+
+    def test_grade_endpoint_queues_and_poll_returns_result(self):
+        client = app.test_client()
+        with patch('app.GEMINI_API_KEY', 'test-key'):
+            response = client.post('/api/essay/grade', json={'problem_id': 1, 'user_answer': '答案'})
+        self.assertEqual(response.status_code, 202)
+        data = response.get_json()
+        self.assertEqual(data['status'], 'queued')
+        self.assertEqual(data['position'], 0)
+
+        response = client.get(data['poll_url'])
+        self.assertEqual(response.get_json()['status'], 'queued')
+
+        with patch('app.grade_essay_answer', return_value=({'status': 'success', 'feedback': 'OK'}, 200)):
+            drain_ai_grading_queue()
+
+        response = client.get(data['poll_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'status': 'success', 'feedback': 'OK'})
+
+    def test_search_jobs_run_before_queued_gradings(self):
+        grade = self._enqueue_grade(self.user_id, '答案')
+        search = enqueue_ai_grading_job('search', None, payload={'keywords': 'ウィーン会議', 'candidate_ids': [1]})
+        self.assertEqual(get_ai_grading_queue_position(search), 0)
+        self.assertEqual(get_ai_grading_queue_position(grade), 1)
+
+        order = []
+        with patch('app.run_essay_ai_search', side_effect=lambda *args: order.append('search') or ({'status': 'success', 'results': []}, 200)), \
+                patch('app.grade_essay_answer', side_effect=lambda *args, **kwargs: order.append('grade') or ({'status': 'success', 'feedback': 'OK'}, 200)):
+            self.assertEqual(drain_ai_grading_queue(), 2)
+        self.assertEqual(order, ['search', 'grade'])
+
+    def test_news_update_is_queued(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+            sess['admin_logged_in'] = True
+        with patch('app.update_world_news') as mock_update, patch('app.start_ai_thread_job') as mock_start:
+            response = client.post('/admin/update_news_now')
+            self.assertEqual(response.status_code, 202)
+            mock_update.assert_not_called()
+            job = mock_start.call_args[0][0]
+
+            # 採点ワーカーは拾わない（1分かかる更新で添削を待たせない）
+            self.assertEqual(drain_ai_grading_queue(), 0)
+            grade = self._enqueue_grade(self.user_id, '答案')
+            self.assertEqual(get_ai_grading_queue_position(grade), 0)
+
+            mock_update.return_value = (False, 'RSSフィードからニュースを取得できませんでした。')
+            run_ai_thread_job(job.id)
+        db.session.expire_all()  # 別スレッド相当のセッションで更新された状態を読み直す
+        response = client.get(response.get_json()['poll_url'])
+        self.assertEqual(response.get_json(), {'status': 'error', 'message': 'RSSフィードからニュースを取得できませんでした。'})
+
+    def test_poll_returns_partial_feedback_while_running(self):
+        job = self._enqueue_grade(None, '答案')
+        job.status = 'running'
+        db.session.commit()
+        set_ai_job_partial(job.job_token, '<h3>講評</h3>途中')
+
+        data = app.test_client().get(f'/api/essay/jobs/{job.job_token}').get_json()
+        self.assertEqual(data['status'], 'running')
+        self.assertEqual(data['partial'], '<h3>講評</h3>途中')
+
+    def test_cancelled_jobs_are_not_sent_to_ai(self):
+        queued = self._enqueue_grade(None, '取り消す答案')
+        running = self._enqueue_grade(None, '処理中の答案')
+        running.status = 'running'
+        db.session.commit()
+        client = app.test_client()
+        for job in (queued, running):
+            self.assertTrue(client.post(f'/api/essay/jobs/{job.job_token}/cancel').get_json()['cancelled'])
+
+        # 待機中のジョブはその場で取り消される
+        response = client.get(f'/api/essay/jobs/{queued.job_token}')
+        self.assertEqual(response.status_code, 499)
+        self.assertEqual(response.get_json()['error_type'], 'cancelled')
+        # 処理中のジョブはワーカーが打ち切る
+        self.assertTrue(is_ai_job_abandoned(running.job_token))
+
+    def test_abandoned_job_is_skipped(self):
+        job = self._enqueue_grade(None, '答案')
+        with patch('app.AI_JOB_ABANDON_TIMEOUT', -1), patch('app.grade_essay_answer') as mock_grade:
+            drain_ai_grading_queue()
+        mock_grade.assert_not_called()
+        self.assertEqual(db.session.get(AiGradingJob, job.id).result_status, 499)
+
+    def _grade_with_ticket(self, client, answer):
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+        with patch('app.GEMINI_API_KEY', 'test-key'):
+            response = client.post('/api/essay/grade', json={'problem_id': 1, 'user_answer': answer,
+                                                            'bypass_cache': True})
+        self.assertEqual(response.status_code, 202)
+        return AiGradingJob.query.filter_by(job_token=response.get_json()['job_id']).first()
+
+    def _tickets(self):
+        db.session.expire_all()
+        return db.session.get(User, self.user_id).ai_tickets
+
+    def test_ticket_is_refunded_when_cancelled_or_abandoned(self):
+        client = app.test_client()
+        queued = self._grade_with_ticket(client, '取り消す答案')
+        tickets = self._tickets()
+        client.post(f'/api/essay/jobs/{queued.job_token}/cancel')
+        self.assertEqual(self._tickets(), tickets + 1)
+        # 二重に取り消しても1枚しか戻らない
+        client.post(f'/api/essay/jobs/{queued.job_token}/cancel')
+        self.assertEqual(self._tickets(), tickets + 1)
+
+        abandoned = self._grade_with_ticket(client, '放置された答案')
+        with patch('app.AI_JOB_ABANDON_TIMEOUT', -1), patch('app.grade_essay_answer') as mock_grade:
+            drain_ai_grading_queue()
+        mock_grade.assert_not_called()
+        self.assertEqual(db.session.get(AiGradingJob, abandoned.id).result_status, 499)
+        self.assertEqual(self._tickets(), tickets + 1)
+
+        # 最後まで採点したものは戻さない
+        self._grade_with_ticket(client, '採点する答案')
+        with patch('app.grade_essay_answer', return_value=({'status': 'success', 'feedback': '講評'}, 200)):
+            drain_ai_grading_queue()
+        self.assertEqual(self._tickets(), tickets)
+
+    def test_abandon_timeout_grows_with_queue_position(self):
+        self._enqueue_grade(None, '先の答案')
+        job = self._enqueue_grade(None, '後の答案')
+        with patch('app.AI_JOB_ABANDON_TIMEOUT', -1), patch('app.AI_JOB_ABANDON_TIMEOUT_PER_JOB', 60):
+            self.assertFalse(is_ai_job_abandoned(job.job_token))  # 前に1件並んでいる
+            touch_ai_job(job.job_token, 0)
+            self.assertTrue(is_ai_job_abandoned(job.job_token))
+
+    def test_poll_hides_other_users_jobs(self):
+        job = self._enqueue_grade(self.user_id, '答案')
+        client = app.test_client()
+        response = client.get(f'/api/essay/jobs/{job.job_token}')
+        self.assertEqual(response.status_code, 404)
+
+
+
+class TestEssayGradingCache(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        AiGradingJob.query.delete()
+        db.session.commit()
+        ESSAY_GRADING_CACHE.clear()
+        self.workers_patch = patch('app.ensure_ai_grading_workers')
+        self.workers_patch.start()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.workers_patch.stop()
+        AiGradingJob.query.delete()
+        db.session.commit()
+        ESSAY_GRADING_CACHE.clear()
+        self.app_context.pop()
+
+    def _grade(self, answer, **extra):
+        with patch('app.GEMINI_API_KEY', 'test-key'):
+            return self.client.post('/api/essay/grade', json=dict({'problem_id': 1, 'user_answer': answer}, **extra))
+
+    def test_key_ignores_whitespace_and_markup(self):
+        self.assertEqual(essay_grading_cache_key(1, '<p>ナポレオンが\n 即位した</p>', 'concise'),
+                         essay_grading_cache_key(1, 'ナポレオンが即位した', 'concise'))
+        # 下線は採点に影響するため区別する
+        self.assertNotEqual(essay_grading_cache_key(1, '<u>ナポレオン</u>が即位した', 'concise'),
+                            essay_grading_cache_key(1, 'ナポレオンが即位した', 'concise'))
+        self.assertNotEqual(essay_grading_cache_key(1, 'ナポレオン', 'concise'),
+                            essay_grading_cache_key(1, 'ナポレオン', 'detailed'))
+
+    def test_resubmission_is_served_from_cache(self):
+        self.assertEqual(self._grade('ナポレオンが即位した').status_code, 202)
+        with patch('app.grade_essay_answer', return_value=({'status': 'success', 'feedback': '講評'}, 200)):
+            drain_ai_grading_queue()
+
+        with patch('app.consume_ai_ticket') as mock_ticket:
+            response = self._grade('<div>ナポレオンが 即位した</div>')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'status': 'success', 'feedback': '講評', 'cached': True})
+        mock_ticket.assert_not_called()
+        self.assertEqual(AiGradingJob.query.count(), 1)
+
+        # 明示的にキャッシュを使わない指定・問題の更新後は再採点する
+        self.assertEqual(self._grade('ナポレオンが即位した', bypass_cache=True).status_code, 202)
+        invalidate_essay_grading_cache(1)
+        self.assertEqual(self._grade('ナポレオンが即位した').status_code, 202)
+
+    def test_admin_writes_invalidate_cache(self):
+        problems = [EssayProblem(chapter='97', type='A', university='キャッシュ大学', year=2000 + i,
+                                 question=f'問題{i}', answer='解答例', answer_length=100) for i in range(2)]
+        db.session.add_all(problems)
+        db.session.commit()
+        edited_id, other_id = problems[0].id, problems[1].id
+        with self.client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+
+        store_essay_grading_cache('edited', edited_id, {'feedback': '古い講評'})
+        store_essay_grading_cache('other', other_id, {'feedback': '講評'})
+        self.client.post(f'/admin/essay/edit/{edited_id}', json={'answer': '新しい解答例'})
+        self.assertEqual(set(ESSAY_GRADING_CACHE), {'other'})
+
+        # 削除後はIDが再利用されうるため全件破棄する
+        self.client.post('/admin/essay/delete_problem', json={'problem_id': edited_id})
+        self.assertEqual(ESSAY_GRADING_CACHE, {})
+
+        store_essay_grading_cache('other', other_id, {'feedback': '講評'})
+        csv_data = f'id,chapter,type,university,year,question,answer\n{other_id},97,A,キャッシュ大学,2001,問題1,別の解答例\n'
+        self.client.post('/admin/essay/upload_csv', data={'file': (io.BytesIO(csv_data.encode('utf-8')), 'essay.csv')},
+                         content_type='multipart/form-data')
+        self.assertEqual(EssayProblem.query.get(other_id).answer, '別の解答例')
+        self.assertEqual(ESSAY_GRADING_CACHE, {})
+
+        db.session.add(EssayImage(problem_id=other_id, image_data=b'png', image_format='PNG'))
+        db.session.commit()
+        store_essay_grading_cache('other', other_id, {'feedback': '講評'})
+        response = self.client.post(f'/admin/delete_essay_image/{other_id}')
+        self.assertEqual(response.get_json()['status'], 'success')
+        self.assertEqual(ESSAY_GRADING_CACHE, {})
+
+        EssayProblem.query.delete()
+        db.session.commit()
+
+    def test_cache_entries_expire(self):
+        store_essay_grading_cache('key', 1, {'feedback': '講評'})
+        self.assertEqual(get_cached_essay_grading('key'), {'feedback': '講評'})
+        ESSAY_GRADING_CACHE['key']['timestamp'] -= ESSAY_GRADING_CACHE_TTL
+        self.assertIsNone(get_cached_essay_grading('key'))
+        self.assertNotIn('key', ESSAY_GRADING_CACHE)
+
+    def test_failed_grading_is_not_cached(self):
+        self._grade('答案')
+        with patch('app.grade_essay_answer', return_value=({'status': 'error', 'message': 'NG'}, 500)):
+            drain_ai_grading_queue()
+        self.assertEqual(ESSAY_GRADING_CACHE, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
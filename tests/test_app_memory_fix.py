@@ -6,6 +6,7 @@ import os
 # Add the project directory to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import temp_db  # noqa: F401  app より先に一時DBへ切り替える
 from app import app, cleanup_caches, WORD_DATA_CACHE
 
 class TestMemoryCleanup(unittest.TestCase):
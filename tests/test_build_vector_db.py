@@ -0,0 +1,142 @@
+import unittest
+import sys
+import os
+import json
+import pickle
+import time
+import tempfile
+
+import numpy as np
+
+# Add the project directory and scripts/ to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+
+import temp_db  # noqa: F401  app より先に一時DBへ切り替える
+import build_vector_db
+from build_vector_db import FakeEmbeddingBackend, RateLimiter
+from app import TextbookManager, EMBEDDING_MODEL
+
+
+class _FailingBackend(FakeEmbeddingBackend):
+    """指定した語を含むセクションだけ埋め込みに失敗する"""
+    def __init__(self, failing_word):
+        super().__init__()
+        self.failing_word = failing_word
+
+    def embed(self, text):
+        if self.failing_word in text:
+            raise RuntimeError('quota exceeded')
+        return super().embed(text)
+
+
+class TestIncrementalVectorBuild(unittest.TestCase):
+    SECTIONS = [
+        ('●ウィーン会議', 'メッテルニヒの主導でウィーン会議が開かれた。'),
+        ('●七月革命', 'フランスで七月革命がおこった。'),
+        ('●宋代の経済', '宋代には商業が発展した。'),
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmpdir.name
+        self._write_textbook(self.SECTIONS)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_textbook(self, sections):
+        with open(os.path.join(self.data_dir, build_vector_db.TEXTBOOK_FILENAME), 'w', encoding='utf-8') as f:
+            f.write("\n".join(f"{title}\n{content}" for title, content in sections))
+
+    def _build(self, backend, **kwargs):
+        return build_vector_db.build_vector_db(
+            backend, data_dir=self.data_dir, workers=3, rate_per_sec=0, map_essays=False, retry_delay=0, **kwargs
+        )
+
+    def test_full_build_is_loadable_by_app(self):
+        backend = FakeEmbeddingBackend()
+        stats = self._build(backend)
+        self.assertEqual(stats, {'total': 3, 'reused': 0, 'embedded': 3, 'failed': 0})
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, build_vector_db.CHECKPOINT_FILENAME)))
+
+        manager = TextbookManager()
+        manager.data_dir = self.data_dir
+        self.assertTrue(manager._load_vector_matrix())
+        self.assertEqual(manager.vector_titles, [title for title, _ in self.SECTIONS])
+        self.assertIsNotNone(manager.vector_codes)
+        # 同じ文章の埋め込みで検索すると、そのセクションが1位になる
+        query = backend.embed(build_vector_db.section_text(*self.SECTIONS[1]))
+        self.assertEqual(manager._search_vector_matrix(query, 1), ['●七月革命'])
+        self.assertEqual(manager.bm25_search_sections('七月革命', 1), ['●七月革命'])
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, build_vector_db.SECTION_INDEX_FILENAME)))
+        content, used = manager.get_relevant_content(['●宋代の経済'])
+        self.assertEqual(used, ['●宋代の経済'])
+        self.assertIn('商業が発展した', content)
+        manager.clear_memory()
+
+    def test_legacy_pickle_is_converted(self):
+        backend = FakeEmbeddingBackend()
+        legacy = [{'title': title, 'content': content, 'vector': backend.embed(content)}
+                  for title, content in self.SECTIONS]
+        with open(os.path.join(self.data_dir, build_vector_db.LEGACY_PICKLE_FILENAME), 'wb') as f:
+            pickle.dump(legacy, f)
+
+        build_vector_db.convert_legacy_pickle(self.data_dir, map_essays=False)
+        with open(os.path.join(self.data_dir, build_vector_db.MANIFEST_FILENAME), encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['model'], EMBEDDING_MODEL)
+        # 変換後の差分ビルドでは同じモデルのベクトルとして再利用される
+        reusable = build_vector_db.load_previous_vectors(self.data_dir, EMBEDDING_MODEL)
+        self.assertEqual(len(reusable), len(self.SECTIONS))
+
+    def test_unchanged_sections_are_reused(self):
+        self._build(FakeEmbeddingBackend())
+        first_matrix = np.load(os.path.join(self.data_dir, build_vector_db.MATRIX_FILENAME))
+
+        backend = FakeEmbeddingBackend()
+        stats = self._build(backend)
+        self.assertEqual(stats, {'total': 3, 'reused': 3, 'embedded': 0, 'failed': 0})
+        self.assertEqual(backend.calls, [])
+        np.testing.assert_allclose(np.load(os.path.join(self.data_dir, build_vector_db.MATRIX_FILENAME)), first_matrix, rtol=1e-6)
+
+        # 1セクションだけ書き換えたらそこだけ埋め込み直す
+        edited = list(self.SECTIONS)
+        edited[2] = ('●宋代の経済', '宋代には商業が発展し、紙幣が使われた。')
+        self._write_textbook(edited)
+        backend = FakeEmbeddingBackend()
+        stats = self._build(backend)
+        self.assertEqual((stats['reused'], stats['embedded']), (2, 1))
+        self.assertEqual(len(backend.calls), 1)
+        self.assertIn('紙幣', backend.calls[0])
+
+        # --full は前回の結果を使わない
+        backend = FakeEmbeddingBackend()
+        self.assertEqual(self._build(backend, full=True)['embedded'], 3)
+
+    def test_failed_sections_resume_from_checkpoint(self):
+        stats = self._build(_FailingBackend('宋代'))
+        self.assertEqual((stats['embedded'], stats['failed']), (2, 1))
+        checkpoint_path = os.path.join(self.data_dir, build_vector_db.CHECKPOINT_FILENAME)
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+        with open(os.path.join(self.data_dir, build_vector_db.TITLES_FILENAME), 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f), ['●ウィーン会議', '●七月革命'])
+
+        # 保存前に止まった場合（マニフェストなし）もチェックポイントから再開できる
+        os.remove(os.path.join(self.data_dir, build_vector_db.MANIFEST_FILENAME))
+        backend = FakeEmbeddingBackend()
+        stats = self._build(backend)
+        self.assertEqual((stats['reused'], stats['embedded'], stats['failed']), (2, 1, 0))
+        self.assertEqual(len(backend.calls), 1)
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.07)
+
+
+if __name__ == '__main__':
+    unittest.main()
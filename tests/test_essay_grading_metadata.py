@@ -0,0 +1,79 @@
+import unittest
+import sys
+import os
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import app, db, EssayProblem, compute_essay_grading_metadata, backfill_essay_grading_metadata
+
+
+class TestComputeEssayGradingMetadata(unittest.TestCase):
+    def test_max_limit(self):
+        metadata = compute_essay_grading_metadata('<b>フランス革命</b>について150字以内で述べよ。', '解答')
+        self.assertEqual(metadata['grading_max_length'], 150)
+        self.assertEqual(metadata['grading_min_length'], 0)
+        self.assertEqual(metadata['clean_question'], 'フランス革命について150字以内で述べよ。')
+
+    def test_min_and_range_limits(self):
+        metadata = compute_essay_grading_metadata('300字以上で説明せよ。', '解答')
+        self.assertEqual((metadata['grading_max_length'], metadata['grading_min_length']), (0, 300))
+
+        metadata = compute_essay_grading_metadata('100〜120字で説明せよ。', '解答')
+        self.assertEqual((metadata['grading_max_length'], metadata['grading_min_length']), (120, 100))
+
+    def test_heuristic_limit_ignores_minimum(self):
+        metadata = compute_essay_grading_metadata('60字程度で答えよ。（ただし20字以上）', '解答')
+        self.assertEqual((metadata['grading_max_length'], metadata['grading_min_length']), (60, 20))
+
+    def test_model_answer_length_excludes_tags_and_spaces(self):
+        metadata = compute_essay_grading_metadata('述べよ。', '<u>ナポレオン</u> が\n即位した')
+        self.assertEqual(metadata['model_answer_clean_length'], 10)
+        self.assertEqual(compute_essay_grading_metadata('述べよ。', '')['model_answer_clean_length'], 0)
+
+
+class TestBackfillEssayGradingMetadata(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        problem = EssayProblem(
+            chapter='97', type='A', university='テスト大学', year=2000,
+            question='ウィーン体制について200字以内で述べよ。', answer='解答例です', answer_length=5
+        )
+        db.session.add(problem)
+        db.session.commit()
+        self.problem_id = problem.id
+
+    def tearDown(self):
+        EssayProblem.query.filter_by(id=self.problem_id).delete()
+        db.session.commit()
+        self.app_context.pop()
+
+    def test_backfill_fills_missing_rows(self):
+        problem = db.session.get(EssayProblem, self.problem_id)
+        self.assertIsNone(problem.model_answer_clean_length)
+        # 未計算でも採点時はその場で計算される
+        self.assertEqual(problem.get_grading_metadata()['grading_max_length'], 200)
+
+        self.assertGreaterEqual(backfill_essay_grading_metadata(), 1)
+        problem = db.session.get(EssayProblem, self.problem_id)
+        self.assertEqual(problem.grading_max_length, 200)
+        self.assertEqual(problem.model_answer_clean_length, 5)
+        self.assertEqual(backfill_essay_grading_metadata(), 0)
+
+    def test_admin_edit_refreshes_metadata(self):
+        backfill_essay_grading_metadata()
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+        response = client.post(f'/admin/essay/edit/{self.problem_id}',
+                               json={'question': 'ウィーン体制について100字以内で述べよ。', 'answer': '<u>新しい</u>解答例'})
+        self.assertEqual(response.status_code, 200)
+        problem = db.session.get(EssayProblem, self.problem_id)
+        self.assertEqual(problem.grading_max_length, 100)
+        self.assertEqual(problem.model_answer_clean_length, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
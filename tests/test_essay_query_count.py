@@ -0,0 +1,100 @@
+import unittest
+import sys
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, User, EssayProblem, EssayProgress,
+                 get_filtered_essay_problems_with_visibility, invalidate_essay_visibility_cache,
+                 invalidate_essay_search_index)
+
+
+@contextmanager
+def capture_queries():
+    """実行されたSQL文を記録する"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class TestEssayQueryCount(TempDatabaseTestCase):
+    PROBLEM_COUNT = 20
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.create_user()
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        self.user = User.query.first()
+        self.problem_ids = []
+        for i in range(self.PROBLEM_COUNT):
+            problem = EssayProblem(
+                chapter='99', type='A', university='テスト大学', year=2000 + i,
+                question=f'ナポレオン戦争について述べよ{i}', answer='解答例', answer_length=100
+            )
+            db.session.add(problem)
+            db.session.flush()
+            self.problem_ids.append(problem.id)
+            if i % 2 == 0:
+                db.session.add(EssayProgress(user_id=self.user.id, problem_id=problem.id, understood=True))
+        db.session.commit()
+        invalidate_essay_visibility_cache()
+        invalidate_essay_search_index()
+
+        # commit後の再読込クエリを計測に含めないよう先に取り出しておく
+        self.user_id = self.user.id
+        self.room_number = self.user.room_number
+
+    def tearDown(self):
+        EssayProgress.query.filter(EssayProgress.problem_id.in_(self.problem_ids)).delete(synchronize_session=False)
+        EssayProblem.query.filter(EssayProblem.id.in_(self.problem_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        self.app_context.pop()
+
+    def test_progress_is_loaded_in_one_query(self):
+        """問題数に関わらず進捗取得は1クエリで済む"""
+        with capture_queries() as statements:
+            problems = get_filtered_essay_problems_with_visibility('99', self.room_number, user_id=self.user_id)
+
+        self.assertEqual(len(problems), self.PROBLEM_COUNT)
+        understood = [p for p in problems if p.progress['understood']]
+        self.assertEqual(len(understood), self.PROBLEM_COUNT // 2)
+
+        progress_queries = [s for s in statements if 'essay_progress' in s]
+        self.assertEqual(len(progress_queries), 1)
+        # 問題一覧 + 公開設定 + 進捗
+        self.assertLessEqual(len(statements), 3)
+
+    def test_find_related_essays_skips_progress(self):
+        """関連問題検索は進捗テーブルに触れない"""
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+
+        with capture_queries() as statements:
+            response = client.post('/api/find_related_essays', json={'keywords': ['ナポレオン'], 'chapters': ['99']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()['essays']), 5)
+        self.assertFalse([s for s in statements if 'essay_progress' in s])
+        self.assertLessEqual(len(statements), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, EssayProblem, search_essay_candidate_ids, search_essays_ranked, rank_essays_bm25,
+                 get_filtered_essay_problems_with_visibility, invalidate_essay_search_index,
+                 invalidate_essay_visibility_cache, drain_ai_grading_queue)
+
+
+class TestEssaySearchIndex(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        self.problem_ids = []
+        for university, year, question, enabled in [
+            ('検索大学', 2001, 'ウィーン会議について述べよ。ウィーン体制の崩壊にも触れること。', True),
+            ('検索大学', 2005, 'ウィーン会議の結果を説明せよ。', True),
+            ('ナポレオン大学', 2003, 'ＦＲＡＮＣＥ革命の影響を述べよ。', True),
+            ('検索大学', 2010, 'ウィーン会議の意義を述べよ。', False),
+        ]:
+            problem = EssayProblem(
+                chapter='98', type='A', university=university, year=year,
+                question=question, answer='解答例', answer_length=100, enabled=enabled
+            )
+            db.session.add(problem)
+            db.session.flush()
+            self.problem_ids.append(problem.id)
+        db.session.commit()
+        invalidate_essay_search_index()
+        invalidate_essay_visibility_cache()
+
+    def tearDown(self):
+        EssayProblem.query.filter(EssayProblem.id.in_(self.problem_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        invalidate_essay_search_index()
+        self.app_context.pop()
+
+    def test_candidates_are_narrowed_by_bigrams(self):
+        candidates = search_essay_candidate_ids('ウィーン会議')
+        self.assertTrue({self.problem_ids[0], self.problem_ids[1], self.problem_ids[3]} <= candidates)
+        self.assertNotIn(self.problem_ids[2], candidates)
+        self.assertEqual(search_essay_candidate_ids('存在しない語句'), set())
+        # 1文字の語はインデックスで絞り込めない
+        self.assertIsNone(search_essay_candidate_ids('会'))
+
+    def test_ranked_search_orders_by_relevance(self):
+        rows = [r for r in search_essays_ranked('ウィーン') if r.id in self.problem_ids]
+        # 出現回数の多い問題が先、無効な問題は含まない
+        self.assertEqual([r.id for r in rows], [self.problem_ids[0], self.problem_ids[1]])
+
+    def test_ranked_search_normalizes_and_requires_all_terms(self):
+        rows = search_essays_ranked('france 革命')
+        self.assertEqual([r.id for r in rows], [self.problem_ids[2]])
+        rows = search_essays_ranked('ナポレオン')
+        self.assertEqual([r.id for r in rows], [self.problem_ids[2]])
+        self.assertEqual(search_essays_ranked('ウィーン 革命'), [])
+
+    def test_index_is_rebuilt_after_invalidation(self):
+        self.assertEqual(search_essay_candidate_ids('産業革命'), set())
+        problem = EssayProblem(
+            chapter='98', type='A', university='検索大学', year=2020,
+            question='産業革命について述べよ。', answer='解答例', answer_length=100
+        )
+        db.session.add(problem)
+        db.session.commit()
+        self.problem_ids.append(problem.id)
+
+        invalidate_essay_search_index()
+        self.assertEqual(search_essay_candidate_ids('産業革命'), {problem.id})
+
+    def test_admin_edit_and_delete_update_index(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+        target_id = self.problem_ids[2]
+        self.assertEqual(search_essay_candidate_ids('産業革命'), set())
+
+        response = client.post(f'/admin/essay/edit/{target_id}', json={'question': '産業革命について述べよ。'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(search_essay_candidate_ids('産業革命'), {target_id})
+
+        response = client.post('/admin/essay/delete_problem', json={'problem_id': target_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(search_essay_candidate_ids('産業革命'), set())
+
+    def test_keyword_filter_uses_index(self):
+        problems = get_filtered_essay_problems_with_visibility('98', '101', keyword='ウィーン会議')
+        self.assertEqual({p.id for p in problems}, set(self.problem_ids[:2]))
+        self.assertEqual(get_filtered_essay_problems_with_visibility('98', '101', keyword='存在しない語句'), [])
+
+
+    def test_bm25_ranks_within_candidates(self):
+        ranked = rank_essays_bm25('ウィーン体制', candidate_ids=set(self.problem_ids))
+        self.assertEqual(ranked[0][0], self.problem_ids[0])
+        self.assertNotIn(self.problem_ids[2], [problem_id for problem_id, _ in ranked])
+
+        ranked = rank_essays_bm25('ウィーン体制', candidate_ids={self.problem_ids[1]})
+        self.assertEqual([problem_id for problem_id, _ in ranked], [self.problem_ids[1]])
+
+    def test_bm25_scores_single_character_terms(self):
+        """唐・宋のような1文字の語もbigramなしで採点する"""
+        ids = []
+        for question in ['唐の律令制と唐の滅亡について述べよ。', '宋の科挙について述べよ。', '唐代の文化を説明せよ。']:
+            problem = EssayProblem(
+                chapter='98', type='C', university='王朝大学', year=2000,
+                question=question, answer='解答例', answer_length=100
+            )
+            db.session.add(problem)
+            db.session.flush()
+            ids.append(problem.id)
+        db.session.commit()
+        self.problem_ids.extend(ids)
+        invalidate_essay_search_index()
+
+        ranked = rank_essays_bm25('唐', candidate_ids=set(self.problem_ids))
+        self.assertEqual([problem_id for problem_id, _ in ranked], [ids[0], ids[2]])
+
+        ranked = rank_essays_bm25('宋 科挙', candidate_ids={ids[0], ids[1]})
+        self.assertEqual([problem_id for problem_id, _ in ranked], [ids[1]])
+
+    def test_ai_search_sees_whole_filtered_corpus(self):
+        """件数で打ち切らず、絞り込み結果全体から関連度の高い問題をAIへ渡す"""
+        target = EssayProblem(
+            chapter='98', type='B', university='埋め草大学', year=1990,
+            question='東方問題とクリミア戦争について述べよ。', answer='解答例', answer_length=100
+        )
+        db.session.add(target)
+        db.session.flush()
+        self.problem_ids.append(target.id)
+        for i in range(210):
+            problem = EssayProblem(
+                chapter='98', type='B', university='埋め草大学', year=1990,
+                question=f'関係のない問題{i}', answer='解答例', answer_length=100
+            )
+            db.session.add(problem)
+            db.session.flush()
+            self.problem_ids.append(problem.id)
+        db.session.commit()
+        invalidate_essay_search_index()
+
+        client = MagicMock()
+        client.models.generate_content.return_value.text = f'[{target.id}]'
+        test_client = app.test_client()
+        # AI選定は待ち行列で処理される（テストではワーカーを起動せず直接処理する）
+        with patch('app.get_genai_client', return_value=client), patch('app.ensure_ai_grading_workers'):
+            response = test_client.post('/api/search_essays_ai', json={
+                'keywords': 'クリミア戦争', 'types': ['B'], 'year_start': 1990, 'year_end': 1990
+            })
+            self.assertEqual(response.status_code, 202)
+            poll_url = response.get_json()['poll_url']
+            drain_ai_grading_queue()
+            response = test_client.get(poll_url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['id'] for r in response.get_json()['results']], [target.id])
+        prompt = client.models.generate_content.call_args.kwargs['contents']
+        self.assertIn('クリミア戦争', prompt)
+
+
+if __name__ == '__main__':
+    unittest.main()
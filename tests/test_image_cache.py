@@ -0,0 +1,116 @@
+import unittest
+import sys
+import os
+import hashlib
+
+from sqlalchemy import event
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, EssayProblem, EssayImage, EssayCorrectionRequest, CorrectionRequestImage, MapImage, User,
+                 IMAGE_IMMUTABLE_CACHE_CONTROL, essay_image_url, correction_image_url, map_image_url)
+
+PNG_BYTES = b'\x89PNG\r\n\x1a\n' + b'image-cache-test' * 64
+
+
+class TestVersionedImageCache(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        self.client = app.test_client()
+        self.image_hash = hashlib.md5(PNG_BYTES).hexdigest()
+        self.cleanup = []
+
+    def tearDown(self):
+        for obj in reversed(self.cleanup):
+            db.session.delete(db.session.merge(obj))
+        db.session.commit()
+        self.app_context.pop()
+
+    def _add(self, obj):
+        db.session.add(obj)
+        db.session.commit()
+        self.cleanup.append(obj)
+        return obj
+
+    def _count_blob_reads(self, url, **kwargs):
+        """レスポンスと、その間に image_data を読んだSQLの数を返す"""
+        statements = []
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_execute)
+        try:
+            response = self.client.get(url, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_execute)
+        return response, sum(1 for s in statements if 'image_data' in s.split('FROM')[0])
+
+    def _assert_cached(self, versioned_url, unversioned_url, mimetype):
+        response, blob_reads = self._count_blob_reads(versioned_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, PNG_BYTES)
+        self.assertEqual(response.headers['ETag'], f'"{self.image_hash}"')
+        self.assertEqual(response.headers['Cache-Control'], IMAGE_IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(response.mimetype, mimetype)
+        self.assertEqual(blob_reads, 1)
+
+        # 再検証は画像本体を読まずに304
+        response, blob_reads = self._count_blob_reads(
+            versioned_url, headers={'If-None-Match': f'"{self.image_hash}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(blob_reads, 0)
+
+        # バージョンなしのURLは毎回再検証させる
+        response = self.client.get(unversioned_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+    def test_essay_image(self):
+        problem = self._add(EssayProblem(chapter='98', type='A', university='画像大学', year=2002,
+                                         question='問題', answer='解答', answer_length=100))
+        self._add(EssayImage(problem_id=problem.id, image_data=PNG_BYTES, image_format='PNG',
+                             image_hash=self.image_hash))
+        with app.test_request_context():
+            versioned_url = essay_image_url(problem.id, self.image_hash)
+            unversioned_url = essay_image_url(problem.id)
+        self.assertIn(self.image_hash, versioned_url)
+        self._assert_cached(versioned_url, unversioned_url, 'image/png')
+
+        # 古いバージョンのURLは長期キャッシュさせない
+        response = self.client.get(unversioned_url + '/stale')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(self.client.get('/essay_image/999999').status_code, 404)
+
+    def test_correction_image(self):
+        problem = self._add(EssayProblem(chapter='98', type='A', university='画像大学', year=2003,
+                                         question='問題', answer='解答', answer_length=100))
+        user = User(room_number='9999', student_id='image-cache', username='image_cache_user',
+                    original_username='image_cache_user')
+        user.set_room_password('room')
+        user.set_individual_password('pass')
+        self._add(user)
+        req = self._add(EssayCorrectionRequest(user_id=user.id, problem_id=problem.id, status='pending'))
+        image = self._add(CorrectionRequestImage(request_id=req.id, image_type='request', image_data=PNG_BYTES,
+                                                 image_format='JPEG', image_hash=self.image_hash))
+        with app.test_request_context():
+            versioned_url = correction_image_url(image.id, self.image_hash)
+            unversioned_url = correction_image_url(image.id)
+        self._assert_cached(versioned_url, unversioned_url, 'image/jpeg')
+
+    def test_map_image(self):
+        filename = 'image_cache_test_map.png'
+        self._add(MapImage(name='キャッシュ地図', filename=filename, image_data=PNG_BYTES, image_hash=self.image_hash))
+        with app.test_request_context():
+            versioned_url = map_image_url(filename, self.image_hash)
+            unversioned_url = map_image_url(filename)
+        self.assertIn(f'v={self.image_hash}', versioned_url)
+        self._assert_cached(versioned_url, unversioned_url, 'image/png')
+
+
+if __name__ == '__main__':
+    unittest.main()
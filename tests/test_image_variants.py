@@ -0,0 +1,214 @@
+import unittest
+import sys
+import os
+import io
+import hashlib
+
+from PIL import Image
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, RpgEnemy, MapImage, EssayProblem, EssayImage, ImageVariant, IMAGE_VARIANT_WIDTHS, IMAGE_IMMUTABLE_CACHE_CONTROL,
+                 build_image_variant, image_variant_url, image_variant_srcset, backfill_image_variants,
+                 image_variant_report, IMAGE_VARIANT_SRCSET_CACHE)
+
+
+def make_image(size, fmt='PNG', mode='RGB'):
+    image = Image.effect_noise(size, 40).convert(mode)
+    if mode == 'RGBA':
+        image.putalpha(128)  # 半透明（不透明だとWebPはアルファを省く）
+    output = io.BytesIO()
+    image.save(output, format=fmt)
+    return output.getvalue()
+
+
+class TestBuildImageVariant(unittest.TestCase):
+    def test_resizes_and_converts(self):
+        data, image_format, pixel_width = build_image_variant(make_image((800, 400)), 160)
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.format, image_format)
+            self.assertEqual(image.size, (160, 80))
+        self.assertEqual(pixel_width, 160)
+
+    def test_keeps_transparency(self):
+        data, _, _ = build_image_variant(make_image((400, 400), mode='RGBA'), 160)
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertIn('A', image.getbands())
+
+    def test_never_upscales_or_grows(self):
+        small = make_image((100, 50), fmt='JPEG')
+        data, image_format, pixel_width = build_image_variant(small, 320)
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.size, (100, 50))
+        self.assertEqual(pixel_width, 100)
+        self.assertLessEqual(len(data), len(small))
+
+
+class TestImageVariantServing(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        self.client = app.test_client()
+        self.icon = make_image((640, 640))
+        self.icon_hash = hashlib.md5(self.icon).hexdigest()
+        self.enemy = RpgEnemy(name='派生版テスト', badge_name='派生版の証', icon_image='icon.png',
+                              icon_image_content=self.icon, icon_image_mimetype='image/png',
+                              icon_image_hash=self.icon_hash)
+        db.session.add(self.enemy)
+        db.session.commit()
+        self.enemy_id = self.enemy.id
+
+    def tearDown(self):
+        ImageVariant.query.filter_by(source_id=self.enemy_id).delete()
+        MapImage.query.filter_by(filename='variant_test_map.png').delete()
+        db.session.delete(db.session.get(RpgEnemy, self.enemy_id))
+        db.session.commit()
+        self.app_context.pop()
+
+    def _variants(self):
+        return ImageVariant.query.filter_by(source_type='rpg_icon', source_id=self.enemy_id)
+
+    def test_variant_is_created_on_first_request_and_reused(self):
+        with app.test_request_context():
+            url = image_variant_url('rpg_icon', self.enemy_id, self.icon_hash, 160)
+            # 派生版がまだなければ srcset は出さない（幅が分からない）
+            self.assertEqual(image_variant_srcset('rpg_icon', self.enemy_id, self.icon_hash), '')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], IMAGE_IMMUTABLE_CACHE_CONTROL)
+        with Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.width, 160)
+        self.assertEqual(self._variants().count(), 1)
+        variant = self._variants().first()
+        self.assertEqual((variant.source_size, variant.byte_size), (len(self.icon), len(response.data)))
+        self.assertLess(variant.byte_size, variant.source_size)
+
+        # 2回目は保存済みの派生版、再検証は304
+        self.assertEqual(self.client.get(url).data, response.data)
+        response = self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self._variants().count(), 1)
+
+    def test_srcset_lists_real_widths(self):
+        with app.test_request_context():
+            backfill_image_variants(['rpg_icon'])
+            srcset = image_variant_srcset('rpg_icon', self.enemy_id, self.icon_hash)
+            self.assertEqual(srcset, ', '.join(
+                f'{image_variant_url("rpg_icon", self.enemy_id, self.icon_hash, width)} {width}w'
+                for width in IMAGE_VARIANT_WIDTHS['rpg_icon']))
+
+            # 元画像（200px）より広い幅は載せず、元のサイズを実際の幅で載せる
+            narrow = make_image((200, 100))
+            narrow_hash = hashlib.md5(narrow).hexdigest()
+            enemy = db.session.get(RpgEnemy, self.enemy_id)
+            enemy.icon_image_content = narrow
+            enemy.icon_image_hash = narrow_hash
+            db.session.commit()
+            backfill_image_variants(['rpg_icon'])
+            srcset = image_variant_srcset('rpg_icon', self.enemy_id, narrow_hash)
+            self.assertEqual(srcset.split(', '), [
+                f'{image_variant_url("rpg_icon", self.enemy_id, narrow_hash, 160)} 160w',
+                f'{image_variant_url("rpg_icon", self.enemy_id, narrow_hash, 320)} 200w',
+            ])
+
+    def test_replaced_image_redirects_and_drops_old_variants(self):
+        with app.test_request_context():
+            old_url = image_variant_url('rpg_icon', self.enemy_id, self.icon_hash, 160)
+        self.client.get(old_url)
+
+        new_icon = make_image((300, 300))
+        enemy = db.session.get(RpgEnemy, self.enemy_id)
+        enemy.icon_image_content = new_icon
+        enemy.icon_image_hash = hashlib.md5(new_icon).hexdigest()
+        db.session.commit()
+
+        response = self.client.get(old_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(enemy.icon_image_hash, response.headers['Location'])
+        self.assertEqual(self.client.get(response.headers['Location']).status_code, 200)
+        self.assertEqual([v.source_hash for v in self._variants()], [enemy.icon_image_hash])
+
+        self.assertEqual(self.client.get(old_url.replace('/160/', '/100/')).status_code, 404)
+
+    def test_mimetype_follows_served_bytes(self):
+        # ノイズの多い小さなJPEGはWebPにしても小さくならず、元のJPEGのまま返る
+        photo = make_image((300, 200), fmt='JPEG')
+        problem = EssayProblem(chapter='98', type='A', university='派生版大学', year=2004,
+                               question='問題', answer='解答', answer_length=100)
+        db.session.add(problem)
+        db.session.commit()
+        photo_hash = hashlib.md5(photo).hexdigest()
+        db.session.add(EssayImage(problem_id=problem.id, image_data=photo, image_format='JPEG', image_hash=photo_hash))
+        db.session.commit()
+        try:
+            with app.test_request_context():
+                url = image_variant_url('essay', problem.id, photo_hash, 480)
+            for _ in range(2):  # 初回（その場で作成）と保存済みの両方
+                response = self.client.get(url)
+                with Image.open(io.BytesIO(response.data)) as image:
+                    self.assertEqual(response.mimetype, Image.MIME[image.format])
+            self.assertEqual(response.data, photo)
+            self.assertEqual(response.mimetype, 'image/jpeg')
+        finally:
+            ImageVariant.query.filter_by(source_type='essay', source_id=problem.id).delete()
+            EssayImage.query.filter_by(problem_id=problem.id).delete()
+            db.session.delete(problem)
+            db.session.commit()
+
+    def test_deleting_source_drops_variants(self):
+        """敵・地図・論述問題の画像を削除したら派生版の行も残さない"""
+        with self.client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+        image = make_image((400, 300))
+        image_hash = hashlib.md5(image).hexdigest()
+        enemy = RpgEnemy(name='削除される敵', icon_image='icon.png', icon_image_content=image, icon_image_hash=image_hash,
+                         badge_image='badge.png', badge_image_content=image, badge_image_hash=image_hash)
+        map_image = MapImage(name='削除される地図', filename='variant_test_map.png', image_data=image, image_hash=image_hash)
+        problem = EssayProblem(chapter='98', type='A', university='派生版大学', year=2005,
+                               question='問題', answer='解答', answer_length=100)
+        db.session.add_all([enemy, map_image, problem])
+        db.session.commit()
+        db.session.add(EssayImage(problem_id=problem.id, image_data=image, image_format='PNG', image_hash=image_hash))
+        db.session.commit()
+        sources = [('rpg_icon', enemy.id), ('rpg_badge', enemy.id), ('map', map_image.id), ('essay', problem.id)]
+        with app.test_request_context():
+            backfill_image_variants(['rpg_icon', 'rpg_badge', 'map', 'essay'])
+            for source_type, source_id in sources:
+                self.assertTrue(image_variant_srcset(source_type, source_id, image_hash))
+        try:
+            self.client.post(f'/admin/rpg/enemies/delete/{sources[0][1]}')
+            self.client.post(f'/admin/api/map_quiz/map/{sources[2][1]}/delete')
+            self.client.post(f'/admin/delete_essay_image/{sources[3][1]}')
+            for source_type, source_id in sources:
+                self.assertEqual(ImageVariant.query.filter_by(source_type=source_type, source_id=source_id).count(), 0)
+                self.assertNotIn((source_type, source_id, image_hash), IMAGE_VARIANT_SRCSET_CACHE)
+        finally:
+            EssayProblem.query.filter_by(id=sources[3][1]).delete()
+            db.session.commit()
+
+    def test_backfill_and_report(self):
+        map_image = MapImage(name='派生版地図', filename='variant_test_map.png', image_data=make_image((500, 300)))
+        map_image.image_hash = hashlib.md5(map_image.image_data).hexdigest()
+        db.session.add(map_image)
+        db.session.commit()
+        map_id = map_image.id
+        try:
+            counts = backfill_image_variants(['rpg_icon', 'map'])
+            self.assertGreaterEqual(counts['rpg_icon'], 1)
+            self.assertEqual(self._variants().count(), len(IMAGE_VARIANT_WIDTHS['rpg_icon']))
+            self.assertEqual(ImageVariant.query.filter_by(source_type='map', source_id=map_id).count(), 1)
+
+            report = {(row['source_type'], row['width']): row for row in image_variant_report()}
+            row = report[('rpg_icon', 160)]
+            self.assertEqual(row['saved_bytes'], row['source_bytes'] - row['variant_bytes'])
+            self.assertGreater(row['saved_bytes'], 0)
+        finally:
+            ImageVariant.query.filter_by(source_type='map', source_id=map_id).delete()
+            db.session.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import sys
+import os
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, CsvFileContent, build_keyword_automaton, find_keywords_in_text,
+                 extract_keywords_from_text, get_answer_keyword_matcher, ANSWER_KEYWORD_MATCHER_CACHE)
+
+
+class TestKeywordAutomaton(unittest.TestCase):
+    def test_finds_overlapping_keywords(self):
+        matcher = build_keyword_automaton(['ウィーン', 'ウィーン会議', '会議', 'he', 'she', 'hers'])
+        found = find_keywords_in_text(matcher, 'ウィーン会議とushers')
+        self.assertEqual(set(found), {'ウィーン', 'ウィーン会議', '会議', 'she', 'he', 'hers'})
+        self.assertEqual(found['会議'], 4)
+        self.assertEqual(found['she'], 8)
+
+    def test_no_match(self):
+        matcher = build_keyword_automaton(['ルター'])
+        self.assertEqual(find_keywords_in_text(matcher, 'カルヴァン'), {})
+
+
+class TestExtractKeywords(TempDatabaseTestCase):
+    FILENAME = 'test_keyword_matcher.csv'
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        ANSWER_KEYWORD_MATCHER_CACHE.clear()
+        content = 'chapter,number,category,question,answer\n1,1,A,問1,ウィーン会議\n1,2,A,問2,メッテルニヒ\n1,3,A,問3,会\n1,4,A,問4,ウィーン会議\n'
+        self.record = CsvFileContent(filename=self.FILENAME, original_filename=self.FILENAME,
+                                     content=content, file_size=len(content), word_count=4)
+        db.session.add(self.record)
+        db.session.commit()
+
+    def tearDown(self):
+        CsvFileContent.query.filter_by(filename=self.FILENAME).delete()
+        db.session.commit()
+        ANSWER_KEYWORD_MATCHER_CACHE.clear()
+        self.app_context.pop()
+
+    def test_extracts_longest_first(self):
+        keywords = extract_keywords_from_text('メッテルニヒがウィーン会議を主導した')
+        self.assertEqual(keywords[:2], ['メッテルニヒ', 'ウィーン会議'])
+        self.assertNotIn('会', keywords)
+
+        _, word_by_answer = get_answer_keyword_matcher()
+        self.assertEqual(word_by_answer['ウィーン会議']['number'], '1')
+
+    def test_rebuilt_only_when_csv_changes(self):
+        matcher, _ = get_answer_keyword_matcher()
+        self.assertIs(get_answer_keyword_matcher()[0], matcher)
+
+        content = self.record.content + '1,5,A,問5,神聖同盟\n'
+        self.record.content = content
+        self.record.file_size = len(content)
+        db.session.commit()
+
+        self.assertIsNot(get_answer_keyword_matcher()[0], matcher)
+        self.assertIn('神聖同盟', extract_keywords_from_text('神聖同盟が結成された'))
+
+
+if __name__ == '__main__':
+    unittest.main()
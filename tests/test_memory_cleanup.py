@@ -7,6 +7,7 @@ import gc
 # Add app directory to path
 sys.path.append('/Users/kitsukaasaki/Desktop/SSWordbook')
 
+import temp_db  # noqa: F401  app より先に一時DBへ切り替える
 from app import app, cleanup_caches, MEMORY_THRESHOLD_MB, ROOM_SETTING_CACHE, WORD_DATA_CACHE, TextbookManager, check_memory_and_cleanup
 
 class TestMemoryCleanup(unittest.TestCase):
@@ -0,0 +1,98 @@
+import unittest
+import sys
+import os
+import io
+from unittest.mock import patch
+
+from PIL import Image
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import app, db, AiGradingJob, preprocess_ocr_image, OCR_IMAGE_MAX_SIDE
+
+
+def make_photo(size=(4032, 3024), orientation=None, fmt='JPEG'):
+    """スマホ写真を模した画像（ノイズ入りのカラー画像）"""
+    image = Image.effect_noise(size, 60).convert('RGB')
+    output = io.BytesIO()
+    kwargs = {'quality': 95} if fmt == 'JPEG' else {}
+    if orientation:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        kwargs['exif'] = exif.tobytes()
+    image.save(output, format=fmt, **kwargs)
+    return output.getvalue()
+
+
+class TestOcrPreprocess(unittest.TestCase):
+    def test_large_photo_is_reduced(self):
+        photo = make_photo()
+        processed, stats = preprocess_ocr_image(photo)
+
+        with Image.open(io.BytesIO(processed)) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.mode, 'L')
+            self.assertEqual(max(image.size), OCR_IMAGE_MAX_SIDE)
+            self.assertEqual(image.size, (1280, 960))
+        self.assertEqual(stats['pixels_in'], 4032 * 3024)
+        self.assertEqual(stats['pixels_out'], 1280 * 960)
+        self.assertEqual(stats['bytes_in'], len(photo))
+        self.assertLess(stats['bytes_out'], stats['bytes_in'] / 4)
+
+    def test_exif_orientation_is_applied(self):
+        processed, _ = preprocess_ocr_image(make_photo(size=(2000, 1000), orientation=6))
+        with Image.open(io.BytesIO(processed)) as image:
+            self.assertEqual(image.size, (640, 1280))  # 縦向きに直っている
+
+    def test_png_and_small_images(self):
+        processed, stats = preprocess_ocr_image(make_photo(size=(800, 600), fmt='PNG'))
+        with Image.open(io.BytesIO(processed)) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (800, 600)))
+        self.assertEqual(stats['pixels_in'], stats['pixels_out'])
+
+    def test_invalid_or_huge_images_are_rejected(self):
+        with self.assertRaises(ValueError):
+            preprocess_ocr_image(b'not an image')
+        with patch('app.OCR_IMAGE_MAX_SOURCE_PIXELS', 1000):
+            with self.assertRaises(ValueError):
+                preprocess_ocr_image(make_photo(size=(100, 100)))
+
+
+class TestOcrUpload(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        self.workers_patch = patch('app.ensure_ai_grading_workers')
+        self.workers_patch.start()
+
+    def tearDown(self):
+        self.workers_patch.stop()
+        AiGradingJob.query.filter_by(job_type='ocr').delete()
+        db.session.commit()
+        self.app_context.pop()
+
+    def _upload(self, data):
+        with patch('app.GEMINI_API_KEY', 'test-key'):
+            return app.test_client().post('/api/essay/ocr', data={'image': (io.BytesIO(data), 'answer.jpg')},
+                                          content_type='multipart/form-data')
+
+    def test_upload_stores_preprocessed_image(self):
+        photo = make_photo()
+        response = self._upload(photo)
+        self.assertEqual(response.status_code, 202)
+        stats = response.get_json()['preprocess']
+        self.assertEqual(stats['bytes_in'], len(photo))
+
+        job = AiGradingJob.query.filter_by(job_token=response.get_json()['job_id']).first()
+        self.assertEqual(len(job.input_data), stats['bytes_out'])
+
+    def test_upload_rejects_non_images(self):
+        response = self._upload(b'plain text')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(AiGradingJob.query.filter_by(job_type='ocr').count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
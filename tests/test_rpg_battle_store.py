@@ -0,0 +1,143 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import time
+from datetime import datetime, timedelta
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, get_rpg_problem_pool, create_rpg_battle, get_rpg_battle, get_rpg_battle_score,
+                 discard_rpg_battle, WORD_DATA_CACHE, RPG_BATTLE_STORE, RpgBattle, RpgEnemy, RpgState)
+
+
+def _word(number, answer, enabled=True):
+    return {'chapter': '1', 'number': number, 'question': f'Q{number}', 'answer': answer, 'enabled': enabled}
+
+
+def _cache_word_data(word_data, filename='test.csv'):
+    """load_word_data_from_source で読み込んだのと同じ状態にする"""
+    WORD_DATA_CACHE[filename] = {'data': word_data, 'timestamp': time.time()}
+    return word_data
+
+
+class TestRpgProblemPool(unittest.TestCase):
+    def setUp(self):
+        WORD_DATA_CACHE.clear()
+
+    def tearDown(self):
+        WORD_DATA_CACHE.clear()
+
+    def test_pool_excludes_z_and_disabled(self):
+        word_data = [_word('1', 'A'), _word('Z', 'B'), _word('2', 'C', enabled=False)]
+        pool, all_answers = get_rpg_problem_pool('101', word_data, None)
+        self.assertEqual([w['answer'] for w in pool], ['A'])
+        self.assertEqual(set(all_answers), {'A', 'B', 'C'})
+
+    def test_pool_is_cached_until_word_data_changes(self):
+        word_data = _cache_word_data([_word('1', 'A')])
+        with patch('app.is_unit_enabled_by_room_setting', return_value=True) as mock_check:
+            first, _ = get_rpg_problem_pool('101', word_data, None)
+            second, _ = get_rpg_problem_pool('101', word_data, None)
+            self.assertIs(first, second)
+            self.assertEqual(mock_check.call_count, 1)
+
+            # CSV再読込で別オブジェクトになったら再構築
+            reloaded = _cache_word_data(list(word_data))
+            third, _ = get_rpg_problem_pool('101', reloaded, None)
+            self.assertIsNot(first, third)
+            self.assertEqual(mock_check.call_count, 2)
+
+    def test_pool_is_dropped_with_word_data(self):
+        word_data = _cache_word_data([_word('1', 'A')])
+        get_rpg_problem_pool('101', word_data, None)
+        # プールはCSVのキャッシュエントリ内にあり、CSVが追い出されれば一緒に消える
+        self.assertIn('101', WORD_DATA_CACHE['test.csv']['rpg_pools'])
+
+        # キャッシュ外のword_dataからはプールを作るだけで保存しない
+        uncached = [_word('1', 'A')]
+        first, _ = get_rpg_problem_pool('101', uncached, None)
+        second, _ = get_rpg_problem_pool('101', uncached, None)
+        self.assertIsNot(first, second)
+
+
+class TestRpgBattleStore(TempDatabaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user_id = cls.create_user().id
+
+    def setUp(self):
+        RPG_BATTLE_STORE.clear()
+
+    def test_battle_belongs_to_user(self):
+        battle_id = create_rpg_battle(self.user_id, ['A', 'B'], 5)
+        self.assertEqual(get_rpg_battle(battle_id, self.user_id)['stage_id'], 5)
+        self.assertIsNone(get_rpg_battle(battle_id, self.user_id + 1))
+
+    def test_battle_expires(self):
+        battle_id = create_rpg_battle(self.user_id, ['A'], 5)
+        RpgBattle.query.filter_by(battle_id=battle_id).update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        RPG_BATTLE_STORE.clear()
+        self.assertIsNone(get_rpg_battle(battle_id, self.user_id))
+
+        # 次の戦闘作成時に期限切れデータは掃除される
+        create_rpg_battle(self.user_id, ['A'], 5)
+        self.assertIsNone(RpgBattle.query.filter_by(battle_id=battle_id).first())
+        self.assertNotIn(battle_id, RPG_BATTLE_STORE)
+
+    def test_discard(self):
+        battle_id = create_rpg_battle(self.user_id, ['A'], 5)
+        discard_rpg_battle(battle_id)
+        self.assertIsNone(get_rpg_battle(battle_id, self.user_id))
+        self.assertIsNone(get_rpg_battle_score(battle_id))
+
+    def test_check_endpoint_uses_server_state(self):
+        client = app.test_client()
+        battle_id = create_rpg_battle(self.user_id, ['正解', '別解'], 5)
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+            sess['rpg_battle_id'] = battle_id
+
+        response = client.post('/api/rpg/check', json={'index': 0, 'choice': '正解'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_json()['is_correct'])
+
+        response = client.post('/api/rpg/check', json={'index': 1, 'choice': '正解'})
+        self.assertFalse(response.get_json()['is_correct'])
+
+        response = client.post('/api/rpg/check', json={'index': 2, 'choice': '正解'})
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(get_rpg_battle_score(battle_id), (1, 1))
+
+    def test_win_is_accepted_after_worker_restart(self):
+        """メモリ上の戦闘データが消えても（ワーカー再起動）、正当な勝利は記録される"""
+        enemy = RpgEnemy(name='再起動のボス', clear_correct_count=2, clear_max_mistakes=0)
+        db.session.add(enemy)
+        db.session.commit()
+        enemy_id = enemy.id
+
+        client = app.test_client()
+        battle_id = create_rpg_battle(self.user_id, ['A', 'B', 'C'], enemy_id)
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+            sess['rpg_battle_id'] = battle_id
+
+        client.post('/api/rpg/check', json={'index': 0, 'choice': 'A'})
+        RPG_BATTLE_STORE.clear()
+        client.post('/api/rpg/check', json={'index': 1, 'choice': 'B'})
+        RPG_BATTLE_STORE.clear()
+
+        response = client.post('/api/rpg/result', json={'is_win': True, 'stage_id': enemy_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_json()['new_clear'])
+        db.session.expire_all()
+        self.assertIn(enemy_id, RpgState.query.filter_by(user_id=self.user_id).first().cleared_stages)
+        self.assertIsNone(RpgBattle.query.filter_by(battle_id=battle_id).first())
+
+if __name__ == '__main__':
+    unittest.main()
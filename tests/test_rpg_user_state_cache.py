@@ -0,0 +1,60 @@
+import unittest
+import sys
+import os
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import app, db, User, RpgState, RPG_USER_STATE_CACHE, get_rpg_user_state_cached
+
+
+class TestRpgUserStateOnUserDelete(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        RPG_USER_STATE_CACHE.clear()
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+
+    def tearDown(self):
+        RPG_USER_STATE_CACHE.clear()
+        self.app_context.pop()
+
+    def _user_with_cleared_stages(self, student_id):
+        user = self.create_user(student_id=student_id, username=f'RPG生徒{student_id}')
+        db.session.add(RpgState(user_id=user.id, cleared_stages=[1, 2]))
+        db.session.commit()
+        self.assertEqual(get_rpg_user_state_cached(user.id)['cleared_stages'], frozenset({'1', '2'}))
+        return user.id
+
+    def _assert_reused_id_starts_fresh(self, user_id):
+        # SQLiteなどでIDが再利用されても、前のユーザーの撃破状況を引き継がない
+        new_user = self.create_user(student_id='new', username='新しい生徒')
+        self.assertEqual(new_user.id, user_id)
+        self.assertEqual(get_rpg_user_state_cached(new_user.id)['cleared_stages'], frozenset())
+        db.session.delete(new_user)
+        db.session.commit()
+
+    def test_bulk_delete_drops_cached_state(self):
+        user_id = self._user_with_cleared_stages('bulk')
+        response = self.client.post('/admin/bulk_delete_users', json={'user_ids': [str(user_id)]})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(db.session.get(User, user_id))
+        self.assertNotIn(user_id, RPG_USER_STATE_CACHE)
+        self._assert_reused_id_starts_fresh(user_id)
+
+    def test_single_delete_drops_cached_state(self):
+        user_id = self._user_with_cleared_stages('single')
+        self.client.post(f'/admin/delete_user/{user_id}')
+        self.assertIsNone(db.session.get(User, user_id))
+        self.assertNotIn(user_id, RPG_USER_STATE_CACHE)
+
+    def test_bulk_delete_rejects_invalid_ids(self):
+        response = self.client.post('/admin/bulk_delete_users', json={'user_ids': ['abc']})
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
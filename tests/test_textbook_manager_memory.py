@@ -7,6 +7,7 @@ import gc
 # Add app directory to path
 sys.path.append('/Users/kitsukaasaki/Desktop/SSWordbook')
 
+import temp_db  # noqa: F401  app より先に一時DBへ切り替える
 from app import TextbookManager, app
 
 class TestTextbookManagerMemory(unittest.TestCase):
@@ -44,21 +45,21 @@ class TestTextbookManagerMemory(unittest.TestCase):
         self.assertIsNone(self.tm.sections)
         self.assertIsNone(self.tm.toc)
         self.assertIsNone(self.tm.vectors)
+        self.assertIsNone(self.tm.section_index)
         print("✅ Memory cleared successfully")
 
-    def test_get_relevant_content_triggers_load(self):
-        """Verify that get_relevant_content triggers loading"""
-        print("\nTesting get_relevant_content triggers load...")
+    def test_get_relevant_content_loads_only_index(self):
+        """Verify that get_relevant_content loads the section index, not the whole textbook"""
+        print("\nTesting get_relevant_content loads only the section index...")
         self.tm.clear_memory()
         self.assertIsNone(self.tm.sections)
         
         # Call with dummy title
-        # Note: We need to mock _load_textbook if we want to be pure, but integration test is fine here
-        # We expect it to load data then return empty string if not found, or content if found
-        # We just check if sections became not None
+        # セクション本文は索引のバイト位置から必要な分だけ読むので、教科書全体は読み込まない
         self.tm.get_relevant_content(["NonExistentTitle"])
-        self.assertIsNotNone(self.tm.sections)
-        print("✅ get_relevant_content triggered load")
+        self.assertIsNotNone(self.tm.section_index)
+        self.assertIsNone(self.tm.sections)
+        print("✅ get_relevant_content loaded the section index only")
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,391 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import json
+import pickle
+import tempfile
+
+import numpy as np
+
+try:
+    from google.genai import types as _genai_types  # noqa: F401  採点処理が遅延インポートする
+    HAS_GENAI = True
+except ImportError:
+    HAS_GENAI = False
+
+# Add the project directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from temp_db import TempDatabaseTestCase  # app より先に一時DBへ切り替える
+from app import (app, db, EssayProblem, EmbeddingCache, TextbookManager, map_essay_problems_to_textbook, quantize_vectors_int8,
+                 build_textbook_bm25_index, build_textbook_section_index, reciprocal_rank_fusion,
+                 grade_essay_answer, get_text_embedding, get_embedding_cache_stats, EMBEDDING_CACHE, EMBEDDING_CACHE_STATS)
+
+
+class TestTextbookVectorSearch(unittest.TestCase):
+    TITLES = ['第1章 古代', '第2章 中世', '第3章 近世', '第4章 近代']
+    VECTORS = [[1.0, 0.0, 0.0], [0.6, 0.8, 0.0], [0.0, 0.0, 2.0], [0.0, 1.0, 0.0]]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manager = TextbookManager()
+        self.manager.data_dir = self.tmpdir.name
+        self.manager.sections = {}
+        self.manager.toc = []
+
+    def tearDown(self):
+        self.manager.clear_memory()
+        self.tmpdir.cleanup()
+
+    def _write_matrix(self):
+        matrix = np.asarray(self.VECTORS, dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.save(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_MATRIX_FILENAME), matrix)
+        with open(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_TITLES_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(self.TITLES, f, ensure_ascii=False)
+
+    def test_matrix_search_orders_by_cosine_similarity(self):
+        self._write_matrix()
+        with patch.object(self.manager, '_embed_query', return_value=[1.0, 2.0, 0.0]):
+            titles = self.manager.search_relevant_sections('クエリ', top_k=3)
+        self.assertEqual(titles, ['第2章 中世', '第4章 近代', '第1章 古代'])
+
+    def test_matrix_is_mapped_once_and_kept(self):
+        self._write_matrix()
+        with patch.object(self.manager, '_embed_query', return_value=[0.0, 0.0, 1.0]):
+            self.assertEqual(self.manager.search_relevant_sections('a', top_k=1), ['第3章 近世'])
+            matrix = self.manager.vector_matrix
+            self.assertIsInstance(matrix, np.memmap)
+            self.manager.search_relevant_sections('b', top_k=1)
+            self.assertIs(self.manager.vector_matrix, matrix)
+
+        self.manager.clear_memory()
+        self.assertIsNone(self.manager.vector_matrix)
+
+    def test_top_k_larger_than_matrix(self):
+        self._write_matrix()
+        with patch.object(self.manager, '_embed_query', return_value=[1.0, 0.0, 0.0]):
+            titles = self.manager.search_relevant_sections('クエリ', top_k=10)
+        self.assertEqual(len(titles), len(self.TITLES))
+        self.assertEqual(titles[0], '第1章 古代')
+
+    def _write_int8(self, matrix):
+        codes, scales = quantize_vectors_int8(matrix)
+        np.save(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_INT8_FILENAME), codes)
+        np.save(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_SCALES_FILENAME), scales)
+
+    def test_quantize_round_trip(self):
+        matrix = np.asarray(self.VECTORS, dtype=np.float32)
+        codes, scales = quantize_vectors_int8(matrix)
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertEqual(np.abs(codes).max(axis=1).tolist(), [127, 127, 127, 127])
+        np.testing.assert_allclose(codes * scales[:, None], matrix, atol=0.01)
+
+    def test_int8_first_pass_with_rerank_matches_exact_search(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((300, 64)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.TITLES = [f'section{i}' for i in range(300)]
+        np.save(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_MATRIX_FILENAME), matrix)
+        with open(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_TITLES_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(self.TITLES, f)
+        self._write_int8(matrix)
+
+        self.assertTrue(self.manager._load_vector_matrix())
+        self.assertIsNotNone(self.manager.vector_codes)
+        for query in rng.standard_normal((20, 64)):
+            expected = [self.TITLES[i] for i in np.argsort(-(matrix @ (query / np.linalg.norm(query))))[:5]]
+            self.assertEqual(self.manager._search_vector_matrix(query, 5), expected)
+
+    def test_mismatched_int8_file_is_ignored(self):
+        self._write_matrix()
+        self._write_int8(np.ones((2, 3), dtype=np.float32))
+        with patch.object(self.manager, '_embed_query', return_value=[1.0, 2.0, 0.0]):
+            titles = self.manager.search_relevant_sections('クエリ', top_k=1)
+        self.assertIsNone(self.manager.vector_codes)
+        self.assertEqual(titles, ['第2章 中世'])
+
+    def test_falls_back_to_legacy_pickle(self):
+        vector_db = [{'title': t, 'content': '', 'vector': v} for t, v in zip(self.TITLES, self.VECTORS)]
+        with open(os.path.join(self.tmpdir.name, TextbookManager.LEGACY_VECTOR_FILENAME), 'wb') as f:
+            pickle.dump(vector_db, f)
+
+        with patch.object(self.manager, '_embed_query', return_value=[1.0, 2.0, 0.0]):
+            titles = self.manager.search_relevant_sections('クエリ', top_k=2)
+        self.assertEqual(titles, ['第2章 中世', '第4章 近代'])
+        # 旧形式は検索ごとに解放する
+        self.assertIsNone(self.manager.vectors)
+
+    def test_no_vector_db(self):
+        with patch.object(self.manager, '_embed_query') as mock_embed:
+            self.assertEqual(self.manager.search_relevant_sections('クエリ'), [])
+        mock_embed.assert_not_called()
+
+
+class TestEssayTextbookMapping(TempDatabaseTestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manager = TextbookManager()
+        self.manager.data_dir = self.tmpdir.name
+        self.manager.sections = {}
+        self.manager.toc = []
+        np.save(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_MATRIX_FILENAME),
+                np.eye(3, dtype=np.float32))
+        with open(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_TITLES_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(['古代', '中世', '近代'], f, ensure_ascii=False)
+
+        problem = EssayProblem(
+            chapter='96', type='A', university='テスト大学', year=2000,
+            question='ウィーン体制について述べよ。', answer='解答例', answer_length=3
+        )
+        db.session.add(problem)
+        db.session.commit()
+        self.problem_id = problem.id
+
+        self.patchers = [
+            patch('app.TextbookManager.get_instance', return_value=self.manager),
+            patch.object(self.manager, '_embed_query', return_value=[0.0, 1.0, 0.5]),
+        ]
+        self.mock_embed = [p.start() for p in self.patchers][1]
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        EssayProblem.query.filter_by(id=self.problem_id).delete()
+        db.session.commit()
+        self.manager.clear_memory()
+        self.tmpdir.cleanup()
+        self.app_context.pop()
+
+    def test_mapping_is_stored_and_skipped_until_question_changes(self):
+        self.assertEqual(map_essay_problems_to_textbook([self.problem_id]), 1)
+        problem = db.session.get(EssayProblem, self.problem_id)
+        self.assertEqual(problem.get_textbook_sections(), ['中世', '近代', '古代'])
+
+        self.assertEqual(map_essay_problems_to_textbook([self.problem_id]), 0)
+        self.assertEqual(self.mock_embed.call_count, 1)
+
+        problem = db.session.get(EssayProblem, self.problem_id)
+        problem.question = '産業革命について述べよ。'
+        db.session.commit()
+        self.assertIsNone(problem.get_textbook_sections())
+        self.assertEqual(map_essay_problems_to_textbook([self.problem_id]), 1)
+
+    @unittest.skipUnless(HAS_GENAI, 'google-genai is not installed')
+    def test_grading_uses_stored_mapping(self):
+        map_essay_problems_to_textbook([self.problem_id])
+        with patch.object(self.manager, 'retrieve_sections') as mock_search, \
+                patch('app.get_genai_client', return_value=None):
+            _, status = grade_essay_answer(self.problem_id, '解答')
+        self.assertEqual(status, 503)
+        mock_search.assert_not_called()
+
+    @unittest.skipUnless(HAS_GENAI, 'google-genai is not installed')
+    def test_grading_stores_live_search_result(self):
+        with patch('app.get_genai_client', return_value=None):
+            grade_essay_answer(self.problem_id, '解答')
+        problem = db.session.get(EssayProblem, self.problem_id)
+        self.assertEqual(problem.get_textbook_sections(), ['中世', '近代', '古代'])
+
+
+class TestTextbookBm25(unittest.TestCase):
+    SECTIONS = {
+        '●ウィーン会議': 'ナポレオン戦争後、メッテルニヒの主導でウィーン会議が開かれ、正統主義が唱えられた。',
+        '●七月革命': 'フランスで七月革命がおこり、ウィーン体制は動揺した。',
+        '●宋代の経済': '宋代には商業が発展し、交子や会子などの紙幣が使われた。',
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manager = TextbookManager()
+        self.manager.data_dir = self.tmpdir.name
+        self.manager.sections = dict(self.SECTIONS)
+        self.manager.toc = list(self.SECTIONS)
+
+    def tearDown(self):
+        self.manager.clear_memory()
+        self.tmpdir.cleanup()
+
+    def test_ranks_sections_by_bm25(self):
+        self.assertEqual(self.manager.bm25_search_sections('ウィーン体制の動揺について', top_k=2),
+                         ['●七月革命', '●ウィーン会議'])
+        self.assertEqual(self.manager.bm25_search_sections('宋の紙幣', top_k=3), ['●宋代の経済'])
+        self.assertEqual(self.manager.bm25_search_sections('あ', top_k=3), [])
+
+    def test_precomputed_index_file_is_used(self):
+        index = build_textbook_bm25_index(self.SECTIONS.items())
+        np.savez(os.path.join(self.tmpdir.name, TextbookManager.BM25_INDEX_FILENAME), **index)
+        self.manager.sections = {}
+        self.assertEqual(self.manager.bm25_search_sections('紙幣', top_k=1), ['●宋代の経済'])
+
+    def test_falls_back_to_bm25_when_embedding_fails(self):
+        np.save(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_MATRIX_FILENAME), np.eye(3, dtype=np.float32))
+        with open(os.path.join(self.tmpdir.name, TextbookManager.VECTOR_TITLES_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(list(self.SECTIONS), f, ensure_ascii=False)
+
+        with patch.object(self.manager, '_embed_query', return_value=None):
+            titles, source = self.manager.retrieve_sections('七月革命', top_k=1)
+        self.assertEqual((titles, source), (['●七月革命'], 'bm25'))
+
+        with patch.object(self.manager, '_embed_query') as mock_embed:
+            titles, source = self.manager.retrieve_sections('七月革命', top_k=1, mode='bm25')
+        mock_embed.assert_not_called()
+        self.assertEqual(source, 'bm25')
+
+    def test_hybrid_fuses_vector_and_bm25_ranks(self):
+        with patch.object(self.manager, '_vector_search', return_value=['●宋代の経済', '●ウィーン会議', '●七月革命']):
+            titles, source = self.manager.retrieve_sections('ウィーン体制の動揺', top_k=3, mode='hybrid')
+            self.assertEqual(source, 'hybrid')
+            # ベクトル検索だけで1位の宋代は、BM25で一致しないため最下位に下がる
+            self.assertEqual(titles, ['●七月革命', '●ウィーン会議', '●宋代の経済'])
+
+            # hybrid は環境変数で明示したときだけ使う
+            titles, source = self.manager.retrieve_sections('ウィーン体制の動揺', top_k=1)
+            self.assertEqual((titles, source), (['●宋代の経済'], 'vector'))
+
+    def test_reciprocal_rank_fusion(self):
+        self.assertEqual(reciprocal_rank_fusion([['a', 'b', 'c'], ['b', 'c']]), ['b', 'c', 'a'])
+        self.assertEqual(reciprocal_rank_fusion([['a', 'b'], []]), ['a', 'b'])
+
+
+class TestTextbookSectionIndex(unittest.TestCase):
+    TEXTBOOK = (
+        "はじめに\n"
+        "第1章　古代\n"
+        "１　文明の誕生\n"
+        "大河のほとりで文明がおこった。\n"
+        "\n"
+        "●ウィーン会議\n"
+        "メッテルニヒが主導した。\n"
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.textbook_path = os.path.join(self.tmpdir.name, 'textbook.txt')
+        with open(self.textbook_path, 'w', encoding='utf-8') as f:
+            f.write(self.TEXTBOOK)
+        self.manager = TextbookManager()
+        self.manager.data_dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.manager.clear_memory()
+        self.tmpdir.cleanup()
+
+    def test_index_records_byte_ranges(self):
+        index = build_textbook_section_index(self.textbook_path)
+        self.assertEqual(index['toc'], ['Introduction', '第1章　古代', '１　文明の誕生', '●ウィーン会議'])
+        self.assertEqual(index['source_size'], len(self.TEXTBOOK.encode('utf-8')))
+        offset, length = index['sections']['●ウィーン会議']
+        self.assertEqual(self.TEXTBOOK.encode('utf-8')[offset:offset + length].decode('utf-8'),
+                         "●ウィーン会議\nメッテルニヒが主導した。\n")
+
+    def test_relevant_content_reads_only_selected_sections(self):
+        with patch.object(self.manager, '_ensure_textbook_loaded') as mock_load:
+            content, used = self.manager.get_relevant_content(['●ウィーン会議', '文明の誕生', '古代', '存在しない見出し'])
+        mock_load.assert_not_called()
+        self.assertIsNone(self.manager.sections)
+        # 完全一致・表記揺れ（番号なし）・部分一致の順に解決する
+        self.assertEqual(used, ['●ウィーン会議', '１　文明の誕生', '第1章　古代'])
+        self.assertIn("--- １　文明の誕生 ---\n１　文明の誕生\n大河のほとりで文明がおこった。\n\n\n---", content)
+
+    def test_precomputed_index_is_used_and_stale_index_rebuilt(self):
+        index = build_textbook_section_index(self.textbook_path)
+        index_path = os.path.join(self.tmpdir.name, TextbookManager.SECTION_INDEX_FILENAME)
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        with patch('app.build_textbook_section_index') as mock_build:
+            self.assertEqual(self.manager.get_relevant_content(['●ウィーン会議'])[1], ['●ウィーン会議'])
+        mock_build.assert_not_called()
+
+        # 教科書を書き換えたら古い索引は使わない
+        self.manager.clear_memory()
+        with open(self.textbook_path, 'w', encoding='utf-8') as f:
+            f.write("序文を追加\n" + self.TEXTBOOK)
+        content, used = self.manager.get_relevant_content(['●ウィーン会議'])
+        self.assertEqual(used, ['●ウィーン会議'])
+        self.assertIn("●ウィーン会議\nメッテルニヒが主導した。", content)
+
+    def test_shifted_offsets_are_detected(self):
+        # 大きさは同じで内容だけずれた索引（見出しの位置が合わない）
+        index = build_textbook_section_index(self.textbook_path)
+        index['sections']['●ウィーン会議'][0] -= 3
+        with open(os.path.join(self.tmpdir.name, TextbookManager.SECTION_INDEX_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        content, used = self.manager.get_relevant_content(['●ウィーン会議'])
+        self.assertEqual(used, ['●ウィーン会議'])
+        self.assertTrue(content.startswith("\n\n--- ●ウィーン会議 ---\n●ウィーン会議\n"))
+
+
+class _FakeEmbeddingClient:
+    """embed_content の呼び出し回数を数える埋め込みAPIの代役"""
+    def __init__(self):
+        self.calls = []
+        self.models = self
+
+    def embed_content(self, model, contents):
+        self.calls.append(contents)
+        values = [float(len(contents)), 1.0, 0.5]
+        return type('Result', (), {'embeddings': [type('Embedding', (), {'values': values})()]})()
+
+
+class TestEmbeddingCache(TempDatabaseTestCase):
+    MODEL = 'test-embedding-model'
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        EMBEDDING_CACHE.clear()
+        for key in EMBEDDING_CACHE_STATS:
+            EMBEDDING_CACHE_STATS[key] = 0
+        self.client = _FakeEmbeddingClient()
+        self.patcher = patch('app.get_genai_client', return_value=self.client)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        EMBEDDING_CACHE.clear()
+        EmbeddingCache.query.filter_by(model=self.MODEL).delete()
+        db.session.commit()
+        self.app_context.pop()
+
+    def test_memory_then_table_then_api(self):
+        first = get_text_embedding('ウィーン体制について200字で述べよ。', model=self.MODEL)
+        self.assertEqual(list(first), [19.0, 1.0, 0.5])
+        self.assertEqual(len(self.client.calls), 1)
+
+        # 前後の空白・全角半角の違いは同じ文章として扱う
+        second = get_text_embedding('  ウィーン体制について２００字で述べよ。\n', model=self.MODEL)
+        self.assertIs(second, first)
+
+        # プロセス再起動相当（メモリ上のLRUが空）でもテーブルから返す
+        EMBEDDING_CACHE.clear()
+        third = get_text_embedding('ウィーン体制について200字で述べよ。', model=self.MODEL)
+        self.assertEqual(list(third), list(first))
+        self.assertEqual(len(self.client.calls), 1)
+
+        stats = get_embedding_cache_stats()
+        self.assertEqual((stats['memory_hits'], stats['db_hits'], stats['misses']), (1, 1, 1))
+
+    def test_lru_keeps_recently_used(self):
+        with patch('app.MAX_EMBEDDING_CACHE_SIZE', 2):
+            get_text_embedding('A', model=self.MODEL)
+            get_text_embedding('B', model=self.MODEL)
+            get_text_embedding('A', model=self.MODEL)  # Aを最新にする
+            get_text_embedding('C', model=self.MODEL)  # 最も古いBが追い出される
+        cached_hashes = [text_hash for _, text_hash in EMBEDDING_CACHE]
+        self.assertEqual(len(cached_hashes), 2)
+        self.assertEqual(EMBEDDING_CACHE_STATS['memory_hits'], 1)
+        self.assertEqual(EmbeddingCache.query.filter_by(model=self.MODEL).count(), 3)
+
+    def test_api_failure_is_not_cached(self):
+        with patch('app.get_genai_client', return_value=None):
+            self.assertIsNone(get_text_embedding('失敗する文章', model=self.MODEL))
+        self.assertEqual(len(EMBEDDING_CACHE), 0)
+        self.assertEqual(EmbeddingCache.query.filter_by(model=self.MODEL).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
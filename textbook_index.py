@@ -0,0 +1,125 @@
+"""
+教科書・論述問題の検索索引を作る純粋な関数（DBやFlaskに依存しない）。
+app.py と scripts/build_vector_db.py の両方から使う。scripts 側が app を読み込むと
+DB初期化まで走るため、分かち方・見出しの判定・量子化の方式はここに置いて揃える。
+"""
+import re
+import unicodedata
+
+# 教科書の見出し行（第X部・第X章 / 番号+全角空白 / ● / 【】）
+TEXTBOOK_HEADER_PATTERN = re.compile(r'^(第[０-９0-9]+[部章].*|[０-９0-9]+　.*|●.*|【.*】.*)')
+
+
+def normalize_search_text(value):
+    """検索用にテキストを正規化する（HTMLタグ除去・NFKC・小文字化・空白除去）"""
+    if not value:
+        return ''
+    value = re.sub(r'<[^>]+>', '', value)
+    value = unicodedata.normalize('NFKC', value).lower()
+    return re.sub(r'\s+', '', value)
+
+
+def search_bigrams(normalized):
+    """正規化済みテキストを文字bigramのリストに分解する（重複を含む）"""
+    return [normalized[i:i + 2] for i in range(len(normalized) - 1)]
+
+
+def normalize_section_title(title):
+    """見出しの表記揺れを吸収したキー（NFKC・先頭の●や番号・空白を除去）"""
+    value = unicodedata.normalize('NFKC', title or '').strip()
+    value = re.sub(r'^(●|\d+\s+)', '', value)
+    return re.sub(r'\s+', '', value).lower()
+
+
+def quantize_vectors_int8(matrix):
+    """
+    行ごとのスケールでint8に量子化する（scripts/build_vector_db.py とベンチマークで使用）。
+    戻り値は (codes: int8行列, scales: float32配列)。復元値は codes * scales[:, None]。
+    """
+    import numpy as np
+
+    matrix = np.asarray(matrix, dtype=np.float32)
+    max_abs = np.abs(matrix).max(axis=1)
+    scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def build_textbook_bm25_index(sections):
+    """
+    教科書セクションの文字bigram BM25インデックスを作る（scripts/build_vector_db.py と、ファイルがない場合の遅延構築で使用）。
+    sections は (title, content) の列。戻り値は np.savez にそのまま渡せる配列のdict:
+    grams（昇順のbigram）/ indptr・doc_ids・tfs（bigramごとのpostings。grams[i] は doc_ids[indptr[i]:indptr[i+1]]）/
+    doc_lengths / titles
+    """
+    import numpy as np
+
+    titles = []
+    doc_lengths = []
+    gram_chunks, doc_chunks, tf_chunks = [], [], []
+    for doc_id, (title, content) in enumerate(sections):
+        grams = search_bigrams(normalize_search_text(f"{title}\n{content}"))
+        counts = {}
+        for gram in grams:
+            counts[gram] = counts.get(gram, 0) + 1
+        titles.append(title)
+        doc_lengths.append(len(grams))
+        if counts:
+            gram_chunks.append(np.array(list(counts.keys()), dtype='<U2'))
+            tf_chunks.append(np.fromiter(counts.values(), dtype=np.int32, count=len(counts)))
+            doc_chunks.append(np.full(len(counts), doc_id, dtype=np.int32))
+
+    if gram_chunks:
+        all_grams = np.concatenate(gram_chunks)
+        order = np.argsort(all_grams, kind='stable')  # 同じbigram内は文書ID順のまま
+        all_grams = all_grams[order]
+        doc_ids = np.concatenate(doc_chunks)[order]
+        tfs = np.concatenate(tf_chunks)[order]
+        grams, starts = np.unique(all_grams, return_index=True)
+    else:
+        grams, starts = np.array([], dtype='<U2'), np.array([], dtype=np.int64)
+        doc_ids = tfs = np.array([], dtype=np.int32)
+
+    return {
+        'grams': grams,
+        'indptr': np.append(starts, len(doc_ids)).astype(np.int32),
+        'doc_ids': doc_ids,
+        'tfs': tfs,
+        'doc_lengths': np.array(doc_lengths, dtype=np.int32),
+        'titles': np.array(titles, dtype=str)
+    }
+
+
+def build_textbook_section_index(textbook_path):
+    """
+    教科書の見出しごとのバイト位置の索引を作る（scripts/build_vector_db.py と、索引ファイルがない場合に使用）。
+    戻り値: {'source_size': 教科書のバイト数, 'toc': [見出し], 'sections': {見出し: [offset, length]},
+             'aliases': {正規化した見出し: 見出し}}
+    同じ見出しが複数ある場合は後のものを使う（TextbookManager._load_textbook と同じ）。
+    """
+    with open(textbook_path, 'rb') as f:
+        data = f.read()
+
+    toc = []
+    sections = {}
+    current_header = "Introduction"
+    current_start = 0
+    offset = 0
+    for line in data.splitlines(keepends=True):
+        if TEXTBOOK_HEADER_PATTERN.match(line.decode('utf-8', errors='replace')):
+            if offset > current_start:
+                sections[current_header] = [current_start, offset - current_start]
+                toc.append(current_header)
+            current_header = line.decode('utf-8', errors='replace').strip()
+            current_start = offset
+        offset += len(line)
+    if offset > current_start:
+        sections[current_header] = [current_start, offset - current_start]
+        toc.append(current_header)
+
+    return {
+        'source_size': len(data),
+        'toc': toc,
+        'sections': sections,
+        'aliases': {normalize_section_title(title): title for title in sections}
+    }